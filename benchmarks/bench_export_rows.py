@@ -0,0 +1,114 @@
+"""Row conversion throughput of the /export cursor path.
+
+Compares the historical per-row/per-column loop (default re-evaluated for every
+value) with the converter plan resolved once per table, on a synthetic
+`attache` table. No database needed.
+
+    python benchmarks/bench_export_rows.py [rows]
+"""
+import gc
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import main  # noqa: E402
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+# Colonnes de attache telles que build_table_plan les décrit
+ATTACHE_COLUMNS = [
+    {'name': 'numero_attache', 'type': 'integer', 'default': "nextval('attache_numero_attache_seq'::regclass)", 'nullable': 'NO', 'is_identity': True},
+    {'name': 'user_id', 'type': 'character varying', 'default': None, 'nullable': 'NO', 'is_identity': False},
+    {'name': 'numero_comande', 'type': 'integer', 'default': None, 'nullable': 'YES', 'is_identity': False},
+    {'name': 'numero_item', 'type': 'integer', 'default': None, 'nullable': 'YES', 'is_identity': False},
+    {'name': 'quantite', 'type': 'double precision', 'default': None, 'nullable': 'YES', 'is_identity': False},
+    {'name': 'prixt', 'type': 'character varying', 'default': None, 'nullable': 'YES', 'is_identity': False},
+    {'name': 'remarque', 'type': 'character varying', 'default': None, 'nullable': 'YES', 'is_identity': False},
+    {'name': 'bnfc', 'type': 'character varying', 'default': None, 'nullable': 'YES', 'is_identity': False},
+    {'name': 'marge', 'type': 'character varying', 'default': None, 'nullable': 'YES', 'is_identity': False},
+    {'name': 'prixbh', 'type': 'character varying', 'default': "'0.00'::character varying", 'nullable': 'YES', 'is_identity': False},
+    {'name': 'achatfx', 'type': 'character varying', 'default': "'0'::character varying", 'nullable': 'YES', 'is_identity': False},
+    {'name': 'send', 'type': 'boolean', 'default': 'false', 'nullable': 'YES', 'is_identity': False},
+]
+
+
+def synthetic_rows(n):
+    rnd = random.Random(42)
+    for i in range(1, n + 1):
+        yield {
+            'numero_attache': i,
+            'user_id': 'bench',
+            'numero_comande': i // 8,
+            'numero_item': rnd.randint(1, 50000),
+            'quantite': float(rnd.randint(1, 20)),
+            'prixt': f'{rnd.randint(10, 99999) / 100:.2f}',
+            'remarque': '' if i % 5 else None,
+            'bnfc': None,
+            'marge': None,
+            'prixbh': f'{rnd.randint(10, 99999) / 100:.2f}',
+            'achatfx': '0',
+            'send': None if i % 3 == 0 else bool(i % 2),
+        }
+
+
+def legacy_convert(rows, column_info):
+    processed_rows = []
+    for row in rows:
+        processed_row = []
+        for col_info in column_info:
+            value = row[col_info['name']]
+            if value is None:
+                if col_info['default'] and not col_info['is_identity']:
+                    default_str = str(col_info['default']).lower()
+                    if 'true' in default_str:
+                        value = 1
+                    elif 'false' in default_str:
+                        value = 0
+            elif isinstance(value, bool):
+                value = 1 if value else 0
+            processed_row.append(value)
+        processed_rows.append(tuple(processed_row))
+    return processed_rows
+
+
+def planned_convert(rows, column_info):
+    values_of = main.row_values_getter(column_info)
+    converters = main.column_converters(column_info)
+    processed_rows = []
+    for row in rows:
+        values = values_of(row)
+        for idx, convert in converters:
+            values[idx] = convert(values[idx])
+        processed_rows.append(values)
+    return processed_rows
+
+
+def run(label, convert, batches, insert):
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE ATTACHE (%s)' % ', '.join(c['name'] for c in ATTACHE_COLUMNS))
+    sql = 'INSERT INTO ATTACHE VALUES (%s)' % ','.join('?' * len(ATTACHE_COLUMNS))
+    gc.collect()
+    start = time.perf_counter()
+    for batch in batches:
+        rows = convert(batch, ATTACHE_COLUMNS)
+        if insert:
+            db.executemany(sql, rows)
+    elapsed = time.perf_counter() - start
+    print(f'{label:<32} {ROWS / elapsed:>12,.0f} rows/s  ({elapsed:.2f} s)')
+    db.close()
+
+
+if __name__ == '__main__':
+    rows = list(synthetic_rows(ROWS))
+    batches = [rows[i:i + 1000] for i in range(0, ROWS, 1000)]
+    print(f'attache synthétique: {ROWS:,} lignes, lots de 1000')
+    sample = rows[:10000]
+    assert [list(r) for r in legacy_convert(sample, ATTACHE_COLUMNS)] == planned_convert(sample, ATTACHE_COLUMNS)
+    run('avant (conversion seule)', legacy_convert, batches, False)
+    run('après (conversion seule)', planned_convert, batches, False)
+    run('avant (conversion + SQLite)', legacy_convert, batches, True)
+    run('après (conversion + SQLite)', planned_convert, batches, True)
@@ -0,0 +1,106 @@
+"""Conversion throughput of migration payloads (/migrate_receive).
+
+Compares the historical per-row lambda calling s/i/f/b for every field (then
+one copy_text_value per field to build the COPY text) with the column
+converters compiled from MIGRATE_PLAN and the column-wise COPY text of
+copy_columns, on a synthetic `attache` table: as the desktop client sends it
+in JSON (numbers as strings, European decimal commas) and as read from a
+SQLite upload (typed values). No database needed.
+
+    python benchmarks/bench_migrate_convert.py [rows]
+"""
+import gc
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import main  # noqa: E402
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+s, i, f, b = main.to_str, main.to_int, main.to_float, main.to_bool
+
+# Conversion d'une ligne attache telle que migrate_receive la faisait
+def legacy_row(r, user_id='bench'):
+    return (
+        i(r.get('numero_comande')), i(r.get('numero_item')),
+        f(r.get('quantite')),
+        s(r.get('prixt')),   s(r.get('remarque')),
+        s(r.get('bnfc')),    s(r.get('marge')),
+        s(r.get('prixbh')),  s(r.get('achatfx')),
+        b(r.get('send')),    user_id)
+
+
+def synthetic_rows(n, typed):
+    rnd = random.Random(42)
+    for k in range(1, n + 1):
+        quantite = rnd.randint(1, 40) / 2
+        yield {
+            'numero_comande': k // 8 if typed else str(k // 8),
+            'numero_item': rnd.randint(1, 50000),
+            'quantite': quantite if typed else (f'{quantite:.2f}'.replace('.', ',') if k % 3 else str(quantite)),
+            'prixt': f'{rnd.randint(10, 99999) / 100:.2f}',
+            'remarque': '' if k % 5 else None,
+            'bnfc': None,
+            'marge': ' 0 ',
+            'prixbh': f'{rnd.randint(10, 99999) / 100:.2f}',
+            'achatfx': '0',
+            'send': bool(k % 2) if typed else ('true' if k % 2 else 'False'),
+        }
+
+
+EDGE_VALUES = [None, '', ' ', '0', '007', '-3', '1.5', '1,5', ' 2,50 ', '1.2.3', '1e5', 'inf', 'nan',
+               '12 345,67', '-.5', '5.', '.', '-', '5-3', '٣', '²', 'abc', 'TRUE', ' oui ', 0, 1, -7,
+               2.5, float('nan'), True, False, '12345678901234567890', 10 ** 20]
+
+
+def check_equivalence():
+    for kind, scalar in (('s', s), ('i', i), ('f', f), ('b', b)):
+        column = main.MIGRATE_COLUMN_KINDS[kind]
+        expected = [scalar(v) for v in EDGE_VALUES]
+        got = column(EDGE_VALUES, column.__defaults__[0])
+        assert repr(got) == repr(expected), (kind, got, expected)
+    for column in (EDGE_VALUES, ['a\tb', 'c\\', 'ok'], [True, False], [1, 2.5]):
+        assert main.copy_text_column(column) == [main.copy_text_value(v) for v in column], column
+
+
+def legacy_copy_text(rows):
+    buf = io.StringIO()
+    buf.writelines("\t".join(map(main.copy_text_value, row)) + "\n"
+                   for row in (legacy_row(r) for r in rows))
+    return buf.getvalue()
+
+
+def columns_copy_text(convert, rows):
+    text = [main.copy_text_column(col) for col in convert(rows, 'bench', {})]
+    text[-1] = [v + '\n' for v in text[-1]]
+    buf = io.StringIO()
+    buf.writelines(map('\t'.join, zip(*text)))
+    return buf.getvalue()
+
+
+def run(label, convert, rows):
+    gc.collect()
+    start = time.perf_counter()
+    convert(rows)
+    elapsed = time.perf_counter() - start
+    print(f'{label:<34} {len(rows) / elapsed:>12,.0f} rows/s  ({elapsed:.2f} s)')
+
+
+if __name__ == '__main__':
+    check_equivalence()
+    _, _, _, compiled = next(t for t in main.MIGRATE_TABLES if t[0] == 'attache')
+    for typed, label in ((False, 'JSON (chaînes)'), (True, 'SQLite (typé)')):
+        rows = list(synthetic_rows(ROWS, typed))
+        sample = rows[:10000]
+        assert [legacy_row(r) for r in sample] == list(zip(*compiled(sample, 'bench', {})))
+        assert legacy_copy_text(sample) == columns_copy_text(compiled, sample)
+        print(f'attache synthétique {label}: {ROWS:,} lignes')
+        run('  avant (conversion seule)', lambda rows: [legacy_row(r) for r in rows], rows)
+        run('  après (conversion seule)', lambda rows: compiled(rows, 'bench', {}), rows)
+        run('  avant (conversion + texte COPY)', legacy_copy_text, rows)
+        run('  après (conversion + texte COPY)', lambda rows: columns_copy_text(compiled, rows), rows)
@@ -0,0 +1,90 @@
+"""Latency of /valider_vente with and without the prepared-statement registry.
+
+Runs the same sales through the Flask test client, alternating between
+DB_PREPARED_STATEMENTS on and off in rounds so that both modes see the same
+cache and table state, and reports p50/p99 per mode. Needs a database
+(DATABASE_URL); the sales are written under a dedicated tenant that is
+cleaned up before and after.
+
+    python benchmarks/bench_prepared_statements.py [ventes] [lignes par vente]
+"""
+import contextlib
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import main  # noqa: E402
+
+SALES = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+LINES = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+ROUND = 100
+USER_ID = 'bench_prepared'
+
+
+def cleanup(cur):
+    for table in ('attache', 'comande', 'item', 'utilisateur', 'comande_compteur'):
+        cur.execute(f"DELETE FROM {table} WHERE user_id = %s", (USER_ID,))
+
+
+def setup(cur):
+    cur.execute("INSERT INTO utilisateur (nom, password2, user_id) VALUES ('bench', '1234', %s) "
+                "RETURNING numero_util", (USER_ID,))
+    numero_util = cur.fetchone()[0]
+    items = []
+    for k in range(200):
+        cur.execute("INSERT INTO item (designation, qte, user_id) VALUES (%s, 1000000, %s) RETURNING numero_item",
+                    (f'article {k}', USER_ID))
+        items.append(cur.fetchone()[0])
+    return numero_util, items
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+if __name__ == '__main__':
+    client = main.app.test_client()
+    conn = main.get_conn()
+    conn.autocommit = True
+    cur = conn.cursor()
+    main.init_db()
+    cleanup(cur)
+    numero_util, items = setup(cur)
+    conn.close()
+
+    rnd = random.Random(42)
+    timings = {True: [], False: []}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for n in range(-2 * ROUND, SALES * 2):
+            prepared = (n // ROUND) % 2 == 0
+            main.DB_PREPARED_STATEMENTS = prepared
+            sale = {
+                'numero_util': numero_util,
+                'password2': '1234',
+                'lignes': [{'numero_item': rnd.choice(items), 'quantite': rnd.randint(1, 3),
+                            'prixt': f'{rnd.randint(100, 9999) / 100:.2f}', 'prixbh': '1.00'}
+                           for _ in range(LINES)],
+            }
+            start = time.perf_counter()
+            response = client.post('/valider_vente', json=sale, headers={'X-User-ID': USER_ID})
+            elapsed = time.perf_counter() - start
+            assert response.status_code == 200, response.get_data(as_text=True)
+            if n >= 0:  # les deux premiers tours servent d'échauffement
+                timings[prepared].append(elapsed * 1000)
+
+    conn = main.get_conn()
+    conn.autocommit = True
+    cur = conn.cursor()
+    cleanup(cur)
+    conn.close()
+
+    print(f'/valider_vente: {SALES:,} ventes de {LINES} lignes par mode')
+    for prepared, label in ((False, 'sans requêtes préparées'), (True, 'avec requêtes préparées')):
+        values = timings[prepared]
+        print(f'  {label:<26} p50 {percentile(values, 50):6.2f} ms   p99 {percentile(values, 99):6.2f} ms'
+              f'   moyenne {statistics.mean(values):6.2f} ms')
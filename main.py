@@ -1,29 +1,347 @@
 import sqlite3
 import tempfile
 import base64
-from contextlib import contextmanager
-from flask import Flask, request, jsonify
+import gzip
+import glob
+import hashlib
+import io
+import json
+import operator
+import queue
+import shutil
+from flask import Flask, Response, request, jsonify, g, has_request_context
 from flask_cors import CORS
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.pool
 import logging
 import os
+import threading
+import time as _time
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 from psycopg2.extras import RealDictCursor
 from psycopg2 import Error as Psycopg2Error
 from datetime import datetime,timedelta,date,time
 import re
 
+try:
+    import zstandard  # compression zstd optionnelle pour /export
+except ImportError:
+    zstandard = None
+
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 # CORS(app, origins=["https://hicham558.github.io","https://firepoz-s7tl.vercel.app"])  # Autoriser les requêtes depuis ton front-end
 app.debug = True  # Activer le mode debug pour voir les erreurs
 
+# Configurez le logger
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
 # Connexion à la base de données (compatible avec Railway)
-def get_conn():
+def get_database_url():
     url = os.environ['DATABASE_URL']
     if url.startswith("postgres://"):
         url = url.replace("postgres://", "postgresql://", 1)
-    return psycopg2.connect(url, sslmode='require')
+    return url
+
+# ── Pool de connexions PostgreSQL ───────────────────────────────────────────
+# Taille et recyclage configurables par variables d'environnement
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))             # attente max d'une connexion libre (s)
+DB_POOL_MAX_USES = int(os.environ.get('DB_POOL_MAX_USES', 500))             # recyclage après N utilisations
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', 300))   # recyclage après N secondes d'inactivité
+DB_POOL_HEALTHCHECK = float(os.environ.get('DB_POOL_HEALTHCHECK', 30))      # SELECT 1 si inactive depuis N secondes
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connexion psycopg2 dont close() la rend au pool au lieu de fermer le socket."""
+
+    def close(self):
+        if getattr(self, '_request_scoped', False):
+            return  # rendue au pool par le teardown de la requête
+        pool = getattr(self, '_pool', None)
+        if pool is None or self.closed:
+            return super().close()
+        pool.putconn(self)
+
+    def discard(self):
+        """Ferme réellement la connexion (utilisé par le pool)."""
+        super().close()
+
+
+class ConnectionPool:
+    """Pool de connexions thread-safe avec health check, recyclage et statistiques"""
+
+    def __init__(self, minconn, maxconn, timeout, max_uses, idle_timeout, healthcheck):
+        self.minconn = minconn
+        self.maxconn = max(maxconn, 1)
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.idle_timeout = idle_timeout
+        self.healthcheck = healthcheck
+        self._cond = threading.Condition()
+        self._idle = []                      # LIFO : la plus récente en fin de liste
+        self._in_use = weakref.WeakSet()     # une connexion perdue (GC) libère sa place
+        self._opening = 0
+        self._pid = os.getpid()
+        self._stats = {
+            'created': 0, 'closed': 0, 'checkouts': 0, 'returns': 0,
+            'waits': 0, 'timeouts': 0, 'recycled': 0, 'healthcheck_failures': 0,
+        }
+        for _ in range(min(self.minconn, self.maxconn)):
+            try:
+                self._idle.append(self._connect())
+            except psycopg2.Error as e:
+                logger.warning(f"[pool] pré-ouverture impossible: {e}")
+                break
+
+    def _connect(self):
+        conn = psycopg2.connect(get_database_url(), sslmode='require',
+                                connection_factory=PooledConnection)
+        conn._pool = self
+        conn._pool_uses = 0
+        conn._pool_last_used = _time.monotonic()
+        conn._pool_returned = True
+        conn._prepared = set()               # requêtes préparées sur cette connexion
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.discard()
+        except Exception:
+            pass
+        with self._cond:
+            self._stats['closed'] += 1
+
+    def _usable(self, conn):
+        """Health check au moment du checkout"""
+        if conn.closed:
+            return False
+        idle_for = _time.monotonic() - conn._pool_last_used
+        if self.idle_timeout and idle_for > self.idle_timeout:
+            with self._cond:
+                self._stats['recycled'] += 1
+            return False
+        if idle_for > self.healthcheck:
+            try:
+                with conn.cursor() as c:
+                    c.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                with self._cond:
+                    self._stats['healthcheck_failures'] += 1
+                return False
+        return True
+
+    def _reset_after_fork(self):
+        # Un worker forké ne doit jamais réutiliser les sockets du parent
+        if os.getpid() != self._pid:
+            with self._cond:
+                self._pid = os.getpid()
+                self._idle = []
+                self._in_use = weakref.WeakSet()
+                self._opening = 0
+
+    def getconn(self):
+        self._reset_after_fork()
+        deadline = _time.monotonic() + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._idle:
+                        conn = self._idle.pop()
+                        self._in_use.add(conn)
+                        break
+                    if len(self._in_use) + self._opening < self.maxconn:
+                        self._opening += 1
+                        break
+                    remaining = deadline - _time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise psycopg2.pool.PoolError(
+                            f"Pool de connexions épuisé ({self.maxconn} connexions utilisées)")
+                    self._stats['waits'] += 1
+                    self._cond.wait(min(remaining, 1.0))
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                finally:
+                    with self._cond:
+                        self._opening -= 1
+                        if conn is not None:
+                            self._in_use.add(conn)
+                        else:
+                            self._cond.notify()
+                break
+
+            if self._usable(conn):
+                break
+            with self._cond:
+                self._in_use.discard(conn)
+            self._close(conn)
+
+        conn._pool_returned = False
+        with self._cond:
+            self._stats['checkouts'] += 1
+        return conn
+
+    def putconn(self, conn):
+        if conn._pool_returned:
+            return  # double close() toléré
+        conn._pool_returned = True
+        conn._pool_uses += 1
+        conn._pool_last_used = _time.monotonic()
+
+        keep = not conn.closed and os.getpid() == self._pid
+        if keep:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                keep = False
+        if keep and self.max_uses and conn._pool_uses >= self.max_uses:
+            keep = False
+            with self._cond:
+                self._stats['recycled'] += 1
+
+        expired = []
+        with self._cond:
+            self._in_use.discard(conn)
+            self._stats['returns'] += 1
+            if keep:
+                self._idle.append(conn)
+            # Fermer les connexions inactives au-delà du minimum
+            if self.idle_timeout:
+                now = _time.monotonic()
+                while (len(self._idle) > self.minconn and
+                       now - self._idle[0]._pool_last_used > self.idle_timeout):
+                    expired.append(self._idle.pop(0))
+                    self._stats['recycled'] += 1
+            self._cond.notify()
+        if not keep:
+            self._close(conn)
+        for old in expired:
+            self._close(old)
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats,
+                        minconn=self.minconn,
+                        maxconn=self.maxconn,
+                        idle=len(self._idle),
+                        in_use=len(self._in_use))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+                                       DB_POOL_MAX_USES, DB_POOL_IDLE_TIMEOUT, DB_POOL_HEALTHCHECK)
+    return _pool
+
+def get_db():
+    """Connexion liée à la requête courante : empruntée au pool au premier appel,
+    réutilisée pour toutes les requêtes SQL de la requête HTTP, puis rendue par release_db()."""
+    conn = g.get('_db_conn')
+    if conn is None or conn.closed or conn._pool_returned:
+        conn = get_pool().getconn()
+        conn._request_scoped = True
+        g._db_conn = conn
+    return conn
+
+def get_conn():
+    """Connexion de la requête HTTP courante, ou emprunt direct au pool hors requête
+    (threads de fond) ; dans ce cas conn.close() la rend au pool."""
+    if has_request_context():
+        return get_db()
+    return get_pool().getconn()
+
+@app.teardown_request
+def release_db(exc):
+    """Rend la connexion de la requête au pool : rollback si exception ou transaction non validée."""
+    conn = g.pop('_db_conn', None)
+    if conn is None:
+        return
+    conn._request_scoped = False
+    if exc is not None and not conn.closed:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+    conn.close()
+
+# ── Requêtes préparées du chemin transactionnel ─────────────────────────────
+# Les requêtes les plus fréquentes des ventes sont préparées (PREPARE) une fois
+# par connexion du pool puis exécutées par leur nom : PostgreSQL n'a plus à les
+# analyser et planifier à chaque appel. Les lignes de vente passent en tableaux
+# (unnest) pour qu'une seule requête préparée serve quel que soit le panier.
+DB_PREPARED_STATEMENTS = os.environ.get('DB_PREPARED_STATEMENTS', '1') != '0'
+
+PREPARED_STATEMENTS = {
+    'utilisateur_password': """
+        SELECT Password2 FROM utilisateur WHERE numero_util = $1
+    """,
+    'comande_insert': """
+        INSERT INTO comande (numero_table, date_comande, etat_c, nature, connection1, compteur, user_id, numero_util)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+        RETURNING numero_comande
+    """,
+    'attache_insert': """
+        INSERT INTO attache (user_id, numero_comande, numero_item, quantite, prixt, remarque, prixbh, achatfx)
+        SELECT user_id, numero_comande::integer, numero_item::integer, quantite::double precision,
+               prixt, remarque, prixbh, achatfx
+        FROM unnest($1::text[], $2::text[], $3::text[], $4::text[], $5::text[], $6::text[], $7::text[], $8::text[])
+            AS l (user_id, numero_comande, numero_item, quantite, prixt, remarque, prixbh, achatfx)
+    """,
+    'item_stock_decrement': """
+        UPDATE item SET qte = item.qte - v.quantite
+        FROM (SELECT numero_item::integer AS numero_item, SUM(quantite::double precision) AS quantite
+              FROM unnest($1::text[], $2::text[]) AS l (numero_item, quantite)
+              GROUP BY 1) AS v
+        WHERE item.numero_item = v.numero_item
+    """,
+}
+
+# Même requête sans préparation (DB_PREPARED_STATEMENTS=0) : chaque $n apparaît une fois, dans l'ordre
+_UNPREPARED_STATEMENTS = {name: re.sub(r'\$\d+', '%s', sql) for name, sql in PREPARED_STATEMENTS.items()}
+
+def execute_prepared(cur, name, params):
+    """Exécute la requête `name` de PREPARED_STATEMENTS, préparée au premier usage sur la connexion.
+
+    Une requête préparée survit au rollback : le registre de la connexion
+    (conn._prepared) reste valable jusqu'à sa fermeture par le pool.
+    """
+    prepared = getattr(cur.connection, '_prepared', None)
+    if not DB_PREPARED_STATEMENTS or prepared is None:
+        cur.execute(_UNPREPARED_STATEMENTS[name], params)
+        return
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+        prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+def text_array(values):
+    """Valeurs Python -> text[] pour unnest, converties comme psycopg2 les écrirait"""
+    return [None if v is None else ('true' if v else 'false') if isinstance(v, bool) else str(v)
+            for v in values]
 
 # Vérification de l'utilisateur (X-User-ID)
 def validate_user_id():
@@ -32,9 +350,126 @@ def validate_user_id():
         return jsonify({'erreur': 'Identifiant utilisateur requis'}), 401
     return user_id
 
-# Configurez le logger
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+# ── Clés d'idempotence (Idempotency-Key) ────────────────────────────────────
+# Une écriture rejouée avec la même clé renvoie la réponse enregistrée au lieu
+# de refaire la transaction. La clé est insérée dans la transaction même de
+# l'écriture (remember_response) : elle n'existe que si l'écriture est validée,
+# et deux envois simultanés de la même clé se départagent sur la clé primaire.
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+IDEMPOTENCY_PURGE_INTERVAL = 3600  # secondes entre deux purges des clés expirées
+
+IDEMPOTENCY_DDL = """
+    CREATE TABLE IF NOT EXISTS idempotency_key (
+        user_id varchar NOT NULL,
+        cle varchar(255) NOT NULL,
+        empreinte bytea NOT NULL,
+        statut smallint NOT NULL,
+        reponse text NOT NULL,
+        cree_le timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (user_id, cle)
+    );
+    CREATE INDEX IF NOT EXISTS idx_idempotency_key_cree_le ON idempotency_key (cree_le);
+"""
+
+_idempotency = {'purged_at': 0.0}
+_idempotency_lock = threading.Lock()
+
+def purge_idempotency_keys():
+    """Supprime les clés expirées sur une connexion du pool (thread de fond)"""
+    conn = get_pool().getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM idempotency_key WHERE cree_le < now() - make_interval(hours => %s)",
+                        (IDEMPOTENCY_TTL_HOURS,))
+            purged = cur.rowcount
+        conn.commit()
+        logger.info(f"Idempotency-Key : {purged} clés expirées purgées")
+    except psycopg2.Error as e:
+        logger.warning(f"Purge des clés d'idempotence impossible: {e}")
+    finally:
+        conn.close()
+
+def schedule_idempotency_purge():
+    """Lance la purge au plus une fois par heure et par processus, sans faire attendre la requête"""
+    with _idempotency_lock:
+        if _time.time() - _idempotency['purged_at'] <= IDEMPOTENCY_PURGE_INTERVAL:
+            return
+        _idempotency['purged_at'] = _time.time()
+    threading.Thread(target=purge_idempotency_keys, name='idempotency-purge', daemon=True).start()
+
+def stored_response(cur, user_id, cle, empreinte):
+    """Réponse enregistrée pour (user_id, cle), None si la clé est inconnue ou expirée"""
+    cur.execute("""
+        SELECT empreinte, statut, reponse FROM idempotency_key
+        WHERE user_id = %s AND cle = %s AND cree_le >= now() - make_interval(hours => %s)
+    """, (user_id, cle, IDEMPOTENCY_TTL_HOURS))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    if bytes(row['empreinte']) != empreinte:
+        return jsonify({"error": "Idempotency-Key déjà utilisée pour une autre requête"}), 422
+    response = jsonify(json.loads(row['reponse']))
+    response.status_code = row['statut']
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def remember_response(cur, body, status):
+    """Enregistre la réponse sous l'Idempotency-Key de la requête, dans la transaction de l'écriture.
+
+    À appeler juste avant conn.commit(). Sans clé, ou si la clé est enregistrée,
+    renvoie None. Si une requête concurrente a validé la même clé entre-temps
+    (ON CONFLICT DO NOTHING attend sa fin), renvoie sa réponse enregistrée :
+    l'appelant annule alors sa propre transaction et renvoie cette réponse.
+    """
+    key = g.get('idempotency_key')
+    if key is None:
+        return None
+    user_id, cle, empreinte = key
+    cur.execute("""
+        DELETE FROM idempotency_key
+        WHERE user_id = %s AND cle = %s AND cree_le < now() - make_interval(hours => %s)
+    """, (user_id, cle, IDEMPOTENCY_TTL_HOURS))
+    cur.execute("""
+        INSERT INTO idempotency_key (user_id, cle, empreinte, statut, reponse)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (user_id, cle) DO NOTHING
+    """, (user_id, cle, psycopg2.Binary(empreinte), status, app.json.dumps(body)))
+    if cur.rowcount == 1:
+        return None
+    with cur.connection.cursor(cursor_factory=RealDictCursor) as dict_cur:
+        replay = stored_response(dict_cur, user_id, cle, empreinte)
+    if replay is None:
+        raise RuntimeError(f"Idempotency-Key {cle} en conflit mais introuvable")
+    logger.info(f"Idempotency-Key {cle}: requête concurrente validée, sa réponse est renvoyée")
+    return replay
+
+def idempotent(view):
+    """Décorateur des routes d'écriture acceptant l'en-tête Idempotency-Key"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cle = request.headers.get('Idempotency-Key')
+        if not cle:
+            return view(*args, **kwargs)
+        user_id = validate_user_id()
+        if not isinstance(user_id, str):
+            return user_id
+        if len(cle) > 255:
+            return jsonify({"error": "Idempotency-Key trop longue (255 caractères max)"}), 400
+        # Même clé, même route et même corps : sinon la clé est réutilisée à tort
+        empreinte = hashlib.sha256(request.path.encode() + b'\n' + request.get_data()).digest()
+
+        schedule_idempotency_purge()
+        conn = get_conn()
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            replay = stored_response(cur, user_id, cle, empreinte)
+        conn.rollback()
+        if replay is not None:
+            logger.info(f"Idempotency-Key {cle}: réponse enregistrée renvoyée")
+            return replay
+
+        g.idempotency_key = (user_id, cle, empreinte)
+        return view(*args, **kwargs)
+    return wrapper
 
 # Route pour vérifier que l'API est en ligne
 @app.route('/', methods=['GET'])
@@ -46,69 +481,198 @@ def index():
     except Exception as e:
         return f'Erreur connexion DB : {e}', 500
 
+# Statistiques du pool de connexions
+@app.route('/pool_stats', methods=['GET'])
+def pool_stats():
+    return jsonify(get_pool().stats()), 200
 
 
 
-@contextmanager
-def temp_sqlite_db():
-    """Context manager for temporary SQLite database"""
-    tmpfile = tempfile.NamedTemporaryFile(delete=False, suffix=".sqlite")
-    sqlite_path = tmpfile.name
-    tmpfile.close()
-    
-    try:
-        conn = sqlite3.connect(sqlite_path)
-        yield conn, sqlite_path
-    finally:
-        conn.close()
-        if os.path.exists(sqlite_path):
-            os.unlink(sqlite_path)
+# SQLite export engine: size past which an export leaves RAM for a temp file
+EXPORT_MEMORY_LIMIT = int(os.environ.get('EXPORT_MEMORY_LIMIT_MB', 64)) * 1024 * 1024
 
-def get_table_structure_info(pg_cur, table_name, user_id):
-    """Get detailed structure info including identity columns with user_id filtering"""
-    # Get basic column info
-    pg_cur.execute("""
-        SELECT 
-            column_name, 
-            data_type, 
-            column_default, 
-            is_nullable,
-            character_maximum_length, 
-            numeric_precision, 
-            numeric_scale,
-            is_identity,
-            identity_generation
-        FROM information_schema.columns 
-        WHERE table_schema = 'public' AND table_name = %s
-        ORDER BY ordinal_position
-    """, (table_name,))
-    
-    columns = pg_cur.fetchall()
-    
-    # Get primary key info
-    pg_cur.execute("""
-        SELECT column_name
-        FROM information_schema.table_constraints tc
-        JOIN information_schema.key_column_usage kcu 
-            ON tc.constraint_name = kcu.constraint_name
-            AND tc.table_schema = kcu.table_schema
-        WHERE tc.table_schema = 'public' 
-        AND tc.table_name = %s
-        AND tc.constraint_type = 'PRIMARY KEY'
-        ORDER BY kcu.ordinal_position
-    """, (table_name,))
-    
-    primary_keys = [row['column_name'] for row in pg_cur.fetchall()]
+# Bulk-load settings: the file is rebuilt from scratch on every export,
+# so journaling and fsync buy nothing
+SQLITE_BULK_PRAGMAS = (
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA locking_mode = EXCLUSIVE",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536",
+)
+
+class SqliteExportBuilder:
+    """SQLite database for one export.
+
+    Built in :memory: and returned with Connection.serialize(). Once it grows
+    past memory_limit it is copied to a temp file with the backup API and the
+    rest of the export continues on disk, with the same pragmas.
+    """
+
+    def __init__(self, memory_limit=EXPORT_MEMORY_LIMIT):
+        self.memory_limit = memory_limit
+        self.path = None
+        self.conn = self._open(':memory:')
+
+    @staticmethod
+    def _open(target):
+        conn = sqlite3.connect(target)
+        for pragma in SQLITE_BULK_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @property
+    def in_memory(self):
+        return self.path is None
+
+    def size(self):
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def checkpoint(self, sqlite_cur):
+        """Called between batches; returns the cursor to keep inserting with"""
+        if self.in_memory and self.size() > self.memory_limit:
+            self.spill_to_disk()
+            return self.conn.cursor()
+        return sqlite_cur
+
+    def spill_to_disk(self):
+        tmpfile = tempfile.NamedTemporaryFile(delete=False, suffix=".sqlite")
+        tmpfile.close()
+        disk_conn = self._open(tmpfile.name)
+        self.conn.commit()
+        self.conn.backup(disk_conn)
+        self.conn.close()
+        self.conn = disk_conn
+        self.path = tmpfile.name
+        logging.info(f"Export SQLite déplacé sur disque ({self.size()} octets): {self.path}")
+
+    def finish(self):
+        """Return (bytes, None) for an in-memory build or (None, path) for a file.
+
+        The caller owns the returned file and must delete it.
+        """
+        self.conn.commit()
+        if self.in_memory and hasattr(self.conn, 'serialize'):
+            return self.conn.serialize(), None
+        if self.in_memory:
+            self.spill_to_disk()  # Python < 3.11: no serialize()
+        self.conn.close()
+        path, self.path = self.path, None
+        return None, path
+
+    def close(self):
+        self.conn.close()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+# Tables exported to SQLite (user_id filtered)
+EXPORT_TABLES = [
+    'categorie', 'salle', 'tables', 'utilisateur', 'fournisseur', 'comande',
+    'item', 'attache', 'mouvement', 'attache2', 'attachetmp', 'client',
+    'cloture', 'codebar', 'encaisse', 'item_composition', 'mouvementc',
+    'observation', 'tmp', 'tva'
+]
+
+# Column/PK/identity metadata for a set of tables in one pg_catalog round trip.
+# Output matches information_schema.columns so map_postgres_to_sqlite_type_v2 is unchanged.
+CATALOG_COLUMNS_SQL = """
+    SELECT
+        c.relname AS table_name,
+        a.attname AS column_name,
+        CASE WHEN t.typcategory = 'A' THEN 'ARRAY'
+             WHEN t.typtype = 'e' THEN 'USER-DEFINED'
+             ELSE format_type(COALESCE(NULLIF(t.typbasetype, 0), a.atttypid), NULL)
+        END AS data_type,
+        CASE WHEN a.attgenerated = '' THEN pg_get_expr(d.adbin, d.adrelid) END AS column_default,
+        CASE WHEN a.attnotnull THEN 'NO' ELSE 'YES' END AS is_nullable,
+        CASE WHEN a.atttypid IN ('bpchar'::regtype, 'varchar'::regtype) AND a.atttypmod > 0
+             THEN a.atttypmod - 4 END AS character_maximum_length,
+        CASE WHEN a.attidentity IN ('a', 'd') THEN 'YES' ELSE 'NO' END AS is_identity,
+        CASE a.attidentity WHEN 'a' THEN 'ALWAYS' WHEN 'd' THEN 'BY DEFAULT' END AS identity_generation,
+        array_position(i.indkey::int2[], a.attnum) AS pk_position
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    JOIN pg_type t ON t.oid = a.atttypid
+    LEFT JOIN pg_attrdef d ON d.adrelid = c.oid AND d.adnum = a.attnum
+    LEFT JOIN pg_index i ON i.indrelid = c.oid AND i.indisprimary
+    WHERE n.nspname = 'public' AND c.relname = ANY(%s)
+      AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+    ORDER BY c.relname, a.attnum
+"""
+
+# DDL version: any ALTER/CREATE/DROP on these tables rewrites one of the catalog rows,
+# which changes its xmin and therefore the fingerprint.
+CATALOG_VERSION_SQL = """
+    SELECT md5(string_agg(concat_ws(':', c.oid, c.xmin, a.attnum, a.xmin, d.xmin, i.xmin),
+                          ',' ORDER BY c.oid, a.attnum)) AS version
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0
+    LEFT JOIN pg_attrdef d ON d.adrelid = c.oid AND d.adnum = a.attnum
+    LEFT JOIN pg_index i ON i.indrelid = c.oid AND i.indisprimary
+    WHERE n.nspname = 'public' AND c.relname = ANY(%s)
+"""
+
+_export_schema_cache = {'key': None, 'version': None, 'plans': {}}
+_export_schema_lock = threading.Lock()
+
+def load_table_structures(pg_cur, tables):
+    """Get structure info for all tables in one catalog query.
+
+    Returns {table_name: (columns, primary_keys, identity_columns)}.
+    """
+    pg_cur.execute(CATALOG_COLUMNS_SQL, (list(tables),))
     
-    # Alternative check for sequences (older PostgreSQL versions)
-    identity_columns = []
-    for col in columns:
+    structures = {}
+    pk_positions = {}
+    for col in pg_cur.fetchall():
+        table_name = col['table_name']
+        columns, _, identity_columns = structures.setdefault(table_name, ([], [], []))
+        columns.append(col)
+        if col['pk_position'] is not None:
+            pk_positions.setdefault(table_name, []).append((col['pk_position'], col['column_name']))
+        # Alternative check for sequences (older PostgreSQL versions)
         if (col['is_identity'] == 'YES' or 
             ('nextval(' in str(col['column_default']).lower() and 
              '_seq' in str(col['column_default']).lower())):
             identity_columns.append(col['column_name'])
     
-    return columns, primary_keys, identity_columns
+    for table_name, positions in pk_positions.items():
+        structures[table_name][1].extend(name for _, name in sorted(positions))
+
+    return structures
+
+def get_table_structure_info(pg_cur, table_name, user_id):
+    """Get detailed structure info including identity columns with user_id filtering"""
+    return load_table_structures(pg_cur, [table_name]).get(table_name, ([], [], []))
+
+def get_export_plans(pg_cur, tables=EXPORT_TABLES):
+    """SQLite DDL and column info for every exported table, cached in-process.
+
+    One cheap DDL version query per export; the catalog is re-read and the
+    DDL rebuilt only when the fingerprint changes.
+    """
+    key = tuple(tables)
+    pg_cur.execute(CATALOG_VERSION_SQL, (list(tables),))
+    version = pg_cur.fetchone()['version']
+
+    with _export_schema_lock:
+        if _export_schema_cache['key'] == key and _export_schema_cache['version'] == version:
+            return _export_schema_cache['plans']
+
+    structures = load_table_structures(pg_cur, tables)
+    plans = {}
+    for table_name in tables:
+        if table_name in structures:
+            plans[table_name] = build_table_plan(table_name, *structures[table_name])
+
+    with _export_schema_lock:
+        _export_schema_cache.update(key=key, version=version, plans=plans)
+    logging.info(f"Schéma d'export rechargé (version {version})")
+    return plans
 
 def map_postgres_to_sqlite_type_v2(pg_type, column_default, column_name, char_max_length, is_identity, is_pk):
     """Enhanced mapping with explicit identity detection"""
@@ -140,7 +704,7 @@ def map_postgres_to_sqlite_type_v2(pg_type, column_default, column_name, char_ma
             sqlite_type = "VARCHAR(30)"
     elif pg_type in ['text']:
         sqlite_type = "TEXT"
-    elif pg_type.startswith('char') or pg_type == 'character':
+    elif pg_type.startswith(('char', 'bpchar')) or pg_type == 'character':
         if char_max_length:
             sqlite_type = f"CHAR({char_max_length})"
         else:
@@ -171,14 +735,164 @@ def map_postgres_to_sqlite_type_v2(pg_type, column_default, column_name, char_ma
     
     return sqlite_type, default_clause
 
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+def build_export_db(pg_cur, target, user_id, tables_to_export=EXPORT_TABLES, progress=None):
+    """Copy every exported table into the SqliteExportBuilder.
+
+    Returns (exported_tables, table_contents, created_tables). With more than
+    one worker (EXPORT_WORKERS or ?workers=) tables are read in parallel.
+    progress(table, row_count) is called as each table completes.
+    """
+    workers = export_worker_count()
+    if workers > 1:
+        return build_export_db_parallel(pg_cur, target, user_id, tables_to_export, workers, progress)
+
+    # Enable foreign keys in SQLite
+    target.conn.execute("PRAGMA foreign_keys = ON")
+
+    # Structure of every table, from the in-process DDL cache
+    plans = get_export_plans(pg_cur, tables_to_export)
+
+    # Process each table
+    exported_tables = []
+    table_contents = {}
+
+    for table in tables_to_export:
+        try:
+            row_count = export_table_with_user_id(pg_cur, target.conn.cursor(), table, user_id,
+                                                  plans.get(table, {}), target=target)
+            exported_tables.append(table)
+            table_contents[table] = row_count
+            logging.info(f"Table {table} exportée avec {row_count} lignes")
+            if progress:
+                progress(table, row_count)
+        except Exception as table_error:
+            logging.error(f"Erreur lors de l'exportation de la table {table}: {str(table_error)}")
+            continue
+
+    target.conn.commit()
+
+    # Verify created tables in SQLite
+    rows = target.conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+    created_tables = [row[0].lower() for row in rows]
+    logging.info(f"Tables créées dans SQLite : {created_tables}")
+
+    return exported_tables, table_contents, created_tables
+
+def negotiate_export_encoding():
+    """Pick the compression for a binary export: ?compression= wins, else Accept-Encoding"""
+    requested = (request.args.get('compression') or '').lower()
+    if requested in ('none', 'identity'):
+        return None
+    if requested == 'zstd' and zstandard is None:
+        logging.warning("zstandard non installé, export compressé en gzip")
+        return 'gzip'
+    if requested in ('gzip', 'zstd'):
+        return requested
+    if zstandard is not None and request.accept_encodings['zstd']:
+        return 'zstd'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compress_file(src_path, encoding):
+    """Compress a file chunk by chunk into a new temporary file and return its path"""
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=f".sqlite.{encoding}")
+    try:
+        with open(src_path, "rb") as src, tmp:
+            if encoding == 'zstd':
+                zstandard.ZstdCompressor(level=3).copy_stream(src, tmp, read_size=EXPORT_CHUNK_SIZE)
+            else:
+                with gzip.GzipFile(fileobj=tmp, mode="wb", compresslevel=6) as gz:
+                    shutil.copyfileobj(src, gz, EXPORT_CHUNK_SIZE)
+    except Exception:
+        os.unlink(tmp.name)
+        raise
+    return tmp.name
+
+def compress_bytes(data, encoding):
+    """Compress an in-memory export"""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+def stream_export_response(filename, path=None, data=None, encoding=None, headers=None, cleanup_paths=()):
+    """Stream a file (path) or an in-memory export (data) in chunks with a Content-Length.
+
+    cleanup_paths are removed once the response is sent. The file is opened
+    before returning: if another request replaces (unlinks) it meanwhile, the
+    response keeps reading the open file and matches its Content-Length.
+    """
+    f = None
+    if data is not None:
+        size = len(data)
+    else:
+        f = open(path, "rb")
+        size = os.fstat(f.fileno()).st_size
+
+    def cleanup():
+        if f is not None:
+            f.close()
+        for p in cleanup_paths:
+            if os.path.exists(p):
+                os.unlink(p)
+
+    def generate():
+        try:
+            if data is not None:
+                view = memoryview(data)
+                for offset in range(0, size, EXPORT_CHUNK_SIZE):
+                    yield bytes(view[offset:offset + EXPORT_CHUNK_SIZE])
+                return
+            while True:
+                chunk = f.read(EXPORT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            cleanup()
+
+    response = Response(generate(), mimetype='application/octet-stream', direct_passthrough=True)
+    response.headers['Content-Length'] = str(size)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+    for key, value in (headers or {}).items():
+        response.headers[key] = value
+    response.call_on_close(cleanup)
+    return response
+
+def wants_binary_export():
+    """Binary mode: ?format=sqlite or an Accept header preferring application/octet-stream"""
+    if request.args.get('format') == 'sqlite':
+        return True
+    return request.accept_mimetypes.best_match(
+        ['application/json', 'application/octet-stream']) == 'application/octet-stream'
+
 @app.route('/export', methods=['GET'])
 def export_db():
-    """Export PostgreSQL database to SQLite and return as base64 with user_id filtering"""
+    """Export PostgreSQL database to SQLite with user_id filtering.
+
+    Returns base64 in JSON by default, or streams the SQLite file as
+    application/octet-stream (optionally gzip/zstd compressed) in binary mode.
+    Every export carries a watermark; /export?since=<watermark> returns only
+    the rows changed since then (delta), or a full export when the watermark
+    is too old.
+    """
     user_id = request.headers.get('X-User-ID')
     if not user_id:
         logging.error("Aucun en-tête X-User-ID fourni")
         return jsonify({'error': 'Missing X-User-ID header'}), 401
 
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({'error': 'Invalid since watermark'}), 400
+
     pg_conn = None
     
     try:
@@ -186,68 +900,78 @@ def export_db():
         pg_conn = get_conn()
         pg_cur = pg_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         
-        with temp_sqlite_db() as (sqlite_conn, sqlite_path):
-            sqlite_cur = sqlite_conn.cursor()
-            
-            # Enable foreign keys in SQLite
-            sqlite_cur.execute("PRAGMA foreign_keys = ON")
-            
-            # Define all tables that should be exported with user_id filtering
-            tables_to_export = [
-                'categorie', 'salle', 'tables', 'utilisateur', 'fournisseur', 'comande',
-                'item', 'attache', 'mouvement', 'attache2', 'attachetmp', 'client',
-                'cloture', 'codebar', 'encaisse', 'item_composition', 'mouvementc',
-                'observation', 'tmp', 'tva'
-            ]
-            
-            # Process each table
-            exported_tables = []
-            table_contents = {}
-            
-            for table in tables_to_export:
-                try:
-                    row_count = export_table_with_user_id(pg_cur, sqlite_cur, table, user_id)
-                    exported_tables.append(table)
-                    table_contents[table] = row_count
-                    logging.info(f"Table {table} exportée avec {row_count} lignes")
-                except Exception as table_error:
-                    logging.error(f"Erreur lors de l'exportation de la table {table}: {str(table_error)}")
-                    continue
-            
-            sqlite_conn.commit()
-            
-            # Verify created tables in SQLite
-            sqlite_cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            created_tables = [row[0].lower() for row in sqlite_cur.fetchall()]
-            logging.info(f"Tables créées dans SQLite : {created_tables}")
-            
-            # Read and encode the SQLite file
-            with open(sqlite_path, "rb") as f:
-                file_size = os.path.getsize(sqlite_path)
-                
-                # Check file size (limit to ~50MB base64 encoded)
-                max_size = 37 * 1024 * 1024  # ~37MB raw = ~50MB base64
-                if file_size > max_size:
-                    return jsonify({
-                        'error': f'Database too large for export: {file_size} bytes'
-                    }), 413
-                
-                b64_db = base64.b64encode(f.read()).decode("utf-8")
-            
-            return jsonify({
-                "db": b64_db,
-                "tables_exported": exported_tables,
-                "total_tables": len(exported_tables),
-                "expected_tables": tables_to_export,
-                "created_tables": created_tables,
-                "table_contents": table_contents,
-                "size_bytes": file_size,
-                "user_id": user_id
-            })
+        # Export complet déjà construit pour cette version des données : seule la version est lue
+        etag = None
+        if since is None and change_tracking_ready():
+            etag = export_etag(user_id, export_data_state(pg_cur, user_id))
+            cached = cached_export_response(user_id, etag)
+            if cached is not None:
+                return cached
+
+        watermark = prepare_change_tracking(pg_cur)
+        sync_info = {'watermark': watermark, 'delta': False}
+        if since is not None and watermark is not None and delta_available(pg_cur, since, user_id):
+            sync_info.update(delta=True, since=since)
+            build = lambda target: build_delta_export_db(pg_cur, target, user_id, since, sync_info)
+        elif watermark is not None:
+            if etag is None:
+                etag = export_etag(user_id, export_data_state(pg_cur, user_id))
+                cached = cached_export_response(user_id, etag)
+                if cached is not None:
+                    return cached
+            return build_cached_export(pg_cur, user_id, etag, sync_info)
+        else:
+            build = lambda target: build_export_db(pg_cur, target, user_id)
+
+        if wants_binary_export():
+            return export_db_binary(user_id, build, sync_info)
+
+        tables_to_export = EXPORT_TABLES
+        builder = SqliteExportBuilder()
+        try:
+            exported_tables, table_contents, created_tables = build(builder)
+            db_bytes, sqlite_path = builder.finish()
+        finally:
+            builder.close()
+
+        try:
+            # Check file size (limit to ~50MB base64 encoded), built in RAM or on disk
+            file_size = len(db_bytes) if db_bytes is not None else os.path.getsize(sqlite_path)
+            max_size = 37 * 1024 * 1024  # ~37MB raw = ~50MB base64
+            if file_size > max_size:
+                return jsonify({
+                    'error': f'Database too large for export: {file_size} bytes'
+                }), 413
+
+            if db_bytes is None:
+                # Read the SQLite file built on disk
+                with open(sqlite_path, "rb") as f:
+                    db_bytes = f.read()
+        finally:
+            if sqlite_path:
+                os.unlink(sqlite_path)
+
+        b64_db = base64.b64encode(db_bytes).decode("utf-8")
+
+        return jsonify({
+            "db": b64_db,
+            "tables_exported": exported_tables,
+            "total_tables": len(exported_tables),
+            "expected_tables": tables_to_export,
+            "created_tables": created_tables,
+            "table_contents": table_contents,
+            "size_bytes": file_size,
+            "user_id": user_id,
+            **sync_info
+        })
             
     except psycopg2.Error as db_error:
         logging.error(f"Database error during export: {str(db_error)}")
         return jsonify({'error': 'Database connection error'}), 500
+
+    except ExportIncomplete as e:
+        logging.error(f"Incomplete export: {str(e)}")
+        return jsonify({'error': 'Export incomplete, retry later'}), 503, {'Retry-After': '5'}
         
     except Exception as e:
         logging.error(f"Unexpected error during export: {str(e)}")
@@ -257,18 +981,94 @@ def export_db():
         if pg_conn:
             pg_conn.close()
 
-def export_table_with_user_id(pg_cur, sqlite_cur, table_name, user_id):
-    """Export a single table from PostgreSQL to SQLite with user_id filtering"""
-    
-    # Get table structure
-    columns, primary_keys, identity_columns = get_table_structure_info(pg_cur, table_name, user_id)
-    
-    if not columns:
-        logging.warning(f"No columns found for table {table_name}")
-        return 0
-    
-    logging.info(f"Table {table_name}: PK={primary_keys}, Identity={identity_columns}")
+def export_db_binary(user_id, build, sync_info):
+    """Build the SQLite export (RAM, or disk past EXPORT_MEMORY_LIMIT) and stream it"""
+    builder = SqliteExportBuilder()
+    try:
+        exported_tables, table_contents, created_tables = build(builder)
+        db_bytes, sqlite_path = builder.finish()
+    finally:
+        builder.close()
     
+    cleanup_paths = [sqlite_path] if sqlite_path else []
+    try:
+        raw_size = len(db_bytes) if db_bytes is not None else os.path.getsize(sqlite_path)
+        encoding = negotiate_export_encoding()
+        send_path = sqlite_path
+        if encoding and db_bytes is not None:
+            db_bytes = compress_bytes(db_bytes, encoding)
+        elif encoding:
+            send_path = compress_file(sqlite_path, encoding)
+            cleanup_paths.append(send_path)
+
+        logging.info(f"Export binaire: {raw_size} octets, encodage={encoding or 'identity'}, "
+                     f"{'mémoire' if db_bytes is not None else 'disque'}")
+        return stream_export_response(
+            f"export_{user_id}.sqlite",
+            path=send_path,
+            data=db_bytes,
+            encoding=encoding,
+            headers=dict(export_headers({'tables_exported': exported_tables,
+                                         'table_contents': table_contents,
+                                         'sync': sync_info}),
+                         **{'X-Uncompressed-Size': str(raw_size)}),
+            cleanup_paths=cleanup_paths,
+        )
+    except Exception:
+        for p in cleanup_paths:
+            if os.path.exists(p):
+                os.unlink(p)
+        raise
+
+def iter_table_batches(pg_cur, table_name, column_info, primary_keys, user_id, batch_size):
+    """Yield batches of rows with keyset pagination on the primary key.
+
+    Each batch is an index range scan starting after the last key seen, so the
+    cost stays linear in table size (LIMIT/OFFSET re-scanned every skipped row).
+    Tables without a single-column primary key are read through a server-side
+    named cursor instead.
+    """
+    has_user_id = any(col['name'] == 'user_id' for col in column_info)
+    select_columns = ", ".join(f'"{col["name"]}"' for col in column_info)
+    conditions = ['user_id = %s'] if has_user_id else []
+    base_params = (user_id,) if has_user_id else ()
+
+    if len(primary_keys) != 1:
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        query = f'SELECT {select_columns} FROM "{table_name}"{where}'
+        with pg_cur.connection.cursor(name=f'export_{table_name}',
+                                      cursor_factory=RealDictCursor) as named_cur:
+            named_cur.itersize = batch_size
+            named_cur.execute(query, base_params)
+            while True:
+                rows = named_cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        return
+
+    pk = primary_keys[0]
+    last_key = None
+    while True:
+        if last_key is None:
+            where_parts, params = conditions, base_params
+        else:
+            where_parts, params = conditions + [f'"{pk}" > %s'], base_params + (last_key,)
+        where = f' WHERE {" AND ".join(where_parts)}' if where_parts else ''
+        pg_cur.execute(
+            f'SELECT {select_columns} FROM "{table_name}"{where} ORDER BY "{pk}" LIMIT %s',
+            params + (batch_size,)
+        )
+        rows = pg_cur.fetchall()
+        if not rows:
+            break
+        yield rows
+        if len(rows) < batch_size:
+            break
+        last_key = rows[-1][pk]
+
+def build_table_plan(table_name, columns, primary_keys, identity_columns):
+    """Build the SQLite CREATE TABLE statement and column info for one table"""
     # Build CREATE TABLE statement
     col_defs = []
     column_info = []
@@ -318,85 +1118,1253 @@ def export_table_with_user_id(pg_cur, sqlite_cur, table_name, user_id):
     
     create_sql = f'CREATE TABLE {table_name_quoted} ({", ".join(col_defs)})'
     
+    return {
+        'primary_keys': primary_keys,
+        'identity_columns': identity_columns,
+        'column_info': column_info,
+        'create_sql': create_sql,
+        'table_name_upper': table_name_upper,
+        'table_name_quoted': table_name_quoted,
+    }
+
+# Extraction path for /export: 'copy' (COPY ... TO STDOUT) or 'cursor' (keyset SELECT batches)
+EXPORT_EXTRACTION = os.environ.get('EXPORT_EXTRACTION', 'copy')
+EXPORT_COPY_BATCH = int(os.environ.get('EXPORT_COPY_BATCH', 10000))
+
+_COPY_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v', '\\': '\\'}
+_COPY_ESCAPE_RE = re.compile(r'\\(.)')
+
+def _copy_unescape(value):
+    """Decode one field of COPY text format (\\N is NULL)"""
+    if value == '\\N':
+        return None
+    return _COPY_ESCAPE_RE.sub(lambda m: _COPY_ESCAPES.get(m.group(1), m.group(1)), value)
+
+def column_converters(column_info, true_value=True, false_value=False):
+    """(index, converter) pairs for the columns whose values need more than passthrough.
+
+    Resolved once per table: booleans become 1/0 and NULLs in columns with a
+    true/false default take that default. true_value/false_value are the
+    boolean tokens of the source ('t'/'f' in COPY text, True/False from psycopg2).
+    """
+    converters = []
+    for idx, col_info in enumerate(column_info):
+        null_value = None
+        if col_info['default'] and not col_info['is_identity']:
+            default_str = str(col_info['default']).lower()
+            if 'true' in default_str:
+                null_value = 1
+            elif 'false' in default_str:
+                null_value = 0
+        if col_info['type'] == 'boolean':
+            converters.append((idx, {true_value: 1, false_value: 0, None: null_value}.get))
+        elif null_value is not None:
+            converters.append((idx, lambda v, nv=null_value: nv if v is None else v))
+    return tuple(converters)
+
+def copy_column_converters(column_info):
+    """Converters for COPY text fields"""
+    return column_converters(column_info, 't', 'f')
+
+def row_values_getter(column_info):
+    """Callable turning a RealDictCursor row into a list of values in column order"""
+    getter = operator.itemgetter(*[col['name'] for col in column_info])
+    if len(column_info) == 1:
+        return lambda row: [getter(row)]
+    return lambda row: list(getter(row))
+
+class CopyRowSink(io.TextIOBase):
+    """File-like target for copy_expert.
+
+    Parses COPY text rows as psycopg2 writes them and inserts them into SQLite
+    with executemany in batches; no row dicts and no per-column branching
+    unless a row contains escapes or the column needs a converter.
+    """
+
+    def __init__(self, sqlite_cur, insert_sql, converters, batch_size, target=None):
+        self.sqlite_cur = sqlite_cur
+        self.insert_sql = insert_sql
+        self.converters = converters
+        self.batch_size = batch_size
+        self.target = target
+        self.total_rows = 0
+        self._rows = []
+        self._partial = ''
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._partial:
+            data = self._partial + data
+        lines = data.split('\n')
+        self._partial = lines.pop()
+        rows = self._rows
+        converters = self.converters
+        for line in lines:
+            if '\\' in line:
+                # NULL (\N) or escaped characters: decode only the fields concerned
+                row = [_copy_unescape(v) if '\\' in v else v for v in line.split('\t')]
+            elif converters:
+                row = line.split('\t')
+            else:
+                rows.append(tuple(line.split('\t')))
+                continue
+            for idx, convert in converters:
+                row[idx] = convert(row[idx])
+            rows.append(row)
+        if len(rows) >= self.batch_size:
+            self.insert_pending()
+        return len(data)
+
+    def insert_pending(self):
+        if not self._rows:
+            return
+        self.sqlite_cur.executemany(self.insert_sql, self._rows)
+        self.total_rows += len(self._rows)
+        self._rows = []
+        # Let the export engine move to disk if the database outgrew RAM
+        if self.target is not None:
+            self.sqlite_cur = self.target.checkpoint(self.sqlite_cur)
+        if self.total_rows % 100000 < self.batch_size:
+            logging.info(f"Exported {self.total_rows} rows via COPY")
+
+def table_copy_sql(pg_cur, table_name, plan, user_id):
+    """COPY (SELECT ... WHERE user_id = ...) TO STDOUT statement for one table"""
+    column_info = plan['column_info']
+    primary_keys = plan['primary_keys']
+    select_columns = ", ".join(f'"{col["name"]}"' for col in column_info)
+
+    query = f'SELECT {select_columns} FROM "{table_name}"'
+    params = ()
+    if any(col['name'] == 'user_id' for col in column_info):
+        query += ' WHERE user_id = %s'
+        params = (user_id,)
+    if len(primary_keys) == 1:
+        query += f' ORDER BY "{primary_keys[0]}"'
+    return f"COPY ({pg_cur.mogrify(query, params).decode()}) TO STDOUT"
+
+def copy_table_with_user_id(pg_cur, sqlite_cur, table_name, plan, user_id, target=None):
+    """Stream one table with COPY (SELECT ... WHERE user_id = ...) TO STDOUT into SQLite"""
+    column_info = plan['column_info']
+    copy_sql = table_copy_sql(pg_cur, table_name, plan, user_id)
+
+    placeholders = ",".join(["?"] * len(column_info))
+    sink = CopyRowSink(
+        sqlite_cur,
+        f'INSERT INTO {plan["table_name_quoted"]} VALUES ({placeholders})',
+        copy_column_converters(column_info),
+        EXPORT_COPY_BATCH,
+        target,
+    )
+    try:
+        pg_cur.copy_expert(copy_sql, sink)
+        sink.insert_pending()
+    except Exception as e:
+        logging.error(f"Error copying data from {table_name}: {str(e)}")
+        raise
+    return sink.total_rows
+
+def iter_export_rows(pg_cur, table_name, plan, user_id, batch_size=1000):
+    """Yield batches of SQLite-ready rows for one table (cursor extraction).
+
+    Values are converted with the per-table converter plan.
+    """
+    column_info = plan['column_info']
+    values_of = row_values_getter(column_info)
+    converters = column_converters(column_info)
+
+    for rows in iter_table_batches(pg_cur, table_name, column_info, plan['primary_keys'], user_id, batch_size):
+        if converters:
+            processed_rows = []
+            for row in rows:
+                values = values_of(row)
+                for idx, convert in converters:
+                    values[idx] = convert(values[idx])
+                processed_rows.append(values)
+        else:
+            processed_rows = [values_of(row) for row in rows]
+        yield processed_rows
+
+def export_table_with_user_id(pg_cur, sqlite_cur, table_name, user_id, plan=None, target=None):
+    """Export a single table from PostgreSQL to SQLite with user_id filtering"""
+
+    # Get table structure
+    if plan is None:
+        columns, primary_keys, identity_columns = get_table_structure_info(pg_cur, table_name, user_id)
+        plan = build_table_plan(table_name, columns, primary_keys, identity_columns) if columns else None
+
+    if not plan:
+        logging.warning(f"No columns found for table {table_name}")
+        return 0
+
+    primary_keys = plan['primary_keys']
+    column_info = plan['column_info']
+    table_name_upper = plan['table_name_upper']
+    table_name_quoted = plan['table_name_quoted']
+    logging.info(f"Table {table_name}: PK={primary_keys}, Identity={plan['identity_columns']}")
+
     try:
-        sqlite_cur.execute(create_sql)
+        sqlite_cur.execute(plan['create_sql'])
         logging.info(f"Created table: {table_name_upper}")
     except Exception as e:
         logging.error(f"Error creating table {table_name}: {str(e)}")
         raise
     
     # Copy data with user_id filtering
-    batch_size = 1000
-    offset = 0
+    if EXPORT_EXTRACTION == 'copy':
+        total_rows = copy_table_with_user_id(pg_cur, sqlite_cur, table_name, plan, user_id, target)
+        logging.info(f"Successfully exported {total_rows} rows from table {table_name_upper}")
+        return total_rows
+
+    placeholders = ",".join(["?"] * len(column_info))
+    insert_sql = f'INSERT INTO {table_name_quoted} VALUES ({placeholders})'
     total_rows = 0
     
-    # Check if table has user_id column
-    has_user_id = any(col['name'] == 'user_id' for col in column_info)
-    
-    # Build SELECT query with user_id filtering
-    column_names = [f'"{col["name"]}"' for col in column_info]
-    select_columns = ", ".join(column_names)
-    
-    if has_user_id:
-        query = f'SELECT {select_columns} FROM "{table_name}" WHERE user_id = %s LIMIT %s OFFSET %s'
-        base_params = (user_id,)
-    else:
-        query = f'SELECT {select_columns} FROM "{table_name}" LIMIT %s OFFSET %s'
-        base_params = ()
-    
-    while True:
-        params = base_params + (batch_size, offset)
-        pg_cur.execute(query, params)
-        rows = pg_cur.fetchall()
-        
-        if not rows:
-            break
-        
-        # Process rows
-        processed_rows = []
-        for row in rows:
-            processed_row = []
-            for col_info in column_info:
-                col_name = col_info['name']
-                value = row[col_name]
-                
-                # Handle None/NULL values with defaults
-                if value is None:
-                    if col_info['default'] and not col_info['is_identity']:
-                        default_str = str(col_info['default']).lower()
-                        if 'true' in default_str:
-                            value = 1
-                        elif 'false' in default_str:
-                            value = 0
-                
-                # Convert boolean values to integers
-                elif isinstance(value, bool):
-                    value = 1 if value else 0
-                
-                processed_row.append(value)
-            
-            processed_rows.append(tuple(processed_row))
-        
+    for processed_rows in iter_export_rows(pg_cur, table_name, plan, user_id):
         # Insert batch
-        placeholders = ",".join(["?"] * len(column_info))
         try:
-            sqlite_cur.executemany(
-                f'INSERT INTO {table_name_quoted} VALUES ({placeholders})',
-                processed_rows
-            )
+            sqlite_cur.executemany(insert_sql, processed_rows)
             total_rows += len(processed_rows)
         except Exception as e:
             logging.error(f"Error inserting data into {table_name}: {str(e)}")
             raise
         
-        offset += batch_size
+        # Let the export engine move to disk if the database outgrew RAM
+        if target is not None:
+            sqlite_cur = target.checkpoint(sqlite_cur)
         
-        if offset % 10000 == 0:
-            logging.info(f"Exported {offset} rows from {table_name_upper}")
+        if total_rows % 10000 == 0:
+            logging.info(f"Exported {total_rows} rows from {table_name_upper}")
     
     logging.info(f"Successfully exported {total_rows} rows from table {table_name_upper}")
     return total_rows    
 
+# Parallel export: worker threads read tables on their own pooled connections,
+# all inside one exported REPEATABLE READ snapshot; the request thread is the
+# only SQLite writer.
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 1))
+EXPORT_QUEUE_BATCHES = int(os.environ.get('EXPORT_QUEUE_BATCHES', 16))   # lots en attente max (mémoire bornée)
+
+class QueuedCopyRowSink(CopyRowSink):
+    """CopyRowSink handing parsed batches to a callback instead of SQLite"""
+
+    def __init__(self, emit, converters, batch_size):
+        super().__init__(None, None, converters, batch_size)
+        self.emit = emit
+
+    def insert_pending(self):
+        if not self._rows:
+            return
+        self.emit(self._rows)
+        self.total_rows += len(self._rows)
+        self._rows = []
+
+class ExportAborted(Exception):
+    """The SQLite writer gave up; reader threads stop at their next batch"""
+
+class ExportIncomplete(Exception):
+    """Some tables could not be read; the export must not be served as a complete one"""
+
+def require_complete_export(exported_tables, tables=EXPORT_TABLES):
+    """Raise ExportIncomplete unless every table made it into the export (skipped on error)"""
+    missing = [table for table in tables if table not in exported_tables]
+    if missing:
+        raise ExportIncomplete(f"Tables non exportées : {', '.join(missing)}")
+
+def export_worker_count():
+    """?workers= wins over EXPORT_WORKERS; never more than the pool can lend besides the request connection"""
+    workers = request.args.get('workers', type=int) if has_request_context() else None
+    if workers is None:
+        workers = EXPORT_WORKERS
+    return max(1, min(workers, get_pool().maxconn - 1))
+
+def order_tables_by_size(pg_cur, tables):
+    """Biggest tables first, so the longest read starts immediately"""
+    pg_cur.execute("""
+        SELECT c.relname AS table_name, pg_relation_size(c.oid) AS size
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'public' AND c.relname = ANY(%s)
+    """, (list(tables),))
+    sizes = {row['table_name']: row['size'] for row in pg_cur.fetchall()}
+    return sorted(tables, key=lambda t: sizes.get(t, 0), reverse=True)
+
+def read_export_tables(snapshot, tables, plans, user_id, out, abort):
+    """Reader thread: import the snapshot on a pooled connection and read tables from the shared work queue.
+
+    Sends ('rows', table, rows), then ('done', table, count) or ('error', table, exc) to out.
+    """
+    def send(message):
+        while True:
+            if abort.is_set():
+                raise ExportAborted()
+            try:
+                out.put(message, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def emit(table, rows):
+        send(('rows', table, rows))
+
+    conn = None
+    try:
+        conn = get_pool().getconn()
+        pg_cur = conn.cursor(cursor_factory=RealDictCursor)
+        pg_cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        pg_cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+    except Exception as e:
+        # Les tables restantes seront lues par les autres threads
+        logging.error(f"Lecteur d'export indisponible: {str(e)}")
+        if conn is not None:
+            conn.close()
+        return
+
+    try:
+        while not abort.is_set():
+            try:
+                table = tables.get_nowait()
+            except queue.Empty:
+                break
+            plan = plans[table]
+            try:
+                if EXPORT_EXTRACTION == 'copy':
+                    sink = QueuedCopyRowSink(lambda rows: emit(table, rows),
+                                             copy_column_converters(plan['column_info']),
+                                             EXPORT_COPY_BATCH)
+                    pg_cur.copy_expert(table_copy_sql(pg_cur, table, plan, user_id), sink)
+                    sink.insert_pending()
+                    count = sink.total_rows
+                else:
+                    count = 0
+                    for rows in iter_export_rows(pg_cur, table, plan, user_id):
+                        emit(table, rows)
+                        count += len(rows)
+                send(('done', table, count))
+            except ExportAborted:
+                break
+            except Exception as e:
+                # Transaction en erreur : la connexion ne peut plus lire dans ce snapshot
+                try:
+                    send(('error', table, e))
+                except ExportAborted:
+                    pass
+                break
+    finally:
+        conn.close()
+
+def build_export_db_parallel(pg_cur, target, user_id, tables_to_export, workers, progress=None):
+    """build_export_db with tables read concurrently under one snapshot.
+
+    The request connection opens a REPEATABLE READ transaction and exports its
+    snapshot (pg_export_snapshot); every reader thread imports it, so all tables
+    reflect the same instant. The request thread creates the tables and does all
+    SQLite inserts.
+    """
+    pg_conn = pg_cur.connection
+    pg_conn.rollback()
+    pg_cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+    pg_cur.execute("SELECT pg_export_snapshot() AS snapshot")
+    snapshot = pg_cur.fetchone()['snapshot']
+
+    target.conn.execute("PRAGMA foreign_keys = ON")
+    plans = get_export_plans(pg_cur, tables_to_export)
+
+    table_contents = {}
+    inserts = {}
+    sqlite_cur = target.conn.cursor()
+
+    # Tables created up front, in export order
+    for table in tables_to_export:
+        plan = plans.get(table)
+        if not plan:
+            logging.warning(f"No columns found for table {table}")
+            table_contents[table] = 0
+            if progress:
+                progress(table, 0)
+            continue
+        try:
+            sqlite_cur.execute(plan['create_sql'])
+        except Exception as e:
+            logging.error(f"Erreur lors de l'exportation de la table {table}: {str(e)}")
+            continue
+        placeholders = ",".join(["?"] * len(plan['column_info']))
+        inserts[table] = f'INSERT INTO {plan["table_name_quoted"]} VALUES ({placeholders})'
+
+    work = queue.Queue()
+    for table in order_tables_by_size(pg_cur, list(inserts)):
+        work.put(table)
+    out = queue.Queue(maxsize=EXPORT_QUEUE_BATCHES)
+    abort = threading.Event()
+    threads = [
+        threading.Thread(target=read_export_tables, name=f"export-reader-{i}",
+                         args=(snapshot, work, plans, user_id, out, abort), daemon=True)
+        for i in range(min(workers, len(inserts)))
+    ]
+    for t in threads:
+        t.start()
+
+    start = _time.monotonic()
+    pending = set(inserts)
+    failed = set()
+    try:
+        while pending:
+            try:
+                kind, table, payload = out.get(timeout=1)
+            except queue.Empty:
+                if not any(t.is_alive() for t in threads) and out.empty():
+                    break  # plus aucun lecteur : tables restantes non lues
+                continue
+            if kind == 'rows':
+                sqlite_cur.executemany(inserts[table], payload)
+                # Let the export engine move to disk if the database outgrew RAM
+                sqlite_cur = target.checkpoint(sqlite_cur)
+            elif kind == 'done':
+                pending.discard(table)
+                table_contents[table] = payload
+                logging.info(f"Table {table} exportée avec {payload} lignes")
+                if progress:
+                    progress(table, payload)
+            else:
+                pending.discard(table)
+                failed.add(table)
+                logging.error(f"Erreur lors de l'exportation de la table {table}: {str(payload)}")
+    except Exception:
+        abort.set()
+        raise
+    finally:
+        abort.set()
+        for t in threads:
+            t.join()
+
+    if pending:
+        # Pool épuisé : condition passagère, le client doit réessayer plutôt que
+        # recevoir un export amputé
+        raise ExportIncomplete(f"Tables non exportées, aucun lecteur disponible : {', '.join(sorted(pending))}")
+
+    table_contents = {t: table_contents[t] for t in tables_to_export if t in table_contents}
+    exported_tables = list(table_contents)
+    target.conn.commit()
+    logging.info(f"Export parallèle ({len(threads)} lecteurs) terminé en {_time.monotonic() - start:.2f}s")
+
+    rows = target.conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+    created_tables = [row[0].lower() for row in rows]
+    logging.info(f"Tables créées dans SQLite : {created_tables}")
+
+    return exported_tables, table_contents, created_tables
+
+# ── Export incrémental (delta) ──────────────────────────────────────────────
+# Suivi des modifications : triggers par instruction (tables de transition) qui
+# journalisent (user_id, table, clé primaire, txid) dans export_changelog. Le
+# watermark rendu au client est le xmin du snapshot de l'export : toute
+# transaction validée après le début de l'export a un txid >= watermark.
+# Installés par `flask --app main install-change-tracking` (aucun DDL dans les
+# requêtes) ; sans eux les exports sont complets et sans watermark.
+EXPORT_CHANGELOG_RETENTION_DAYS = int(os.environ.get('EXPORT_CHANGELOG_RETENTION_DAYS', 30))
+EXPORT_CHANGELOG_PRUNE_INTERVAL = 3600  # secondes entre deux purges par processus
+
+CHANGE_TRACKING_DDL = """
+    CREATE TABLE IF NOT EXISTS export_changelog (
+        id bigserial PRIMARY KEY,
+        txid bigint NOT NULL DEFAULT txid_current(),
+        user_id text,
+        table_name text NOT NULL,
+        pk text NOT NULL,
+        op char(1) NOT NULL,
+        changed_at timestamptz NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS export_changelog_tenant_idx
+        ON export_changelog (user_id, table_name, txid);
+    CREATE INDEX IF NOT EXISTS export_changelog_changed_at_idx
+        ON export_changelog (changed_at);
+    CREATE INDEX IF NOT EXISTS export_changelog_tenant_txid_idx
+        ON export_changelog (user_id, txid);
+    CREATE TABLE IF NOT EXISTS export_sync_state (
+        name text PRIMARY KEY,
+        value bigint NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS export_changelog_totals (
+        user_id text PRIMARY KEY,
+        total bigint NOT NULL
+    );
+    CREATE OR REPLACE FUNCTION export_log_changes() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    DECLARE
+        changed_rows text := CASE TG_OP
+            WHEN 'INSERT' THEN 'SELECT user_id FROM new_rows'
+            WHEN 'DELETE' THEN 'SELECT user_id FROM old_rows'
+            ELSE 'SELECT user_id FROM new_rows UNION SELECT user_id FROM old_rows' END;
+    BEGIN
+        -- Table partagée (sans user_id) : une entrée sans tenant par instruction,
+        -- cumulée dans la version de données de tous les tenants
+        IF TG_ARGV[1] = 'shared' THEN
+            EXECUTE format('INSERT INTO export_changelog (user_id, table_name, pk, op)
+                            SELECT NULL, %L, %L, %L WHERE EXISTS (SELECT 1 FROM %I)',
+                           TG_TABLE_NAME, '', left(TG_OP, 1),
+                           CASE TG_OP WHEN 'DELETE' THEN 'old_rows' ELSE 'new_rows' END);
+            RETURN NULL;
+        END IF;
+        -- Chargement de masse (migration, export.bulk_load) : une entrée 'R' sans
+        -- clé par tenant et par instruction au lieu d'une par ligne ; un delta
+        -- antérieur à cette entrée devient un export complet
+        IF current_setting('export.bulk_load', true) = 'on' THEN
+            EXECUTE format('INSERT INTO export_changelog (user_id, table_name, pk, op)
+                            SELECT user_id, %L, %L, %L FROM (%s) t
+                            WHERE user_id IS NOT NULL GROUP BY user_id',
+                           TG_TABLE_NAME, '', 'R', changed_rows);
+        -- Journal par clé primaire (tables sans clé simple : TG_ARGV[0] vide)
+        ELSIF TG_ARGV[0] <> '' AND TG_OP = 'INSERT' THEN
+            EXECUTE format('INSERT INTO export_changelog (user_id, table_name, pk, op)
+                            SELECT user_id, %L, %I::text, ''I'' FROM new_rows',
+                           TG_TABLE_NAME, TG_ARGV[0]);
+        ELSIF TG_ARGV[0] <> '' AND TG_OP = 'UPDATE' THEN
+            EXECUTE format('INSERT INTO export_changelog (user_id, table_name, pk, op)
+                            SELECT user_id, %1$L, %2$I::text, ''U'' FROM new_rows
+                            UNION
+                            SELECT user_id, %1$L, %2$I::text, ''U'' FROM old_rows',
+                           TG_TABLE_NAME, TG_ARGV[0]);
+        ELSIF TG_ARGV[0] <> '' THEN
+            EXECUTE format('INSERT INTO export_changelog (user_id, table_name, pk, op)
+                            SELECT user_id, %L, %I::text, ''D'' FROM old_rows',
+                           TG_TABLE_NAME, TG_ARGV[0]);
+        ELSE
+            -- Une entrée sans clé par tenant : compte dans la version de données
+            EXECUTE format('INSERT INTO export_changelog (user_id, table_name, pk, op)
+                            SELECT user_id, %L, %L, %L FROM (%s) t
+                            WHERE user_id IS NOT NULL GROUP BY user_id',
+                           TG_TABLE_NAME, '', left(TG_OP, 1), changed_rows);
+        END IF;
+        RETURN NULL;
+    END $$;
+"""
+
+CHANGE_TRIGGERS = (
+    ('export_changes_ins', 'INSERT', 'NEW TABLE AS new_rows'),
+    ('export_changes_upd', 'UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+    ('export_changes_del', 'DELETE', 'OLD TABLE AS old_rows'),
+)
+
+_change_tracking = {'plans': None, 'tables': {}, 'available': False, 'pruned_at': 0.0}
+_change_tracking_lock = threading.Lock()
+
+def trackable_tables(plans):
+    """Tables dont les lignes peuvent être suivies : clé primaire simple et colonne user_id"""
+    tracked = {}
+    for table, plan in plans.items():
+        column_types = {col['name']: col['type'] for col in plan['column_info']}
+        if len(plan['primary_keys']) == 1 and 'user_id' in column_types:
+            pk = plan['primary_keys'][0]
+            tracked[table] = (pk, column_types[pk])
+    return tracked
+
+def versioned_tables(plans):
+    """{table: partagée} des tables dont les écritures changent une version de données : toutes.
+
+    Une table sans user_id (partagée) est exportée entière à chaque tenant : ses
+    écritures changent la version de tous les tenants.
+    """
+    return {table: not any(col['name'] == 'user_id' for col in plan['column_info'])
+            for table, plan in plans.items()}
+
+def existing_change_triggers(pg_cur):
+    """{(table, trigger)} des triggers du suivi des modifications déjà créés"""
+    pg_cur.execute("""
+        SELECT c.relname AS table_name, t.tgname AS trigger_name
+        FROM pg_trigger t
+        JOIN pg_class c ON c.oid = t.tgrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'public' AND t.tgname LIKE 'export_changes_%'
+    """)
+    return {(row['table_name'], row['trigger_name']) for row in pg_cur.fetchall()}
+
+def missing_change_tracking(pg_cur, versioned):
+    """Tables versionnées sans leurs triggers (toutes si le journal n'existe pas) ; lecture du catalogue seule"""
+    pg_cur.execute("SELECT to_regclass('export_changelog_totals') IS NOT NULL AS installed")
+    if not pg_cur.fetchone()['installed']:
+        return list(versioned)
+    existing = existing_change_triggers(pg_cur)
+    return [table for table in versioned
+            if any((table, trigger) not in existing for trigger, _, _ in CHANGE_TRIGGERS)]
+
+def install_change_tracking(pg_cur, tracked, versioned):
+    """Crée le journal des modifications et les triggers manquants (idempotent, sérialisé par un verrou consultatif).
+
+    Les tables suivies journalisent leurs clés primaires ; les autres tables
+    versionnées journalisent une entrée sans clé par tenant et par instruction,
+    les tables partagées une entrée sans clé ni tenant par instruction.
+    """
+    pg_cur.execute("SELECT pg_advisory_xact_lock(hashtext('export_changelog'))")
+    pg_cur.execute(CHANGE_TRACKING_DDL)
+    existing = existing_change_triggers(pg_cur)
+    for table, shared in versioned.items():
+        pk = tracked[table][0] if table in tracked else ''
+        args = "'', 'shared'" if shared else f"'{pk}'"
+        for trigger, event, transition in CHANGE_TRIGGERS:
+            if (table, trigger) not in existing:
+                pg_cur.execute(
+                    f'CREATE TRIGGER {trigger} AFTER {event} ON "{table}" '
+                    f'REFERENCING {transition} FOR EACH STATEMENT '
+                    f"EXECUTE PROCEDURE export_log_changes({args})"
+                )
+                logger.info(f"Suivi des modifications activé sur {table} ({event})")
+
+def fold_changelog(pg_cur):
+    """Cumule par tenant les entrées des transactions terminées (txid < xmin du snapshot).
+
+    Les entrées des tables partagées (sans tenant) sont cumulées dans
+    export_sync_state.shared_total. La version de données d'un tenant est la
+    somme des cumuls (le sien et shared_total) plus le nombre d'entrées
+    postérieures à folded_txid : elle ne dépend que des transactions validées,
+    quel que soit leur ordre de validation, et la purge ne la fait pas reculer.
+    """
+    pg_cur.execute("SELECT pg_advisory_xact_lock(hashtext('export_changelog_totals'))")
+    pg_cur.execute("""
+        WITH bounds AS (
+            SELECT COALESCE((SELECT value FROM export_sync_state WHERE name = 'folded_txid'), 0) AS since,
+                   txid_snapshot_xmin(txid_current_snapshot()) AS upto
+        ), folded AS (
+            INSERT INTO export_changelog_totals AS t (user_id, total)
+            SELECT c.user_id, count(*) FROM export_changelog c, bounds b
+            WHERE c.user_id IS NOT NULL AND c.txid >= b.since AND c.txid < b.upto
+            GROUP BY c.user_id
+            ON CONFLICT (user_id) DO UPDATE SET total = t.total + EXCLUDED.total
+        ), shared AS (
+            INSERT INTO export_sync_state AS s (name, value)
+            SELECT 'shared_total', count(*) FROM export_changelog c, bounds b
+            WHERE c.user_id IS NULL AND c.txid >= b.since AND c.txid < b.upto
+            HAVING count(*) > 0
+            ON CONFLICT (name) DO UPDATE SET value = s.value + EXCLUDED.value
+        )
+        INSERT INTO export_sync_state (name, value)
+        SELECT 'folded_txid', upto FROM bounds WHERE upto > since
+        ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value
+    """)
+
+def prune_changelog(pg_cur):
+    """Purge le journal au-delà de la rétention ; le plus grand txid purgé devient l'horizon
+    en deçà duquel un watermark ne peut plus être servi en delta.
+
+    Seules les entrées déjà cumulées par fold_changelog sont purgées.
+    """
+    fold_changelog(pg_cur)
+    pg_cur.execute("""
+        WITH pruned AS (
+            DELETE FROM export_changelog
+            WHERE changed_at < now() - make_interval(days => %s)
+              AND txid < COALESCE((SELECT value FROM export_sync_state WHERE name = 'folded_txid'), 0)
+            RETURNING txid
+        )
+        INSERT INTO export_sync_state (name, value)
+        SELECT 'horizon', max(txid) FROM pruned HAVING max(txid) IS NOT NULL
+        ON CONFLICT (name) DO UPDATE SET value = GREATEST(export_sync_state.value, EXCLUDED.value)
+    """, (EXPORT_CHANGELOG_RETENTION_DAYS,))
+
+def prepare_change_tracking(pg_cur, tables=EXPORT_TABLES):
+    """Vérifie que les modifications sont journalisées et renvoie le watermark de cet export.
+
+    Renvoie None si les triggers ne sont pas installés sur toutes les tables
+    versionnées (voir install-change-tracking) : les exports fonctionnent alors
+    comme avant, sans watermark. Aucun DDL n'est exécuté ici.
+    """
+    pg_conn = pg_cur.connection
+    plans = get_export_plans(pg_cur, tables)
+    now = _time.monotonic()
+    with _change_tracking_lock:
+        ready = _change_tracking['plans'] is plans and _change_tracking['available']
+        prune = now - _change_tracking['pruned_at'] > EXPORT_CHANGELOG_PRUNE_INTERVAL
+
+    if not ready or prune:
+        tracked = trackable_tables(plans)
+        try:
+            if not ready:
+                missing = missing_change_tracking(pg_cur, versioned_tables(plans))
+                if missing:
+                    pg_conn.rollback()
+                    with _change_tracking_lock:
+                        warn = _change_tracking['plans'] is not plans
+                        _change_tracking.update(plans=plans, tables={}, available=False)
+                    if warn:
+                        logger.warning(f"Suivi des modifications non installé ({', '.join(missing)}) : "
+                                       f"lancer `flask --app main install-change-tracking`")
+                    return None
+            if prune:
+                prune_changelog(pg_cur)
+            pg_conn.commit()
+        except psycopg2.Error as e:
+            pg_conn.rollback()
+            logger.error(f"Suivi des modifications indisponible: {str(e)}")
+            with _change_tracking_lock:
+                _change_tracking.update(plans=plans, tables={}, available=False, pruned_at=now)
+            return None
+        with _change_tracking_lock:
+            _change_tracking.update(plans=plans, tables=tracked, available=True, pruned_at=now)
+
+    pg_cur.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()) AS watermark")
+    watermark = pg_cur.fetchone()['watermark']
+    pg_conn.commit()
+    return watermark
+
+def delta_available(pg_cur, since, user_id):
+    """Un delta est possible si le suivi est actif, qu'aucune entrée postérieure à since n'a été
+    purgée et que le tenant n'a pas été rechargé en masse depuis (entrée 'R')"""
+    with _change_tracking_lock:
+        if not _change_tracking['available']:
+            return False
+    pg_cur.execute("""
+        SELECT (SELECT value FROM export_sync_state WHERE name = 'horizon') AS horizon,
+               EXISTS (SELECT 1 FROM export_changelog
+                       WHERE user_id = %s AND txid >= %s AND op = 'R') AS reloaded
+    """, (user_id, since))
+    row = pg_cur.fetchone()
+    return not row['reloaded'] and (row['horizon'] is None or since > row['horizon'])
+
+def export_changed_rows(pg_cur, sqlite_cur, table_name, plan, user_id, since, pk, pk_type):
+    """Copie la version actuelle des lignes de table_name modifiées depuis le watermark.
+
+    Renvoie (changed_rows, deleted_keys) : les clés journalisées depuis le
+    watermark qui n'existent plus pour ce tenant sont des suppressions.
+    """
+    column_info = plan['column_info']
+    select_columns = ", ".join(f't."{col["name"]}"' for col in column_info)
+    changed_keys = f"""
+        SELECT DISTINCT c.pk::{pk_type} AS pk FROM export_changelog c
+        WHERE c.user_id = %s AND c.table_name = %s AND c.txid >= %s
+    """
+    params = (user_id, table_name, since)
+
+    pg_cur.execute(
+        f'SELECT {select_columns} FROM "{table_name}" t '
+        f'JOIN ({changed_keys}) c ON t."{pk}" = c.pk WHERE t.user_id = %s ORDER BY t."{pk}"',
+        params + (user_id,)
+    )
+    values_of = row_values_getter(column_info)
+    converters = column_converters(column_info)
+    placeholders = ",".join(["?"] * len(column_info))
+    insert_sql = f'INSERT INTO {plan["table_name_quoted"]} VALUES ({placeholders})'
+    changed_rows = 0
+    while True:
+        rows = pg_cur.fetchmany(1000)
+        if not rows:
+            break
+        processed_rows = []
+        for row in rows:
+            values = values_of(row)
+            for idx, convert in converters:
+                values[idx] = convert(values[idx])
+            processed_rows.append(values)
+        sqlite_cur.executemany(insert_sql, processed_rows)
+        changed_rows += len(processed_rows)
+
+    pg_cur.execute(
+        f'SELECT c.pk::text AS pk FROM ({changed_keys}) c '
+        f'WHERE NOT EXISTS (SELECT 1 FROM "{table_name}" t WHERE t."{pk}" = c.pk AND t.user_id = %s)',
+        params + (user_id,)
+    )
+    deleted_keys = [row['pk'] for row in pg_cur.fetchall()]
+    return changed_rows, deleted_keys
+
+def build_delta_export_db(pg_cur, target, user_id, since, sync_info, tables_to_export=EXPORT_TABLES):
+    """Fichier SQLite ne contenant que ce qui a changé pour user_id depuis le watermark.
+
+    Mêmes tables et DDL que l'export complet, remplies avec la version actuelle
+    des lignes insérées ou modifiées ; SYNC_DELETED liste les suppressions
+    (table, clé primaire). Les tables sans suivi (pas de clé primaire simple)
+    sont exportées en entier et listées dans sync_info['full_tables'].
+    """
+    pg_conn = pg_cur.connection
+    pg_conn.rollback()
+    pg_cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+
+    plans = get_export_plans(pg_cur, tables_to_export)
+    with _change_tracking_lock:
+        tracked = dict(_change_tracking['tables'])
+
+    sqlite_cur = target.conn.cursor()
+    sqlite_cur.execute("CREATE TABLE SYNC_DELETED (TABLE_NAME TEXT NOT NULL, PK TEXT NOT NULL)")
+    sqlite_cur.execute("CREATE TABLE SYNC_INFO (NAME TEXT PRIMARY KEY, VALUE TEXT)")
+
+    exported_tables = []
+    table_contents = {}
+    deleted = sync_info.setdefault('deleted', {})
+    full_tables = sync_info.setdefault('full_tables', [])
+
+    for table in tables_to_export:
+        plan = plans.get(table)
+        try:
+            if plan and table in tracked:
+                sqlite_cur.execute(plan['create_sql'])
+                pk, pk_type = tracked[table]
+                row_count, deleted_keys = export_changed_rows(
+                    pg_cur, sqlite_cur, table, plan, user_id, since, pk, pk_type)
+                sqlite_cur.executemany("INSERT INTO SYNC_DELETED VALUES (?, ?)",
+                                       [(table, key) for key in deleted_keys])
+                if deleted_keys:
+                    deleted[table] = len(deleted_keys)
+            else:
+                row_count = export_table_with_user_id(pg_cur, sqlite_cur, table, user_id,
+                                                      plan or {}, target=target)
+                full_tables.append(table)
+            exported_tables.append(table)
+            table_contents[table] = row_count
+        except Exception as table_error:
+            logger.error(f"Erreur lors de l'exportation delta de la table {table}: {str(table_error)}")
+            raise
+
+    sqlite_cur.executemany("INSERT INTO SYNC_INFO VALUES (?, ?)", [
+        ('since', str(since)),
+        ('watermark', str(sync_info['watermark'])),
+        ('full_tables', ",".join(full_tables)),
+    ])
+    target.conn.commit()
+
+    rows = target.conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+    created_tables = [row[0].lower() for row in rows]
+    logger.info(f"Export delta depuis {since}: {table_contents}, suppressions {deleted}")
+
+    return exported_tables, table_contents, created_tables
+
+# ── Exports en tâche de fond ────────────────────────────────────────────────
+# POST /export/jobs met l'export en file ; l'état des tâches et les fichiers
+# produits sont sur disque (partagés entre workers gunicorn). Un fichier reste
+# servi tant que les données du tenant n'ont pas changé depuis son snapshot.
+EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'export_cache'))
+EXPORT_JOB_WORKERS = int(os.environ.get('EXPORT_JOB_WORKERS', 2))
+EXPORT_JOB_STALE = int(os.environ.get('EXPORT_JOB_STALE_SECONDS', 1800))   # tâche sans progression = interrompue
+EXPORT_JOB_TTL = int(os.environ.get('EXPORT_JOB_TTL_SECONDS', 86400))      # durée de conservation des tâches
+EXPORT_JOB_HEARTBEAT = 60   # secondes entre deux rafraîchissements d'une tâche en cours
+
+_export_executor = None
+_export_executor_lock = threading.Lock()
+
+def get_export_executor():
+    global _export_executor
+    if _export_executor is None:
+        with _export_executor_lock:
+            if _export_executor is None:
+                _export_executor = ThreadPoolExecutor(max_workers=EXPORT_JOB_WORKERS,
+                                                      thread_name_prefix='export-job')
+    return _export_executor
+
+def _export_cache_path(*parts):
+    path = os.path.join(EXPORT_CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def _tenant_key(user_id):
+    return hashlib.sha256(user_id.encode('utf-8')).hexdigest()[:24]
+
+def _write_json(path, data):
+    """Écriture atomique : un autre processus ne lit jamais un fichier à moitié écrit"""
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def load_export_job(job_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id):
+        return None
+    job = _read_json(_export_cache_path('jobs', f'{job_id}.json'))
+    if job and job['status'] in ('queued', 'running') and _time.time() - job['updated_at'] > EXPORT_JOB_STALE:
+        job.update(status='failed', error='Export interrompu')
+    return job
+
+def save_export_job(job):
+    job['updated_at'] = _time.time()
+    _write_json(_export_cache_path('jobs', f"{job['job_id']}.json"), job)
+
+_EXPORT_ARTIFACT_RE = re.compile(r'[0-9a-f]{24}-([0-9a-f]{32})\.sqlite(\.tmp)?')
+
+def prune_export_jobs():
+    """Supprime les tâches plus vieilles que EXPORT_JOB_TTL, sauf celles encore référencées
+    par un tenant, puis les fichiers .sqlite dont la tâche n'existe plus"""
+    jobs_dir = os.path.join(EXPORT_CACHE_DIR, 'jobs')
+    if not os.path.isdir(jobs_dir):
+        return
+    tenants_dir = os.path.join(EXPORT_CACHE_DIR, 'tenants')
+    referenced = set()
+    for name in os.listdir(tenants_dir) if os.path.isdir(tenants_dir) else []:
+        tenant = _read_json(os.path.join(tenants_dir, name)) or {}
+        referenced.update(tenant.get(key) for key in ('job_id', 'pending_job_id'))
+    now = _time.time()
+    for name in os.listdir(jobs_dir):
+        path = os.path.join(jobs_dir, name)
+        try:
+            if name[:-len('.json')] not in referenced and os.path.getmtime(path) < now - EXPORT_JOB_TTL:
+                os.unlink(path)
+        except OSError:
+            pass
+    # Fichiers orphelins (tâche purgée, ou .tmp d'un worker interrompu)
+    for name in os.listdir(EXPORT_CACHE_DIR):
+        match = _EXPORT_ARTIFACT_RE.fullmatch(name)
+        if not match:
+            continue
+        path = os.path.join(EXPORT_CACHE_DIR, name)
+        try:
+            if match.group(2):
+                orphan = os.path.getmtime(path) < now - EXPORT_JOB_STALE
+            else:
+                orphan = not os.path.exists(os.path.join(jobs_dir, f'{match.group(1)}.json'))
+            if orphan:
+                os.unlink(path)
+        except OSError:
+            pass
+
+def run_export_job(job):
+    """Worker de fond : construit l'export et le publie comme fichier en cache du tenant"""
+    user_id = job['user_id']
+    job_lock = threading.Lock()
+    done = threading.Event()
+
+    def update(**changes):
+        with job_lock:
+            job.update(changes)
+            save_export_job(job)
+
+    def progress(table, row_count):
+        with job_lock:
+            job['table_contents'][table] = row_count
+            job['tables_done'] = len(job['table_contents'])
+            save_export_job(job)
+
+    def heartbeat():
+        # Une grosse table peut dépasser EXPORT_JOB_STALE sans progression par table
+        while not done.wait(EXPORT_JOB_HEARTBEAT):
+            update()
+
+    update(status='running')
+    threading.Thread(target=heartbeat, name=f"export-heartbeat-{job['job_id'][:8]}", daemon=True).start()
+    conn = None
+    builder = None
+    try:
+        conn = get_conn()
+        pg_cur = conn.cursor(cursor_factory=RealDictCursor)
+        job['watermark'] = prepare_change_tracking(pg_cur)
+        state = export_data_state(pg_cur, user_id)
+        conn.commit()
+
+        builder = SqliteExportBuilder()
+        exported_tables, table_contents, created_tables = build_export_db(
+            pg_cur, builder, user_id, progress=progress)
+        # Une table manquante ne doit pas devenir le fichier de référence du tenant
+        require_complete_export(exported_tables)
+        db_bytes, sqlite_path = builder.finish()
+        conn.rollback()
+
+        artifact = _export_cache_path(f"{_tenant_key(user_id)}-{job['job_id']}.sqlite")
+        if db_bytes is not None:
+            with open(f"{artifact}.tmp", 'wb') as f:
+                f.write(db_bytes)
+            os.replace(f"{artifact}.tmp", artifact)
+        else:
+            shutil.move(sqlite_path, artifact)
+
+        update(status='done', artifact=artifact, state=state,
+               size_bytes=os.path.getsize(artifact),
+               tables_exported=exported_tables, table_contents=table_contents)
+
+        # Nouveau fichier de référence du tenant ; les précédents sont supprimés, même
+        # si leur tâche a déjà été purgée
+        _write_json(_export_cache_path('tenants', f"{_tenant_key(user_id)}.json"), {'job_id': job['job_id']})
+        for old in glob.glob(os.path.join(EXPORT_CACHE_DIR, f"{_tenant_key(user_id)}-*.sqlite")):
+            if old != artifact:
+                try:
+                    os.unlink(old)
+                except OSError:
+                    pass
+        logger.info(f"Export {job['job_id']} terminé: {job['size_bytes']} octets")
+    except Exception as e:
+        logger.error(f"Export {job['job_id']} en échec: {str(e)}")
+        update(status='failed', error=str(e), watermark=None)
+    finally:
+        done.set()
+        if builder is not None:
+            builder.close()
+        if conn is not None:
+            conn.close()
+
+def export_job_response(job):
+    """Vue publique d'une tâche (sans chemins serveur ni état du snapshot)"""
+    body = {key: job.get(key) for key in (
+        'job_id', 'status', 'created_at', 'updated_at', 'tables_total', 'tables_done',
+        'table_contents', 'size_bytes', 'watermark', 'error')}
+    body['cached'] = job.get('cached', False)
+    body['status_url'] = f"/export/jobs/{job['job_id']}"
+    if job['status'] == 'done':
+        body['download_url'] = f"/export/jobs/{job['job_id']}/download"
+    return body
+
+@app.route('/export/jobs', methods=['POST'])
+def create_export_job():
+    """Met un export en file et renvoie son identifiant ; réutilise le fichier en cache
+    si les données du tenant n'ont pas changé, ou la tâche déjà en cours."""
+    user_id = request.headers.get('X-User-ID')
+    if not user_id:
+        return jsonify({'error': 'Missing X-User-ID header'}), 401
+
+    try:
+        conn = get_conn()
+        pg_cur = conn.cursor(cursor_factory=RealDictCursor)
+        prepare_change_tracking(pg_cur)
+
+        tenant = _read_json(_export_cache_path('tenants', f"{_tenant_key(user_id)}.json")) or {}
+        current = load_export_job(tenant['job_id']) if tenant.get('job_id') else None
+        if current and current['status'] == 'done':
+            if os.path.exists(current['artifact']) and not export_data_changed(pg_cur, user_id, current.get('state')):
+                conn.rollback()
+                return jsonify(dict(export_job_response(current), cached=True)), 200
+        pending = load_export_job(tenant['pending_job_id']) if tenant.get('pending_job_id') else None
+        conn.rollback()
+        if pending and pending['status'] in ('queued', 'running'):
+            return jsonify(export_job_response(pending)), 202
+
+        now = _time.time()
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'user_id': user_id,
+            'status': 'queued',
+            'created_at': now,
+            'tables_total': len(EXPORT_TABLES),
+            'tables_done': 0,
+            'table_contents': {},
+        }
+        save_export_job(job)
+        _write_json(_export_cache_path('tenants', f"{_tenant_key(user_id)}.json"),
+                    dict(tenant, pending_job_id=job['job_id']))
+        get_export_executor().submit(run_export_job, dict(job, table_contents={}))
+        prune_export_jobs()
+        return jsonify(export_job_response(job)), 202
+
+    except psycopg2.Error as db_error:
+        logger.error(f"Erreur base de données à la création de l'export: {str(db_error)}")
+        return jsonify({'error': 'Database connection error'}), 500
+
+@app.route('/export/jobs/<job_id>', methods=['GET'])
+def export_job_status(job_id):
+    """Avancement d'un export : lignes exportées par table"""
+    user_id = request.headers.get('X-User-ID')
+    if not user_id:
+        return jsonify({'error': 'Missing X-User-ID header'}), 401
+    job = load_export_job(job_id)
+    if not job or job['user_id'] != user_id:
+        return jsonify({'error': 'Export job not found'}), 404
+    return jsonify(export_job_response(job)), 200
+
+@app.route('/export/jobs/<job_id>/download', methods=['GET'])
+def download_export_job(job_id):
+    """Fichier SQLite produit par un export terminé (gzip/zstd selon Accept-Encoding)"""
+    user_id = request.headers.get('X-User-ID')
+    if not user_id:
+        return jsonify({'error': 'Missing X-User-ID header'}), 401
+    job = load_export_job(job_id)
+    if not job or job['user_id'] != user_id:
+        return jsonify({'error': 'Export job not found'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': 'Export not ready', 'status': job['status']}), 409
+    if not os.path.exists(job['artifact']):
+        return jsonify({'error': 'Export expired, create a new job'}), 410
+
+    encoding = negotiate_export_encoding()
+    send_path = job['artifact']
+    cleanup_paths = []
+    try:
+        if encoding:
+            send_path = compress_file(job['artifact'], encoding)
+            cleanup_paths.append(send_path)
+        return stream_export_response(
+            f"export_{user_id}.sqlite",
+            path=send_path,
+            encoding=encoding,
+            headers={
+                'X-Tables-Exported': ",".join(job['tables_exported']),
+                'X-Table-Contents': json.dumps(job['table_contents']),
+                'X-Uncompressed-Size': str(job['size_bytes']),
+                'X-Export-Watermark': '' if job.get('watermark') is None else str(job['watermark']),
+            },
+            cleanup_paths=cleanup_paths,
+        )
+    except FileNotFoundError:
+        # Remplacé par un export plus récent pendant la préparation
+        for p in cleanup_paths:
+            if os.path.exists(p):
+                os.unlink(p)
+        return jsonify({'error': 'Export expired, create a new job'}), 410
+
+# ── Cache des exports complets (ETag) ───────────────────────────────────────
+# Chaque écriture ajoute au moins une entrée du tenant à export_changelog
+# (triggers du suivi des modifications), une écriture dans une table partagée
+# une entrée sans tenant, comptée pour tous ; la version de données est le nombre
+# d'entrées validées (cumul de fold_changelog + entrées récentes), sans ligne
+# mise à jour dans la transaction d'écriture. (version de données, version du
+# schéma) identifie le contenu d'un export complet. Un export déjà construit
+# pour cette clé est servi depuis EXPORT_CACHE_DIR/snapshots sans autre requête
+# Postgres.
+EXPORT_SNAPSHOT_GRACE = 60   # secondes avant suppression d'un snapshot remplacé (téléchargements en cours)
+
+def change_tracking_ready():
+    with _change_tracking_lock:
+        return _change_tracking['available']
+
+def export_data_state(pg_cur, user_id, tables=EXPORT_TABLES):
+    """(version de données, version du DDL) de l'export de user_id en un aller-retour.
+
+    None si le suivi des modifications est indisponible : rien ne peut être mis en cache.
+    """
+    if not change_tracking_ready():
+        return None
+    pg_cur.execute(f"""
+        SELECT COALESCE((SELECT total FROM export_changelog_totals WHERE user_id = %s), 0)
+               + COALESCE((SELECT value FROM export_sync_state WHERE name = 'shared_total'), 0)
+               + (SELECT count(*) FROM export_changelog
+                  WHERE (user_id = %s OR user_id IS NULL)
+                    AND txid >= COALESCE((SELECT value FROM export_sync_state
+                                          WHERE name = 'folded_txid'), 0)) AS data_version,
+               ({CATALOG_VERSION_SQL}) AS schema_version
+    """, (user_id, user_id, list(tables)))
+    row = pg_cur.fetchone()
+    return {'data_version': row['data_version'], 'schema_version': row['schema_version']}
+
+def export_data_changed(pg_cur, user_id, state):
+    """True si les données de user_id ou le DDL exporté ont changé depuis state"""
+    current = export_data_state(pg_cur, user_id)
+    return current is None or state is None or current != state
+
+def export_etag(user_id, state):
+    key = f"{user_id}\0{state['data_version']}\0{state['schema_version']}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+def _export_snapshot_base(user_id, etag):
+    return _export_cache_path('snapshots', f"{_tenant_key(user_id)}-{etag}")
+
+def store_export_snapshot(user_id, etag, db_bytes, sqlite_path, meta):
+    """Publie un export terminé sous sa clé de contenu et supprime les anciens du tenant"""
+    base = _export_snapshot_base(user_id, etag)
+    tmp = f"{base}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if db_bytes is not None:
+        with open(tmp, 'wb') as f:
+            f.write(db_bytes)
+    else:
+        shutil.move(sqlite_path, tmp)
+    os.replace(tmp, f"{base}.sqlite")
+    _write_json(f"{base}.json", meta)
+
+    prefix = f"{_tenant_key(user_id)}-"
+    current = os.path.basename(base)
+    directory = os.path.dirname(base)
+    limit = _time.time() - EXPORT_SNAPSHOT_GRACE
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and not name.startswith(current):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+def cached_compressed(path, encoding):
+    """Copie compressée d'un export en cache, construite une fois par encodage"""
+    target = f"{path}.{encoding}"
+    if not os.path.exists(target):
+        shutil.move(compress_file(path, encoding), target)
+    return target
+
+def export_headers(meta):
+    sync_info = meta['sync']
+    return {
+        'X-Tables-Exported': ",".join(meta['tables_exported']),
+        'X-Table-Contents': json.dumps(meta['table_contents']),
+        'X-Export-Watermark': '' if sync_info['watermark'] is None else str(sync_info['watermark']),
+        'X-Export-Delta': '1' if sync_info['delta'] else '0',
+        'X-Deleted-Contents': json.dumps(sync_info.get('deleted', {})),
+        'X-Full-Tables': ",".join(sync_info.get('full_tables', [])),
+    }
+
+def cached_export_response(user_id, etag):
+    """304 si le client a déjà cette version, le fichier en cache s'il existe, sinon None"""
+    binary = wants_binary_export()
+    encoding = negotiate_export_encoding() if binary else None
+    tag = etag if binary and not encoding else f"{etag}-{encoding or 'json'}"
+    if request.if_none_match.contains(tag):
+        response = Response(status=304)
+        response.set_etag(tag)
+        return response
+
+    base = _export_snapshot_base(user_id, etag)
+    meta = _read_json(f"{base}.json")
+    path = f"{base}.sqlite"
+    if meta is None or not os.path.exists(path):
+        return None
+    try:
+        return _cached_export_file_response(user_id, path, meta, binary, encoding, tag)
+    except FileNotFoundError:
+        # Remplacé par une construction plus récente entre-temps : pas en cache
+        return None
+
+def _cached_export_file_response(user_id, path, meta, binary, encoding, tag):
+    """Réponse servie depuis le fichier d'un snapshot ; FileNotFoundError s'il vient d'être supprimé"""
+    if not binary:
+        with open(path, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            max_size = 37 * 1024 * 1024  # ~37MB raw = ~50MB base64
+            if file_size > max_size:
+                return jsonify({'error': f'Database too large for export: {file_size} bytes'}), 413
+            db_bytes = f.read()
+        response = jsonify({
+            "db": base64.b64encode(db_bytes).decode("utf-8"),
+            "tables_exported": meta['tables_exported'],
+            "total_tables": len(meta['tables_exported']),
+            "expected_tables": EXPORT_TABLES,
+            "created_tables": meta['created_tables'],
+            "table_contents": meta['table_contents'],
+            "size_bytes": file_size,
+            "user_id": user_id,
+            **meta['sync']
+        })
+        response.set_etag(tag)
+        return response
+
+    send_path = cached_compressed(path, encoding) if encoding else path
+    headers = export_headers(meta)
+    headers['X-Uncompressed-Size'] = str(os.path.getsize(path))
+    headers['ETag'] = f'"{tag}"'
+    return stream_export_response(f"export_{user_id}.sqlite", path=send_path,
+                                  encoding=encoding, headers=headers)
+
+def build_cached_export(pg_cur, user_id, etag, sync_info):
+    """Construit un export complet, le publie sous etag et le sert depuis le cache.
+
+    Un export auquel manque une table n'est ni mis en cache ni servi avec un
+    watermark : ExportIncomplete (503), le client réessaie.
+    """
+    builder = SqliteExportBuilder()
+    try:
+        exported_tables, table_contents, created_tables = build_export_db(pg_cur, builder, user_id)
+        require_complete_export(exported_tables)
+        db_bytes, sqlite_path = builder.finish()
+    finally:
+        builder.close()
+    try:
+        store_export_snapshot(user_id, etag, db_bytes, sqlite_path, {
+            'tables_exported': exported_tables,
+            'created_tables': created_tables,
+            'table_contents': table_contents,
+            'sync': sync_info,
+        })
+    finally:
+        if sqlite_path and os.path.exists(sqlite_path):
+            os.unlink(sqlite_path)
+    response = cached_export_response(user_id, etag)
+    if response is None:
+        raise RuntimeError(f"Snapshot d'export {etag} supprimé avant d'être servi")
+    return response
+
 @app.route('/valider_vendeur', methods=['POST'])
 def valider_vendeur():
     """
@@ -525,6 +2493,7 @@ def ajouter_codebar_lie():
     if not numero_item:
         return jsonify({'erreur': 'numero_item est requis'}), 400
 
+    conn = None
     try:
         numero_item = int(numero_item)
         conn = get_conn()
@@ -586,7 +2555,9 @@ def ajouter_codebar_lie():
         conn.close()
         return jsonify({'statut': 'Code-barres lié ajouté', 'id': codebar_id, 'bar2': bar2}), 201
     except ValueError:
-        conn.rollback()
+        if conn:
+            conn.rollback()
+            conn.close()
         return jsonify({'erreur': 'numero_item doit être un nombre valide'}), 400
     except Exception as e:
         if conn:
@@ -606,6 +2577,7 @@ def liste_codebar_lies():
     if not numero_item:
         return jsonify({'erreur': 'numero_item est requis'}), 400
 
+    conn = None
     try:
         numero_item = int(numero_item)
         conn = get_conn()
@@ -1036,6 +3008,7 @@ def ajouter_item():
     if not all([designation, prix is not None, qte is not None]):
         return jsonify({'erreur': 'Champs obligatoires manquants (designation, prix, qte)'}), 400
 
+    conn = None
     try:
         prix = float(prix)
         qte = int(qte)
@@ -1130,7 +3103,9 @@ def ajouter_item():
         conn.close()
         return jsonify({'statut': 'Item ajouté', 'id': item_id, 'ref': ref, 'bar': bar}), 201
     except ValueError:
-        conn.rollback()
+        if conn:
+            conn.rollback()
+            conn.close()
         return jsonify({'erreur': 'Le prix et la quantité doivent être des nombres valides'}), 400
     except Exception as e:
         if conn:
@@ -1160,7 +3135,74 @@ def supprimer_item(numero_item):
     except Exception as e:
         return jsonify({'erreur': str(e)}), 500
 
+# ── Compteurs de tickets par tenant et nature ───────────────────────────────
+TICKET_COUNTER_DDL = """
+    CREATE TABLE IF NOT EXISTS comande_compteur (
+        user_id varchar NOT NULL,
+        nature varchar NOT NULL,
+        valeur integer NOT NULL,
+        PRIMARY KEY (user_id, nature)
+    );
+"""
+
+def next_ticket_number(cur, user_id, nature, count=1):
+    """Prochain compteur de (user_id, nature), dans la transaction de la vente.
+
+    La ligne du compteur reste verrouillée jusqu'au commit : deux ventes
+    simultanées ne peuvent pas obtenir le même numéro, et une vente annulée
+    rend son numéro (pas de trou). Au premier usage, le compteur part du
+    MAX(compteur) existant du tenant. Avec `count`, réserve autant de numéros
+    consécutifs et retourne le dernier.
+    """
+    cur.execute("""
+        UPDATE comande_compteur SET valeur = valeur + %s
+        WHERE user_id = %s AND nature = %s
+        RETURNING valeur
+    """, (count, user_id, nature))
+    row = cur.fetchone()
+    if row is None:
+        cur.execute("""
+            INSERT INTO comande_compteur (user_id, nature, valeur)
+            SELECT %s, %s, COALESCE(MAX(compteur), 0) + %s
+            FROM comande WHERE user_id = %s AND nature = %s
+            ON CONFLICT (user_id, nature) DO UPDATE SET valeur = comande_compteur.valeur + %s
+            RETURNING valeur
+        """, (user_id, nature, count, user_id, nature, count))
+        row = cur.fetchone()
+    return row['valeur'] if isinstance(row, dict) else row[0]
+
+def reset_ticket_counters(cur, user_id):
+    """Oublie les compteurs du tenant après un import de commandes : le prochain numéro
+    repartira du MAX(compteur) des commandes importées"""
+    cur.execute("DELETE FROM comande_compteur WHERE user_id = %s", (user_id,))
+
+def release_ticket_number(cur, user_id, nature, compteur):
+    """Rend `compteur` à sa série s'il en est le dernier numéro attribué"""
+    cur.execute("""
+        UPDATE comande_compteur SET valeur = valeur - 1
+        WHERE user_id = %s AND nature = %s AND valeur = %s
+    """, (user_id, nature, compteur))
+
+def insert_sale_lines(cur, rows):
+    """Lignes de vente (attache) en un seul INSERT préparé, colonnes passées en tableaux.
+
+    rows : tuples (user_id, numero_comande, numero_item, quantite, prixt, remarque, prixbh, achatfx)
+    """
+    if not rows:
+        return
+    execute_prepared(cur, 'attache_insert', [text_array(column) for column in zip(*rows)])
+
+def decrement_stock(cur, lines):
+    """Décrémente le stock de toutes les lignes en un seul UPDATE, quantités cumulées par article.
+
+    lines : tuples (numero_item, quantite)
+    """
+    if not lines:
+        return
+    execute_prepared(cur, 'item_stock_decrement', [text_array(column) for column in zip(*lines)])
+
 @app.route('/valider_vente', methods=['POST'])
+@idempotent
 def valider_vente():
     user_id = validate_user_id()
     if not isinstance(user_id, str):
@@ -1196,11 +3238,7 @@ def valider_vente():
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         # Vérifier l'utilisateur et le mot de passe
-        cur.execute("""
-            SELECT Password2
-            FROM utilisateur
-            WHERE numero_util = %s
-        """, (numero_util,))
+        execute_prepared(cur, 'utilisateur_password', (numero_util,))
         utilisateur = cur.fetchone()
         if not utilisateur:
             print(f"Erreur: Utilisateur {numero_util} non trouvé")
@@ -1209,39 +3247,27 @@ def valider_vente():
             print(f"Erreur: Mot de passe incorrect pour l'utilisateur {numero_util}")
             return jsonify({"error": "Mot de passe incorrect"}), 401
 
-        # Récupérer le dernier compteur pour cette nature
-        cur.execute("""
-            SELECT COALESCE(MAX(compteur), 0) as max_compteur
-            FROM comande
-            WHERE nature = %s
-        """, (nature,))
-        compteur = cur.fetchone()['max_compteur'] + 1
+        # Prochain compteur de ce tenant pour cette nature
+        compteur = next_ticket_number(cur, user_id, nature)
         print(f"Compteur calculé: nature={nature}, compteur={compteur}")
 
         # Insérer la commande avec numero_util
-        cur.execute("""
-            INSERT INTO comande (numero_table, date_comande, etat_c, nature, connection1, compteur, user_id, numero_util)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING numero_comande
-        """, (numero_table, date_comande, 'cloture', nature, -1, compteur, user_id, numero_util))
+        execute_prepared(cur, 'comande_insert',
+                         (numero_table, date_comande, 'cloture', nature, -1, compteur, user_id, numero_util))
         numero_comande = cur.fetchone()['numero_comande']
         print(f"Commande insérée: numero_comande={numero_comande}, nature={nature}, connection1=-1, compteur={compteur}, numero_util={numero_util}")
 
-        # Insérer les lignes et mettre à jour le stock
-        for ligne in lignes:
-            cur.execute("""
-                INSERT INTO attache (user_id, numero_comande, numero_item, quantite, prixt, remarque, prixbh, achatfx)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, (user_id,
-                  numero_comande,
-                  ligne.get('numero_item'),
-                  ligne.get('quantite'),
-                  ligne.get('prixt'),
-                  ligne.get('remarque'),
-                  ligne.get('prixbh'),
-                  0))
-            cur.execute("UPDATE item SET qte = qte - %s WHERE numero_item = %s", (ligne.get('quantite'), ligne.get('numero_item')))
-
+        # Insérer les lignes et mettre à jour le stock : une requête chacun, quel que soit le panier
+        insert_sale_lines(cur, [(user_id,
+                                 numero_comande,
+                                 ligne.get('numero_item'),
+                                 ligne.get('quantite'),
+                                 ligne.get('prixt'),
+                                 ligne.get('remarque'),
+                                 ligne.get('prixbh'),
+                                 0) for ligne in lignes])
+        decrement_stock(cur, [(ligne.get('numero_item'), ligne.get('quantite')) for ligne in lignes])
+
         # Mise à jour du solde du client si vente à terme
         if payment_mode == 'a_terme' and numero_table != 0:
             total_sale = sum(float(ligne.get('prixt', 0)) for ligne in lignes)
@@ -1268,9 +3294,14 @@ def valider_vente():
             """, (new_solde_str, numero_table))
             print(f"Solde client mis à jour: numero_clt={numero_table}, solde_change={solde_change}, amount_paid={amount_paid}, new_solde={new_solde_str}")
 
+        body = {"numero_comande": numero_comande}
+        replay = remember_response(cur, body, 200)
+        if replay is not None:
+            conn.rollback()
+            return replay
         conn.commit()
         print(f"Vente validée: numero_comande={numero_comande}, {len(lignes)} lignes")
-        return jsonify({"numero_comande": numero_comande}), 200
+        return jsonify(body), 200
 
     except Exception as e:
         if conn:
@@ -1282,6 +3313,193 @@ def valider_vente():
         if conn:
             cur.close()
             conn.close()
+
+# ── Ventes hors ligne rejouées par lot ──────────────────────────────────────
+VENTES_BATCH_MAX = int(os.environ.get('VENTES_BATCH_MAX', '1000'))
+
+def apply_sales(cur, user_id, ventes):
+    """Enregistre des ventes déjà validées en quelques requêtes ensemblistes.
+
+    Compteurs réservés par nature, commandes, lignes, stock cumulé par article
+    et soldes clients : le nombre de requêtes ne dépend pas du nombre de
+    ventes. Retourne {index: (numero_comande, compteur)}.
+    """
+    compteurs = {}
+    for nature in sorted({v['nature'] for v in ventes}):
+        groupe = [v for v in ventes if v['nature'] == nature]
+        dernier = next_ticket_number(cur, user_id, nature, len(groupe))
+        for compteur, v in enumerate(groupe, dernier - len(groupe) + 1):
+            compteurs[v['index']] = compteur
+
+    rows = psycopg2.extras.execute_values(cur, """
+        INSERT INTO comande (numero_table, date_comande, etat_c, nature, connection1, compteur, user_id, numero_util)
+        VALUES %s
+        RETURNING numero_comande, nature, compteur
+    """, [(v['numero_table'], v['date_comande'], 'cloture', v['nature'], -1, compteurs[v['index']], user_id,
+           v['numero_util']) for v in ventes], page_size=len(ventes), fetch=True)
+    comandes = {(r['nature'], r['compteur']): r['numero_comande'] for r in rows}
+    numeros = {v['index']: (comandes[(v['nature'], compteurs[v['index']])], compteurs[v['index']]) for v in ventes}
+
+    insert_sale_lines(cur, [(user_id, numeros[v['index']][0], ligne.get('numero_item'), ligne.get('quantite'),
+                             ligne.get('prixt'), ligne.get('remarque'), ligne.get('prixbh'), 0)
+                            for v in ventes for ligne in v['lignes']])
+    decrement_stock(cur, [(ligne.get('numero_item'), ligne.get('quantite')) for v in ventes for ligne in v['lignes']])
+
+    # Soldes clients des ventes à terme, appliqués dans l'ordre des ventes comme en les rejouant une à une
+    a_terme = [v for v in ventes if v['a_terme']]
+    if a_terme:
+        cur.execute("SELECT numero_clt, solde FROM client WHERE numero_clt = ANY(%s) FOR UPDATE",
+                    (sorted({v['numero_table'] for v in a_terme}),))
+        soldes = {r['numero_clt']: r['solde'] for r in cur.fetchall()}
+        for v in a_terme:
+            if v['numero_table'] not in soldes:
+                raise Exception(f"Client avec numero_clt={v['numero_table']} non trouvé")
+            solde = soldes[v['numero_table']]
+            current_solde = float(solde) if solde and solde.strip() else 0.0
+            soldes[v['numero_table']] = f"{current_solde + v['solde_change']:.2f}"
+        psycopg2.extras.execute_values(cur, """
+            UPDATE client SET solde = v.solde
+            FROM (VALUES %s) AS v (numero_clt, solde)
+            WHERE client.numero_clt = v.numero_clt
+        """, list(soldes.items()), template="(%s::integer, %s)", page_size=len(soldes))
+    return numeros
+
+def apply_sales_isolating(cur, user_id, ventes, rejeter):
+    """apply_sales sous savepoint ; en cas d'échec, le lot est coupé en deux et
+    chaque moitié réessayée, jusqu'à isoler les ventes fautives (rejetées en 500).
+    Les moitiés sont appliquées dans l'ordre, les compteurs suivent donc l'ordre du lot.
+    """
+    cur.execute("SAVEPOINT ventes_batch")
+    try:
+        numeros = apply_sales(cur, user_id, ventes)
+        cur.execute("RELEASE SAVEPOINT ventes_batch")
+        return numeros
+    except Exception as e:
+        cur.execute("ROLLBACK TO SAVEPOINT ventes_batch")
+        if len(ventes) == 1:
+            rejeter(ventes[0]['index'], 500, str(e))
+            return {}
+    milieu = len(ventes) // 2
+    numeros = apply_sales_isolating(cur, user_id, ventes[:milieu], rejeter)
+    numeros.update(apply_sales_isolating(cur, user_id, ventes[milieu:], rejeter))
+    return numeros
+
+@app.route('/valider_ventes_batch', methods=['POST'])
+@idempotent
+def valider_ventes_batch():
+    """Valide un lot de ventes mises en file par un terminal hors ligne.
+
+    Corps : {"ventes": [...]}, chaque vente au format de /valider_vente.
+    Chaque vente a son résultat (numero_comande ou erreur) à son index dans "resultats".
+    """
+    user_id = validate_user_id()
+    if not isinstance(user_id, str):
+        return user_id  # Retourne l'erreur 401 si user_id est invalide
+
+    data = request.get_json(silent=True)
+    ventes_data = data.get('ventes') if isinstance(data, dict) else None
+    if not isinstance(ventes_data, list) or not ventes_data:
+        return jsonify({"error": "Aucune vente à valider"}), 400
+    if len(ventes_data) > VENTES_BATCH_MAX:
+        return jsonify({"error": f"Lot trop volumineux (max {VENTES_BATCH_MAX} ventes)"}), 400
+
+    resultats = [None] * len(ventes_data)
+
+    def rejeter(index, status, message):
+        resultats[index] = {"index": index, "status": status, "error": message}
+
+    # Validation des ventes, sans base de données (mêmes règles que /valider_vente)
+    ventes = []
+    for index, vente in enumerate(ventes_data):
+        if (not isinstance(vente, dict) or not vente.get('lignes') or 'numero_util' not in vente
+                or 'password2' not in vente):
+            rejeter(index, 400, "Données de vente invalides, utilisateur ou mot de passe manquant")
+            continue
+        numero_table = vente.get('numero_table', 0)
+        payment_mode = vente.get('payment_mode', 'espece')
+        try:
+            amount_paid = float(vente.get('amount_paid', 0))
+        except (TypeError, ValueError):
+            rejeter(index, 400, "Montant versé invalide")
+            continue
+        a_terme = payment_mode == 'a_terme'
+        if a_terme and numero_table == 0:
+            rejeter(index, 400, "Veuillez sélectionner un client pour une vente à terme")
+            continue
+        if a_terme and amount_paid < 0:
+            rejeter(index, 400, "Le montant versé ne peut pas être négatif")
+            continue
+        try:
+            numero_util = int(vente['numero_util'])
+        except (TypeError, ValueError):
+            rejeter(index, 400, "Utilisateur non trouvé")
+            continue
+        solde_change = 0.0
+        if a_terme:
+            try:
+                numero_table = int(numero_table)
+                solde_change = amount_paid - sum(float(ligne.get('prixt', 0)) for ligne in vente['lignes'])
+            except (TypeError, ValueError, AttributeError) as e:
+                rejeter(index, 500, str(e))
+                continue
+        ventes.append({
+            'index': index,
+            'numero_table': numero_table,
+            'date_comande': vente.get('date_comande', datetime.utcnow().isoformat()),
+            'nature': "TICKET" if numero_table == 0 else "BON DE L.",
+            'numero_util': numero_util,
+            'password2': vente['password2'],
+            'lignes': vente['lignes'],
+            'a_terme': a_terme,
+            'solde_change': solde_change,
+        })
+
+    conn = None
+    try:
+        conn = get_conn()
+        conn.autocommit = False
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+
+        # Utilisateurs et mots de passe : une requête pour tout le lot
+        if ventes:
+            cur.execute("SELECT numero_util, password2 FROM utilisateur WHERE numero_util = ANY(%s)",
+                        (sorted({v['numero_util'] for v in ventes}),))
+            passwords = {r['numero_util']: r['password2'] for r in cur.fetchall()}
+        valides = []
+        for v in ventes:
+            if v['numero_util'] not in passwords:
+                rejeter(v['index'], 400, "Utilisateur non trouvé")
+            elif passwords[v['numero_util']] != v['password2']:
+                rejeter(v['index'], 401, "Mot de passe incorrect")
+            else:
+                valides.append(v)
+
+        if valides:
+            numeros = apply_sales_isolating(cur, user_id, valides, rejeter)
+            for index, (numero_comande, compteur) in numeros.items():
+                resultats[index] = {"index": index, "numero_comande": numero_comande, "compteur": compteur}
+
+        validees = sum(1 for r in resultats if 'numero_comande' in r)
+        body = {"resultats": resultats, "validees": validees, "rejetees": len(resultats) - validees}
+        replay = remember_response(cur, body, 200)
+        if replay is not None:
+            conn.rollback()
+            return replay
+        conn.commit()
+        print(f"Lot de ventes: {validees} validées, {len(resultats) - validees} rejetées")
+        return jsonify(body), 200
+
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(f"Erreur validation lot de ventes: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+    finally:
+        if conn:
+            cur.close()
+            conn.close()
+
 @app.route('/client_solde', methods=['GET'])
 def client_solde():
     user_id = validate_user_id()
@@ -1764,6 +3982,8 @@ def modifier_utilisateur(numero_util):
                 (nom, statue, user_id, numero_util)
             )
         if cur.rowcount == 0:
+            cur.close()
+            conn.close()
             return jsonify({'erreur': 'Utilisateur non trouvé'}), 404
         conn.commit()
         cur.close()
@@ -1867,6 +4087,7 @@ def valeur_stock():
             cur.close()
             conn.close()
 @app.route('/valider_reception', methods=['POST'])
+@idempotent
 def valider_reception():
     user_id = validate_user_id()
     if not isinstance(user_id, str):
@@ -1890,7 +4111,7 @@ def valider_reception():
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         # Vérifier l'utilisateur et le mot de passe
-        cur.execute("SELECT Password2 FROM utilisateur WHERE numero_util = %s", (numero_util,))
+        execute_prepared(cur, 'utilisateur_password', (numero_util,))
         utilisateur = cur.fetchone()
         if not utilisateur:
             print(f"Erreur: Utilisateur {numero_util} non trouvé")
@@ -1963,9 +4184,14 @@ def valider_reception():
                     (new_solde_str, numero_four, user_id))
         print(f"Solde fournisseur mis à jour: numero_fou={numero_four}, total_cost={total_cost}, new_solde={new_solde_str}")
 
+        body = {"numero_mouvement": numero_mouvement}
+        replay = remember_response(cur, body, 200)
+        if replay is not None:
+            conn.rollback()
+            return replay
         conn.commit()
         print(f"Réception validée: numero_mouvement={numero_mouvement}, {len(lignes)} lignes")
-        return jsonify({"numero_mouvement": numero_mouvement}), 200
+        return jsonify(body), 200
 
     except Exception as e:
         if conn:
@@ -2084,6 +4310,7 @@ def receptions_jour():
 # --- Versements ---
 
 @app.route('/ajouter_versement', methods=['POST'])
+@idempotent
 def ajouter_versement():
     user_id = validate_user_id()
     if not isinstance(user_id, str):
@@ -2114,7 +4341,7 @@ def ajouter_versement():
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         # Vérifier l'utilisateur et le mot de passe
-        cur.execute("SELECT Password2 FROM utilisateur WHERE numero_util = %s", (numero_util,))
+        execute_prepared(cur, 'utilisateur_password', (numero_util,))
         utilisateur = cur.fetchone()
         if not utilisateur:
             print(f"Erreur: Utilisateur {numero_util} non trouvé")
@@ -2162,9 +4389,14 @@ def ajouter_versement():
         )
         numero_mc = cur.fetchone()['numero_mc']
 
+        body = {"numero_mc": numero_mc, "statut": "Versement ajouté"}
+        replay = remember_response(cur, body, 201)
+        if replay is not None:
+            conn.rollback()
+            return replay
         conn.commit()
         print(f"Versement ajouté: numero_mc={numero_mc}, type={type_versement}, montant={montant}")
-        return jsonify({"numero_mc": numero_mc, "statut": "Versement ajouté"}), 201
+        return jsonify(body), 201
 
     except ValueError:
         return jsonify({"error": "Le montant doit être un nombre valide"}), 400
@@ -2286,7 +4518,7 @@ def annuler_versement():
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         # Vérifier l'utilisateur et le mot de passe
-        cur.execute("SELECT Password2 FROM utilisateur WHERE numero_util = %s", (numero_util,))
+        execute_prepared(cur, 'utilisateur_password', (numero_util,))
         utilisateur = cur.fetchone()
         if not utilisateur:
             print(f"Erreur: Utilisateur {numero_util} non trouvé")
@@ -2377,7 +4609,7 @@ def modifier_versement():
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         # Vérifier l'utilisateur et le mot de passe
-        cur.execute("SELECT Password2 FROM utilisateur WHERE numero_util = %s", (numero_util,))
+        execute_prepared(cur, 'utilisateur_password', (numero_util,))
         utilisateur = cur.fetchone()
         if not utilisateur:
             print(f"Erreur: Utilisateur {numero_util} non trouvé")
@@ -2751,16 +4983,24 @@ def modifier_vente(numero_comande):
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         # Vérifier l'utilisateur et le mot de passe
-        cur.execute("SELECT Password2 FROM utilisateur WHERE numero_util = %s", (numero_util,))
+        execute_prepared(cur, 'utilisateur_password', (numero_util,))
         utilisateur = cur.fetchone()
         if not utilisateur or utilisateur['password2'] != password2:
             return jsonify({"error": "Utilisateur ou mot de passe incorrect"}), 401
 
         # Vérifier l'existence de la commande
         cur.execute("SELECT * FROM comande WHERE numero_comande = %s AND user_id = %s", (numero_comande, user_id))
-        if not cur.fetchone():
+        commande = cur.fetchone()
+        if not commande:
             return jsonify({"error": "Commande non trouvée"}), 404
 
+        # Changement de nature (ticket <-> bon de livraison) : numéro dans la nouvelle série,
+        # l'ancien est rendu s'il était le dernier de la sienne
+        compteur = commande['compteur']
+        if commande['nature'] != nature:
+            release_ticket_number(cur, user_id, commande['nature'], commande['compteur'])
+            compteur = next_ticket_number(cur, user_id, nature)
+
         # Restaurer le stock des anciens articles
         cur.execute("SELECT numero_item, quantite FROM attache WHERE numero_comande = %s AND user_id = %s", (numero_comande, user_id))
         old_lignes = cur.fetchall()
@@ -2774,9 +5014,9 @@ def modifier_vente(numero_comande):
         # Mettre à jour la commande (sans toucher au solde)
         cur.execute("""
             UPDATE comande 
-            SET numero_table = %s, date_comande = %s, nature = %s, numero_util = %s
+            SET numero_table = %s, date_comande = %s, nature = %s, numero_util = %s, compteur = %s
             WHERE numero_comande = %s AND user_id = %s
-        """, (numero_table, date_comande, nature, numero_util, numero_comande, user_id))
+        """, (numero_table, date_comande, nature, numero_util, compteur, numero_comande, user_id))
 
         # Insérer les nouvelles lignes et ajuster le stock
         for ligne in lignes:
@@ -2956,7 +5196,7 @@ def modifier_reception(numero_mouvement):
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         # Vérifier l'utilisateur et le mot de passe
-        cur.execute("SELECT Password2 FROM utilisateur WHERE numero_util = %s", (numero_util,))
+        execute_prepared(cur, 'utilisateur_password', (numero_util,))
         utilisateur = cur.fetchone()
         if not utilisateur:
             print(f"Erreur: Utilisateur {numero_util} non trouvé")
@@ -3339,6 +5579,731 @@ def liste_produits_par_categorie():
         return jsonify({'erreur': str(e)}), 500
 
 
+# ── Chargement en masse (COPY FROM STDIN) ───────────────────────────────────
+MIGRATE_COPY_BATCH = int(os.environ.get('MIGRATE_COPY_BATCH', 50000))   # lignes par COPY
+
+_COPY_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+_COPY_SPECIAL = ('\\', '\t', '\n', '\r')
+
+def copy_text_value(value):
+    """Un champ au format texte de COPY (None devient \\N, booléens t/f)"""
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    return str(value).translate(_COPY_TEXT_ESCAPES)
+
+def copy_text_column(values):
+    """copy_text_value sur une colonne entière, chemins rapides pour les colonnes d'un seul type"""
+    types = set(map(type, values))
+    if types <= {int, float}:
+        return list(map(str, values))
+    if types == {str}:
+        joined = '\x00'.join(values)
+        if not any(c in joined for c in _COPY_SPECIAL):
+            return values
+        return [v.translate(_COPY_TEXT_ESCAPES) for v in values]
+    if types == {bool}:
+        return ['t' if v else 'f' for v in values]
+    return list(map(copy_text_value, values))
+
+def copy_columns(cur, table, columns, values, batch_size=MIGRATE_COPY_BATCH):
+    """Charge des données par colonnes avec COPY table (colonnes) FROM STDIN, batch_size lignes par COPY.
+
+    Le texte COPY est construit colonne par colonne puis assemblé en lignes : un
+    aller-retour par lot au lieu d'un par ligne (executemany).
+    """
+    sql = f"COPY {table} ({columns}) FROM STDIN"
+    row_count = len(values[0])
+    for offset in range(0, row_count, batch_size):
+        text = [copy_text_column(col[offset:offset + batch_size]) for col in values]
+        text[-1] = [v + '\n' for v in text[-1]]
+        buf = io.StringIO()
+        buf.writelines(map('\t'.join, zip(*text)))
+        buf.seek(0)
+        cur.copy_expert(sql, buf)
+
+
+MIGRATE_ITEM_BATCH = int(os.environ.get('MIGRATE_ITEM_BATCH', 5000))   # articles par INSERT
+
+def column_types(cur, table):
+    """{colonne: type} sans modificateur de longueur, pour les casts des INSERT multi-lignes"""
+    cur.execute("""
+        SELECT attname, format_type(atttypid, NULL)
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+    """, (table,))
+    return dict(cur.fetchall())
+
+def insert_rows_returning_ids(cur, table, key_column, columns, types, rows):
+    """INSERT multi-lignes renvoyant la clé générée de chaque ligne, dans l'ordre reçu.
+
+    Les clés sont tirées de la séquence de la colonne clé dans une CTE indexée
+    par la position de la ligne : la correspondance position -> clé ne dépend
+    pas de l'ordre de sortie d'INSERT ... RETURNING. Un aller-retour pour tout.
+    """
+    template = "(%s::int, " + ", ".join(f"%s::{types[col]}" for col in columns) + ")"
+    column_list = ", ".join(columns)
+    sql = f"""
+        WITH v (ord, {column_list}) AS (VALUES %s),
+             k AS (SELECT ord, nextval(pg_get_serial_sequence('{table}', '{key_column}')) AS id FROM v),
+             ins AS (
+                 INSERT INTO {table} ({key_column}, {column_list}) OVERRIDING SYSTEM VALUE
+                 SELECT k.id, {", ".join(f"v.{col}" for col in columns)}
+                 FROM v JOIN k USING (ord)
+                 RETURNING {key_column}
+             )
+        SELECT k.ord, k.id FROM k JOIN ins ON ins.{key_column} = k.id ORDER BY k.ord
+    """
+    returned = psycopg2.extras.execute_values(
+        cur, sql, [(pos,) + tuple(row) for pos, row in enumerate(rows)],
+        template=template, page_size=len(rows), fetch=True)
+    ids = dict(returned)
+    return [ids.get(pos) for pos in range(len(rows))]
+
+
+# Ordre strict d'effacement : enfants avant parents (FK)
+MIGRATE_DELETE_ORDER = [
+    'observation',
+    'item_composition',
+    'mouvementc',
+    'encaisse',
+    'attachetmp',
+    'attache2',
+    'attache',
+    'comande',
+    'cloture',
+    'mouvement',
+    'codebar',
+    'item',
+    '"TABLES"',
+    'client',
+    'fournisseur',
+    'utilisateur',
+    'tva',
+    'categorie',
+    'salle',
+    'tmp',
+]
+
+# ── Conversion des données de migration ─────────────────────────────────────
+def to_str(v, d=''):
+    """String sécurisé"""
+    if v is None: return d
+    return str(v).strip()
+
+def to_int(v, d=0):
+    """Int sécurisé"""
+    if v is None: return d
+    if isinstance(v, int): return v
+    try: return int(float(str(v).replace(',', '.').strip()))
+    except: return d
+
+def to_float(v, d=0.0):
+    """Float sécurisé — gère virgule européenne et espaces"""
+    if v is None: return d
+    if isinstance(v, (int, float)): return float(v)
+    try:
+        x = re.sub(r'[^\d.,-]', '', str(v).strip())
+        x = x.replace(',', '.')
+        parts = x.split('.')
+        if len(parts) > 2:
+            x = parts[0] + '.' + ''.join(parts[1:])
+        return float(x) if x else d
+    except: return d
+
+_TRUE_STRINGS = frozenset(('true', '1', 'yes', 'oui', 'vrai', 'on', 't', 'y'))
+
+def to_bool(v, d=False):
+    """Bool sécurisé"""
+    if isinstance(v, bool): return v
+    if v is None: return d
+    return str(v).lower().strip() in _TRUE_STRINGS
+
+# Conversions par colonne entière : une colonne d'un seul type natif est rendue
+# telle quelle (test de type en C), les chaînes purement numériques prennent un
+# chemin rapide, le reste passe par to_* — résultat identique valeur par valeur.
+# Listes Python plutôt que tableaux NumPy : NumPy n'est pas une dépendance du
+# service, et ces colonnes sont des chaînes à analyser (virgule décimale,
+# espaces, défauts de to_*) que NumPy ne vectoriserait pas sans changer les
+# résultats ; benchmarks/bench_migrate_convert.py mesure le gain.
+
+def _parse_int(v, d):
+    if type(v) is str and v.isdecimal() and len(v) < 16:
+        return int(v)
+    return to_int(v, d)
+
+def _parse_float(v, d):
+    if type(v) is str:
+        x = v.strip().replace(',', '.', 1)
+        # Chiffres, au plus un séparateur décimal et un signe : float() donne le résultat de to_float
+        if x.replace('.', '', 1).replace('-', '', 1).isdecimal():
+            try:
+                return float(x)
+            except ValueError:
+                pass
+    return to_float(v, d)
+
+def str_column(values, d=''):
+    if set(map(type, values)) == {str}:
+        return list(map(str.strip, values))
+    return [v.strip() if type(v) is str else to_str(v, d) for v in values]
+
+def int_column(values, d=0):
+    if set(map(type, values)) == {int}:
+        return list(values)
+    return [v if type(v) is int else _parse_int(v, d) for v in values]
+
+def float_column(values, d=0.0):
+    types = set(map(type, values))
+    if types == {float}:
+        return list(values)
+    if types <= {int, float}:
+        return list(map(float, values))
+    return [v if type(v) is float else _parse_float(v, d) for v in values]
+
+def bool_column(values, d=False):
+    if set(map(type, values)) == {bool}:
+        return list(values)
+    return [v if type(v) is bool else d if v is None else str(v).lower().strip() in _TRUE_STRINGS
+            for v in values]
+
+def raw_column(values, d=None):
+    return list(values)
+
+MIGRATE_COLUMN_KINDS = {
+    's': str_column,
+    'i': int_column,
+    'f': float_column,
+    'b': bool_column,
+    'raw': raw_column,   # dates/heures transmises telles quelles
+}
+
+# Tables de la migration dans l'ordre des dépendances : (clé data, table, champs).
+# Champ : (colonne, type[, défaut]) ; user_id est ajouté en dernière colonne.
+# 'item_ref' : numero_item local (lu dans bar_local_id) traduit vers le numero_item cloud.
+MIGRATE_PLAN = [
+    # ── Niveau 1 — pas de FK vers d'autres tables user ──────────────────
+    ('categorie', 'categorie', [('description_c', 's')]),
+    ('salle', 'salle', [('description_s', 's')]),
+    ('utilisateur', 'utilisateur',
+        [('nom', 's'), ('statue', 's', 'emplo'), ('password2', 's', '1234')] +
+        [(f'o{j}', 'b') for j in range(1, 11)] +
+        [(f'o{j}', 'b', True) for j in range(11, 31)]),
+    ('tva', 'tva', [('tva', 'i')]),
+    ('fournisseur', 'fournisseur',
+        [(c, 's') for c in ('reference', 'nom', 'adresse', 'post', 'ville', 'pays', 'contact', 'tel1',
+                            'tel2', 'fax', 'rem', 'banc', 'idfis', 'ai', 'nis', 'rc', 'solde',
+                            'm1', 'm2', 'm3', 'm4', 'm5')] +
+        [('exonore', 'b')]),
+    ('client', 'client',
+        [(c, 's') for c in ('reference', 'nom', 'adresse', 'post', 'ville', 'pays', 'contact', 'tel1',
+                            'tel2', 'fax', 'rem')] +
+        [('catp', 'i')] +
+        [(c, 's') for c in ('banc', 'idfis', 'ai', 'nis', 'rc', 'solde', 'smax', 'm1', 'm2', 'm3', 'm4', 'm5')] +
+        [('exonore', 'b')]),
+
+    # ── Niveau 2 — dépendent de niveau 1 ────────────────────────────────
+    ('tables', '"TABLES"',
+        [('numero_salle', 'i'), ('position_x', 'i'), ('position_y', 'i'),
+         ('description_t', 's'), ('etat', 's')]),
+    # local_id (mapping vers le numero_item cloud) est lu à part par MigrationLoader
+    ('item', 'item',
+        [('numero_categorie', 'i'), ('ref', 's'), ('designation', 's', 'Article'),
+         ('prix', 's'), ('prixb', 's'), ('prixvh', 's'), ('qte', 'f'), ('qtea', 'i'),
+         ('model', 's'), ('remarque', 's'), ('numero_fou', 'i'), ('tva', 'i'), ('bar', 's'),
+         ('prix2', 's'), ('prix3', 's'), ('prix4', 's'), ('prix5', 's'), ('tvav', 's'), ('prixba', 's'),
+         ('exp', 'raw'), ('debut', 'raw'), ('fin', 'raw'), ('promo', 's'),
+         ('m1', 's'), ('m2', 's'), ('m3', 's'), ('m4', 's'), ('m5', 's'),
+         ('disponible', 'b', True), ('gere', 'b'), ('temp_fabrication', 'i')]),
+    ('codebar', 'codebar', [('bar', 'item_ref'), ('bar2', 's')]),
+    ('mouvement', 'mouvement',
+        [('date_m', 'raw'), ('etat_m', 's'), ('numero_four', 'i'), ('refdoc', 's'), ('vers', 's'),
+         ('nature', 's'), ('connection1', 'i'), ('numero_util', 'i'), ('cheque', 's')]),
+    ('cloture', 'cloture', [('date_cloture', 'raw'), ('prelevement', 's'), ('fondcaisse', 's')]),
+
+    # ── Niveau 3 — dépendent de niveau 2 ────────────────────────────────
+    ('comande', 'comande',
+        [('numero_table', 'i'), ('date_comande', 'raw'), ('etat_c', 's'), ('connection1', 'i'),
+         ('numero_util', 'i'), ('nature', 's'), ('compteur', 'i'), ('cheque', 's')]),
+
+    # ── Niveau 4 — dépendent de niveau 3 ────────────────────────────────
+    ('attache', 'attache',
+        [('numero_comande', 'i'), ('numero_item', 'i'), ('quantite', 'f'), ('prixt', 's'),
+         ('remarque', 's'), ('bnfc', 's'), ('marge', 's'), ('prixbh', 's'), ('achatfx', 's'), ('send', 'b')]),
+    ('attache2', 'attache2',
+        [('numero_item', 'i'), ('numero_mouvement', 'i'), ('qtea', 'f'), ('nqte', 'f'),
+         ('nprix', 's'), ('pump', 's'), ('send', 'b')]),
+    ('attachetmp', 'attachetmp',
+        [('numero_comande', 'i'), ('numero_item', 'i'), ('quantite', 'f'), ('prixt', 's'),
+         ('remarque', 's'), ('bnfc', 's'), ('marge', 's'), ('prixbh', 's'), ('achatfx', 's'), ('send', 'b')]),
+    ('encaisse', 'encaisse',
+        [('apaye', 's'), ('reglement', 's'), ('tva', 's'), ('ht', 's'), ('numero_comande', 'i'),
+         ('numero_cloture', 'i'), ('time_enc', 'raw'), ('origine', 's'), ('solder', 's')]),
+    ('item_composition', 'item_composition',
+        [('numero_item', 'i'), ('numero_item_cmp', 'i'), ('designation_cmp', 's'), ('quantite_cmp', 'f'),
+         ('prixbh_cmp', 's'), ('prixt_cmp', 's'), ('remarque_cmp', 's'), ('send_cmp', 'b'), ('m1_cmp', 's')]),
+    ('mouvementc', 'mouvementc',
+        [('date_mc', 'raw'), ('time_mc', 'raw'), ('montant', 's'), ('justificatif', 's'),
+         ('numero_util', 'i'), ('origine', 's'), ('cf', 's'), ('numero_cf', 'i')]),
+    ('observation', 'observation', [('numero_comande', 'i'), ('doc', 's'), ('texts', 's')]),
+    ('tmp', 'tmp',
+        [(f'{p}{j}', 's') for p in ('v', 'f', 'r') for j in range(1, 11)]),
+]
+
+def compile_table_converter(fields):
+    """Compile une spécification de champs en convert(rows, user_id, item_id_map) -> liste de colonnes.
+
+    Les rows sont découpées en colonnes converties une à une : le choix de la
+    conversion et la recherche du défaut se font une fois par colonne et non par
+    valeur ; user_id est la dernière colonne.
+    """
+    plan = []
+    for field in fields:
+        column, kind = field[0], field[1]
+        if kind == 'item_ref':
+            plan.append(('bar_local_id', None, None))
+            continue
+        default = field[2] if len(field) > 2 else MIGRATE_COLUMN_KINDS[kind].__defaults__[0]
+        plan.append((column, MIGRATE_COLUMN_KINDS[kind], default))
+    plan = [(source, operator.itemgetter(source), convert_column, default)
+            for source, convert_column, default in plan]
+
+    def convert(rows, user_id, item_id_map):
+        columns = []
+        for source, get_source, convert_column, default in plan:
+            try:
+                values = list(map(get_source, rows))
+            except KeyError:
+                values = [r.get(source) for r in rows]
+            if convert_column is None:
+                columns.append([str(item_id_map.get(local_id, local_id)) for local_id in int_column(values)])
+            else:
+                columns.append(convert_column(values, default))
+        columns.append([user_id] * len(rows))
+        return columns
+
+    return convert
+
+MIGRATE_TABLES = [
+    (key, table, ','.join(field[0] for field in fields) + ',user_id', compile_table_converter(fields))
+    for key, table, fields in MIGRATE_PLAN
+]
+
+# Niveaux de dépendance : les tables d'un niveau se chargent en parallèle, le
+# niveau suivant démarre une fois le précédent commité (codebar attend item).
+MIGRATE_LEVELS = [
+    ['categorie', 'salle', 'utilisateur', 'tva', 'fournisseur', 'client'],
+    ['tables', 'item', 'mouvement', 'cloture'],
+    ['codebar', 'comande'],
+    ['attache', 'attache2', 'attachetmp', 'encaisse', 'item_composition', 'mouvementc', 'observation', 'tmp'],
+]
+MIGRATE_WORKERS = int(os.environ.get('MIGRATE_WORKERS', 1))   # connexions de chargement par niveau
+# Connexions de chargement simultanées, toutes migrations confondues : le reste
+# du pool reste disponible pour les autres requêtes
+MIGRATE_MAX_CONNECTIONS = int(os.environ.get('MIGRATE_MAX_CONNECTIONS', max(1, DB_POOL_MAX // 2)))
+_migrate_slots = threading.BoundedSemaphore(MIGRATE_MAX_CONNECTIONS)
+
+MIGRATE_MODES = ('reload', 'sync')
+
+# Clé naturelle par table pour le mode sync ; à défaut, la ligne entière
+MIGRATE_SYNC_KEYS = {
+    'categorie':   ('description_c',),
+    'salle':       ('description_s',),
+    'utilisateur': ('nom',),
+    'tva':         ('tva',),
+    'fournisseur': ('reference', 'nom'),
+    'client':      ('reference', 'nom'),
+    '"TABLES"':    ('numero_salle', 'description_t'),
+    'item':        ('ref',),
+    'codebar':     ('bar2',),
+}
+
+def table_primary_key(cur, table):
+    """(colonne, séquence) de la clé primaire simple de `table`, None sans clé à séquence"""
+    cur.execute("""
+        SELECT a.attname, pg_get_serial_sequence(%s, a.attname)
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND i.indisprimary
+    """, (table, table))
+    rows = cur.fetchall()
+    return rows[0] if len(rows) == 1 and rows[0][1] else None
+
+
+class MigrationLoader:
+    """Charge les rows de migration d'un utilisateur, table par table, dans l'ordre des dépendances.
+
+    load() peut être appelé plusieurs fois par table (lots en flux) : compteurs,
+    erreurs, durées et mapping numero_item local -> cloud se cumulent d'un appel
+    à l'autre. Avec autocommit=False rien n'est commité et une table en échec
+    lève une exception : l'appelant applique un chunk entier de façon atomique.
+
+    Avec sync=True les rows passent par une table de staging et, une fois la
+    table complète, sont appariées aux lignes existantes par clé naturelle
+    (MIGRATE_SYNC_KEYS) : lignes modifiées mises à jour, nouvelles insérées, et
+    lignes absentes de la source supprimées par finish(), enfants d'abord.
+    """
+
+    def __init__(self, conn, user_id, autocommit=True, item_id_map=None, sync=False):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.user_id = user_id
+        self.autocommit = autocommit
+        self.sync = sync
+        self.sync_stats = {}
+        self._staged = {}           # clé data -> lignes en staging
+        self._staged_local_ids = []
+        self._pending_sync = None
+        self._synced_pks = {}       # table -> colonne clé primaire
+        self.item_id_map = {} if item_id_map is None else item_id_map
+        self.new_item_ids = {}    # mapping ajouté par ce loader
+        self.plan = MIGRATE_TABLES
+        self.tables = {key: (table, columns, convert) for key, table, columns, convert in self.plan}
+        self.results = {}
+        self.errors = {}
+        self.timings = {}    # table -> [lignes, secondes]
+
+    def _bulk_load(self):
+        """Journal des exports réduit à une entrée 'R' par instruction pour la transaction en cours"""
+        self.cur.execute("SELECT set_config('export.bulk_load', 'on', true)")
+
+    def clear(self):
+        self._bulk_load()
+        for tbl in MIGRATE_DELETE_ORDER:
+            self.cur.execute(f'DELETE FROM {tbl} WHERE user_id = %s', (self.user_id,))
+        reset_ticket_counters(self.cur, self.user_id)
+        if self.autocommit:
+            self.conn.commit()
+
+    def _timed(self, table, rows, start):
+        timing = self.timings.setdefault(table, [0, 0.0])
+        timing[0] += rows
+        timing[1] += _time.monotonic() - start
+
+    def load(self, key, rows):
+        """Convertit puis charge une liste de rows de la clé data `key`, commit compris."""
+        table, columns, convert = self.tables[key]
+        self.results.setdefault(table, 0)
+        if self.sync and self._pending_sync not in (None, key):
+            self._apply_sync(self._pending_sync)
+        start = _time.monotonic()
+        valid = [r for r in rows if isinstance(r, dict)]
+        if len(valid) < len(rows):
+            logger.warning(f"[{table}] {len(rows) - len(valid)} ligne(s) ignorée(s) : objet attendu")
+        if self.sync:
+            # Une table présente mais vide est mise en staging quand même : toutes ses
+            # lignes existantes deviennent orphelines et sont supprimées
+            if table in self.errors:
+                return
+            vals = convert(valid, self.user_id, self.item_id_map)
+            local_ids = int_column([r.get('local_id') for r in valid]) if table == 'item' else None
+            self._load_staged(key, table, columns, vals, local_ids)
+            self._timed(table, len(valid), start)
+            return
+        if not valid:
+            return
+        vals = convert(valid, self.user_id, self.item_id_map)
+        self._bulk_load()
+        if table == 'item':
+            vals = list(zip(int_column([r.get('local_id') for r in valid]), zip(*vals)))
+            self.results[table] += self._load_items(columns, vals)
+            if self.autocommit:
+                self.conn.commit()
+            self._timed(table, len(vals), start)
+            return
+        try:
+            copy_columns(self.cur, table, columns, vals)
+            if table == 'comande':
+                reset_ticket_counters(self.cur, self.user_id)
+            if self.autocommit:
+                self.conn.commit()
+            self.results[table] += len(valid)
+            self._timed(table, len(valid), start)
+        except Exception as e:
+            if not self.autocommit:
+                raise
+            self.conn.rollback()
+            logger.error(f"[{table}] COPY erreur: {e}")
+            self.errors[table] = f"ERR: {str(e)[:120]}"
+
+    def _load_staged(self, key, table, columns, vals, local_ids):
+        """COPY vers la table temporaire sync_stage_<clé>, numérotée dans l'ordre reçu (_ord)"""
+        stage = f'sync_stage_{key}'
+        try:
+            if key not in self._staged:
+                self.cur.execute(f'DROP TABLE IF EXISTS {stage}')
+                self.cur.execute(f'CREATE TEMP TABLE {stage} AS '
+                                 f'SELECT {columns}, 0::bigint AS _ord FROM {table} WITH NO DATA')
+                self._staged[key] = 0
+            first = self._staged[key]
+            count = len(vals[0])
+            copy_columns(self.cur, stage, columns + ',_ord', vals + [list(range(first, first + count))])
+            if self.autocommit:
+                self.conn.commit()
+        except Exception as e:
+            if not self.autocommit:
+                raise
+            self.conn.rollback()
+            self._staged.pop(key, None)
+            logger.error(f"[{table}] COPY erreur: {e}")
+            self.errors[table] = f"ERR: {str(e)[:120]}"
+            return
+        self._staged[key] += count
+        if local_ids is not None:
+            self._staged_local_ids.extend(local_ids)
+        self._pending_sync = key
+
+    def _apply_sync(self, key):
+        """Apparie staging et lignes existantes par clé naturelle puis UPDATE (si différent) / INSERT.
+
+        Les doublons d'une même clé sont appariés dans l'ordre (_ord côté source,
+        clé primaire côté base) ; les lignes existantes sans correspondance sont
+        notées dans sync_delete et supprimées par finish(). Une table sans clé
+        primaire (rien ne peut la référencer) est appariée par ctid et ses lignes
+        orphelines supprimées dans la même transaction.
+        """
+        self._pending_sync = None
+        table, columns, _ = self.tables[key]
+        if table in self.errors:
+            return
+        stage = f'sync_stage_{key}'
+        cols = columns.split(',')
+        key_expr = f"ROW({', '.join(MIGRATE_SYNC_KEYS.get(table, cols))})::text"
+        source_cols = ', '.join(f's.{c}' for c in cols)
+        target_cols = ', '.join(f't.{c}' for c in cols)
+        cur = self.cur
+        try:
+            self._bulk_load()
+            primary_key = table_primary_key(cur, table)
+            pk, sequence = primary_key or ('ctid', None)
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS sync_delete (tbl text, pk bigint)")
+            cur.execute("DROP TABLE IF EXISTS sync_pairs")
+            cur.execute(f"""
+                CREATE TEMP TABLE sync_pairs AS
+                SELECT s._ord, d.pk, d.pk IS NULL AS is_new
+                FROM (SELECT _ord, {key_expr} AS k,
+                             row_number() OVER (PARTITION BY {key_expr} ORDER BY _ord) AS rn
+                      FROM {stage}) s
+                FULL JOIN (SELECT {pk} AS pk, {key_expr} AS k,
+                                  row_number() OVER (PARTITION BY {key_expr} ORDER BY {pk}) AS rn
+                           FROM {table} WHERE user_id = %s) d
+                  ON s.k = d.k AND s.rn = d.rn
+            """, (self.user_id,))
+            if primary_key:
+                # Clés des nouvelles lignes tirées dans l'ordre source
+                cur.execute("""
+                    UPDATE sync_pairs p SET pk = n.id
+                    FROM (SELECT _ord, nextval(%s) AS id
+                          FROM (SELECT _ord FROM sync_pairs WHERE is_new ORDER BY _ord) o) n
+                    WHERE p._ord = n._ord
+                """, (sequence,))
+            else:
+                cur.execute(f"""
+                    DELETE FROM {table} t USING sync_pairs p
+                    WHERE t.ctid = p.pk AND p._ord IS NULL
+                """)
+                orphans = cur.rowcount
+            cur.execute(f"""
+                UPDATE {table} t SET ({columns}) = ROW({source_cols})
+                FROM sync_pairs p JOIN {stage} s USING (_ord)
+                WHERE t.{pk} = p.pk AND NOT p.is_new AND ROW({target_cols}) IS DISTINCT FROM ROW({source_cols})
+            """)
+            updated = cur.rowcount
+            cur.execute(f"""
+                INSERT INTO {table} ({pk + ', ' if primary_key else ''}{columns}) OVERRIDING SYSTEM VALUE
+                SELECT {'p.pk, ' if primary_key else ''}{source_cols}
+                FROM sync_pairs p JOIN {stage} s USING (_ord)
+                WHERE p.is_new
+                ORDER BY p._ord
+            """)
+            inserted = cur.rowcount
+            if table == 'comande':
+                reset_ticket_counters(cur, self.user_id)
+            if primary_key:
+                cur.execute("INSERT INTO sync_delete (tbl, pk) SELECT %s, pk FROM sync_pairs WHERE _ord IS NULL",
+                            (table,))
+                orphans = cur.rowcount
+            if table == 'item':
+                cur.execute("SELECT _ord, pk FROM sync_pairs WHERE _ord IS NOT NULL")
+                for ord_, cloud_id in cur.fetchall():
+                    local_id = self._staged_local_ids[ord_]
+                    if local_id:
+                        self.item_id_map[local_id] = cloud_id
+                        self.new_item_ids[local_id] = cloud_id
+            cur.execute(f"DROP TABLE sync_pairs, {stage}")
+            if self.autocommit:
+                self.conn.commit()
+        except Exception as e:
+            if not self.autocommit:
+                raise
+            self.conn.rollback()
+            logger.error(f"[{table}] sync erreur: {e}")
+            self.errors[table] = f"ERR: {str(e)[:120]}"
+            return
+        self._staged.pop(key, None)
+        self.results[table] += inserted   # lignes mises à jour ou inchangées : voir sync_stats
+        if primary_key:
+            self._synced_pks[table] = pk
+            self.sync_stats[table] = {'inserees': inserted, 'maj': updated, 'a_supprimer': orphans}
+        else:
+            self.sync_stats[table] = {'inserees': inserted, 'maj': updated, 'supprimees': orphans}
+
+    def finish(self):
+        """Mode sync : applique la dernière table puis supprime les lignes absentes de la source"""
+        if not self.sync:
+            return
+        if self._pending_sync:
+            self._apply_sync(self._pending_sync)
+        if not self._synced_pks:
+            return
+        self._bulk_load()
+        for tbl in MIGRATE_DELETE_ORDER:
+            pk = self._synced_pks.get(tbl)
+            if not pk:
+                continue
+            self.cur.execute(f"""
+                DELETE FROM {tbl} t USING sync_delete d
+                WHERE d.tbl = %s AND t.{pk} = d.pk AND t.user_id = %s
+            """, (tbl, self.user_id))
+            stats = self.sync_stats[tbl]
+            stats['supprimees'] = self.cur.rowcount
+            del stats['a_supprimer']
+        self.cur.execute("DROP TABLE sync_delete")
+        if self.autocommit:
+            self.conn.commit()
+
+    def _load_items(self, columns, item_rows):
+        """INSERT multi-lignes par lots ; un lot refusé est rejoué ligne par ligne.
+        Retourne le nombre d'articles insérés."""
+        cur = self.cur
+        inserted = 0
+        item_columns = [c.strip() for c in columns.split(',')]
+        item_types = column_types(cur, 'item')
+        for offset in range(0, len(item_rows), MIGRATE_ITEM_BATCH):
+            chunk = item_rows[offset:offset + MIGRATE_ITEM_BATCH]
+            cur.execute("SAVEPOINT item_batch")
+            try:
+                ids = insert_rows_returning_ids(cur, 'item', 'numero_item', item_columns, item_types,
+                                                [values for _, values in chunk])
+                cur.execute("RELEASE SAVEPOINT item_batch")
+            except psycopg2.Error as e:
+                # Lot refusé : ligne par ligne pour n'écarter que les articles invalides
+                cur.execute("ROLLBACK TO SAVEPOINT item_batch")
+                logger.warning(f"item lot refusé, insertion ligne par ligne: {e}")
+                ids = []
+                for _, values in chunk:
+                    cur.execute("SAVEPOINT item_row")
+                    try:
+                        ids.extend(insert_rows_returning_ids(cur, 'item', 'numero_item', item_columns,
+                                                             item_types, [values]))
+                        cur.execute("RELEASE SAVEPOINT item_row")
+                    except psycopg2.Error as row_error:
+                        cur.execute("ROLLBACK TO SAVEPOINT item_row")
+                        logger.warning(f"item insert: {row_error}")
+                        ids.append(None)
+            for (local_id, _), cloud_id in zip(chunk, ids):
+                if cloud_id is None:
+                    continue
+                inserted += 1
+                if local_id:
+                    self.item_id_map[local_id] = cloud_id
+                    self.new_item_ids[local_id] = cloud_id
+        return inserted
+
+    def merge(self, other):
+        """Ajoute les compteurs d'un loader de table (chargement parallèle)"""
+        for table, count in other.results.items():
+            self.results[table] = self.results.get(table, 0) + count
+        self.errors.update(other.errors)
+        for table, (rows, seconds) in other.timings.items():
+            timing = self.timings.setdefault(table, [0, 0.0])
+            timing[0] += rows
+            timing[1] += seconds
+        self.new_item_ids.update(other.new_item_ids)
+
+    def summary(self):
+        inserts = {k: v for k, v in self.results.items() if k not in self.errors}
+        rates = {k: round(rows / max(seconds, 1e-6)) for k, (rows, seconds) in self.timings.items()}
+        return {
+            'statut':         'OK',
+            'user_id':        self.user_id,
+            'total_inserted': sum(inserts.values()),
+            'par_table':      inserts,
+            'lignes_par_seconde': rates,
+            'erreurs':        dict(self.errors),
+            **({'mode': 'sync', 'sync': self.sync_stats} if self.sync else {}),
+        }
+
+    def close(self):
+        if self.sync:
+            # Tables temporaires : la connexion retourne au pool
+            try:
+                self.conn.rollback()
+                for key in self._staged:
+                    self.cur.execute(f'DROP TABLE IF EXISTS sync_stage_{key}')
+                self.cur.execute('DROP TABLE IF EXISTS sync_pairs, sync_delete')
+                self.conn.commit()
+            except psycopg2.Error:
+                pass
+        self.cur.close()
+
+
+def load_migration_table(user_id, key, rows, item_id_map):
+    """Charge une table sur sa propre connexion du pool ; renvoie le loader (compteurs)"""
+    conn = get_pool().getconn()
+    conn.autocommit = False
+    loader = MigrationLoader(conn, user_id, item_id_map=item_id_map)
+    try:
+        loader.load(key, rows)
+        return loader
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        loader.close()
+        conn.close()
+
+def load_migration_levels(loader, data, workers):
+    """Charge data niveau par niveau, tables d'un même niveau en parallèle.
+
+    Chaque table a sa connexion et sa transaction ; l'item_id_map du loader est
+    partagé (écrit par item, lu par codebar au niveau suivant).
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='migrate') as executor:
+        for level in MIGRATE_LEVELS:
+            futures = []
+            for key in level:
+                rows = data.get(key, [])
+                if rows:
+                    futures.append(executor.submit(load_migration_table, loader.user_id, key, rows,
+                                                   loader.item_id_map))
+                else:
+                    loader.load(key, rows)
+            for future in futures:
+                loader.merge(future.result())
+
+def acquire_loader_slots(wanted):
+    """Réserve sans attendre jusqu'à wanted connexions de chargement ; renvoie le nombre obtenu"""
+    got = 0
+    while got < wanted and _migrate_slots.acquire(blocking=False):
+        got += 1
+    return got
+
+def release_loader_slots(count):
+    for _ in range(count):
+        _migrate_slots.release()
+
+def migrate_worker_count(req):
+    """workers du corps JSON, sinon MIGRATE_WORKERS ; borné par le pool hors connexion de la requête"""
+    workers = req.get('workers')
+    if not isinstance(workers, int):
+        workers = MIGRATE_WORKERS
+    return max(1, min(workers, get_pool().maxconn - 1))
+
+
 @app.route('/migrate_receive', methods=['POST'])
 def migrate_receive():
 
@@ -3352,380 +6317,518 @@ def migrate_receive():
         return jsonify({'error': 'data vide'}), 400
 
     clear = req.get('clear', True)   # False pour les chunks suivants
-
-    # ── Helpers de conversion ────────────────────────────────────────────────
-    def s(v, d=''):
-        """String sécurisé"""
-        if v is None: return d
-        return str(v).strip()
-
-    def i(v, d=0):
-        """Int sécurisé"""
-        if v is None: return d
-        if isinstance(v, int): return v
-        try: return int(float(str(v).replace(',', '.').strip()))
-        except: return d
-
-    def f(v, d=0.0):
-        """Float sécurisé — gère virgule européenne et espaces"""
-        if v is None: return d
-        if isinstance(v, (int, float)): return float(v)
-        try:
-            x = re.sub(r'[^\d.,-]', '', str(v).strip())
-            x = x.replace(',', '.')
-            parts = x.split('.')
-            if len(parts) > 2:
-                x = parts[0] + '.' + ''.join(parts[1:])
-            return float(x) if x else d
-        except: return d
-
-    def b(v, d=False):
-        """Bool sécurisé"""
-        if isinstance(v, bool): return v
-        if v is None: return d
-        return str(v).lower().strip() in ('true', '1', 'yes', 'oui', 'vrai', 'on', 't', 'y')
+    mode  = req.get('mode', 'reload')  # 'sync' : upsert par clé naturelle, sans effacement
+    if mode not in MIGRATE_MODES:
+        return jsonify({'error': f"mode invalide: {mode}"}), 400
 
     # ── Ouverture connexion ─────────────────────────────────────────────────
     conn = get_conn()
     conn.autocommit = False
-    cur  = conn.cursor()
-    results = {}
+    loader = MigrationLoader(conn, user_id, sync=mode == 'sync')
 
     try:
-        # ════════════════════════════════════════════════════════════════════
         # ÉTAPE 1 — EFFACER toutes les données de cet utilisateur
-        # Ordre strict : enfants avant parents (FK)
-        # ════════════════════════════════════════════════════════════════════
-        delete_order = [
-            'observation',
-            'item_composition',
-            'mouvementc',
-            'encaisse',
-            'attachetmp',
-            'attache2',
-            'attache',
-            'comande',
-            'cloture',
-            'mouvement',
-            'codebar',
-            'item',
-            '"TABLES"',
-            'client',
-            'fournisseur',
-            'utilisateur',
-            'tva',
-            'categorie',
-            'salle',
-            'tmp',
-        ]
-        if clear:
-            for tbl in delete_order:
-                cur.execute(f'DELETE FROM {tbl} WHERE user_id = %s', (user_id,))
-            conn.commit()
+        if mode == 'sync':
+            logger.info(f"[migrate_receive] Mode sync pour user_id={user_id}")
+        elif clear:
+            loader.clear()
             logger.info(f"[migrate_receive] Tables effacées pour user_id={user_id}")
         else:
             logger.info(f"[migrate_receive] Mode chunk — pas d'effacement")
 
-        # ════════════════════════════════════════════════════════════════════
-        # ÉTAPE 2 — INSÉRER par table, en batch (executemany)
-        # ════════════════════════════════════════════════════════════════════
+        # ÉTAPE 2 — INSÉRER par table, dans l'ordre des dépendances (COPY) ;
+        # en rechargement, les tables d'un même niveau en parallèle
+        workers = migrate_worker_count(req)
+        parallel = mode != 'sync' and workers > 1
+        slots = acquire_loader_slots(workers) if parallel else 0
+        try:
+            if parallel and slots < workers:
+                logger.info(f"[migrate_receive] {slots}/{workers} connexions de chargement disponibles")
+            if slots < 2:
+                for key, *_ in loader.plan:
+                    # En sync, une clé absente laisse la table intacte ; présente et vide, elle la vide
+                    if mode != 'sync' or key in data:
+                        loader.load(key, data.get(key) or [])
+            else:
+                load_migration_levels(loader, data, slots)
+        finally:
+            release_loader_slots(slots)
 
-        def batch(key, rows, sql, val_fn):
-            """Insère une liste de rows en une seule transaction."""
-            if not rows:
-                results[key] = 0
-                return
-            vals = []
-            for r in rows:
-                try:
-                    vals.append(val_fn(r))
-                except Exception as e:
-                    logger.warning(f"[{key}] val_fn ignorée: {e}")
-            if not vals:
-                results[key] = 0
-                return
+        loader.finish()
+        summary = loader.summary()
+        logger.info(f"[migrate_receive] OK — {summary['total_inserted']} lignes insérées pour user_id={user_id}")
+        return jsonify(summary), 200
+
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"[migrate_receive] ERREUR: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+    finally:
+        loader.close()
+        conn.close()
+
+
+MIGRATE_STREAM_BATCH = int(os.environ.get('MIGRATE_STREAM_BATCH', 5000))   # lignes tamponnées par table
+
+@app.route('/migrate_receive/stream', methods=['POST'])
+def migrate_receive_stream():
+    """Migration en flux NDJSON : une ligne JSON par enregistrement.
+
+    Chaque ligne est {"table": "<clé data>", "row": {...}} ; les tables arrivent
+    dans l'ordre des dépendances (item avant codebar), chacune d'un seul tenant :
+    une table qui réapparaît après une autre est refusée (400). Une ligne
+    {"table": "<clé>"} sans "row" déclare une table vide (en sync, ses lignes
+    cloud sont supprimées). Les lignes sont chargées
+    par lots de MIGRATE_STREAM_BATCH : la mémoire reste bornée quelle que soit
+    la taille de la base envoyée. Tout le flux, effacement compris, est une seule
+    transaction : une ligne invalide ou une table en échec n'en laisse rien.
+    """
+    user_id = request.args.get('user_id') or request.headers.get('X-User-ID')
+    if not user_id:
+        return jsonify({'error': 'user_id requis'}), 400
+    clear = request.args.get('clear', 'true').lower() not in ('0', 'false', 'non', 'no')
+    mode = request.args.get('mode', 'reload')
+    if mode not in MIGRATE_MODES:
+        return jsonify({'error': f"mode invalide: {mode}"}), 400
+
+    conn = get_conn()
+    conn.autocommit = False
+    loader = MigrationLoader(conn, user_id, autocommit=False, sync=mode == 'sync')
+    pending_key, pending = None, []
+    done = set()    # tables terminées : elles ne peuvent plus réapparaître
+    line_no = 0
+
+    def reject(message):
+        conn.rollback()
+        return jsonify({'error': message}), 400
+
+    try:
+        if clear and mode != 'sync':
+            loader.clear()
+            logger.info(f"[migrate_receive/stream] Tables effacées pour user_id={user_id}")
+
+        for line_no, line in enumerate(request.stream, 1):
+            line = line.strip()
+            if not line:
+                continue
             try:
-                cur.executemany(sql, vals)
-                conn.commit()
-                results[key] = len(vals)
-            except Exception as e:
-                conn.rollback()
-                logger.error(f"[{key}] INSERT erreur: {e}")
-                results[key] = f"ERR: {str(e)[:120]}"
-
-        # ── Niveau 1 — pas de FK vers d'autres tables user ──────────────────
-
-        batch('categorie', data.get('categorie', []),
-            "INSERT INTO categorie (description_c, user_id) VALUES (%s,%s)",
-            lambda r: (s(r.get('description_c')), user_id))
-
-        batch('salle', data.get('salle', []),
-            "INSERT INTO salle (description_s, user_id) VALUES (%s,%s)",
-            lambda r: (s(r.get('description_s')), user_id))
-
-        batch('utilisateur', data.get('utilisateur', []),
-            """INSERT INTO utilisateur
-               (nom,statue,password2,
-                o1,o2,o3,o4,o5,o6,o7,o8,o9,o10,
-                o11,o12,o13,o14,o15,o16,o17,o18,o19,o20,
-                o21,o22,o23,o24,o25,o26,o27,o28,o29,o30,
-                user_id)
-               VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,
-                       %s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,
-                       %s,%s,%s,%s,%s,%s,%s,%s)""",
-            lambda r: (
-                s(r.get('nom')), s(r.get('statue'), 'emplo'), s(r.get('password2'), '1234'),
-                b(r.get('o1')),  b(r.get('o2')),  b(r.get('o3')),  b(r.get('o4')),
-                b(r.get('o5')),  b(r.get('o6')),  b(r.get('o7')),  b(r.get('o8')),
-                b(r.get('o9')),  b(r.get('o10')),
-                b(r.get('o11'), True), b(r.get('o12'), True), b(r.get('o13'), True),
-                b(r.get('o14'), True), b(r.get('o15'), True), b(r.get('o16'), True),
-                b(r.get('o17'), True), b(r.get('o18'), True), b(r.get('o19'), True),
-                b(r.get('o20'), True), b(r.get('o21'), True), b(r.get('o22'), True),
-                b(r.get('o23'), True), b(r.get('o24'), True), b(r.get('o25'), True),
-                b(r.get('o26'), True), b(r.get('o27'), True), b(r.get('o28'), True),
-                b(r.get('o29'), True), b(r.get('o30'), True),
-                user_id))
-
-        batch('tva', data.get('tva', []),
-            "INSERT INTO tva (tva, user_id) VALUES (%s,%s)",
-            lambda r: (i(r.get('tva')), user_id))
-
-        batch('fournisseur', data.get('fournisseur', []),
-            """INSERT INTO fournisseur
-               (reference,nom,adresse,post,ville,pays,contact,tel1,tel2,fax,
-                rem,banc,idfis,ai,nis,rc,solde,m1,m2,m3,m4,m5,exonore,user_id)
-               VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-            lambda r: (
-                s(r.get('reference')), s(r.get('nom')), s(r.get('adresse')),
-                s(r.get('post')),      s(r.get('ville')), s(r.get('pays')),
-                s(r.get('contact')),   s(r.get('tel1')),  s(r.get('tel2')),
-                s(r.get('fax')),       s(r.get('rem')),   s(r.get('banc')),
-                s(r.get('idfis')),     s(r.get('ai')),    s(r.get('nis')),
-                s(r.get('rc')),        s(r.get('solde')),
-                s(r.get('m1')), s(r.get('m2')), s(r.get('m3')),
-                s(r.get('m4')), s(r.get('m5')),
-                b(r.get('exonore')), user_id))
-
-        batch('client', data.get('client', []),
-            """INSERT INTO client
-               (reference,nom,adresse,post,ville,pays,contact,tel1,tel2,fax,
-                rem,catp,banc,idfis,ai,nis,rc,solde,smax,m1,m2,m3,m4,m5,exonore,user_id)
-               VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-            lambda r: (
-                s(r.get('reference')), s(r.get('nom')),     s(r.get('adresse')),
-                s(r.get('post')),      s(r.get('ville')),   s(r.get('pays')),
-                s(r.get('contact')),   s(r.get('tel1')),    s(r.get('tel2')),
-                s(r.get('fax')),       s(r.get('rem')),     i(r.get('catp')),
-                s(r.get('banc')),      s(r.get('idfis')),   s(r.get('ai')),
-                s(r.get('nis')),       s(r.get('rc')),      s(r.get('solde')),
-                s(r.get('smax')),
-                s(r.get('m1')), s(r.get('m2')), s(r.get('m3')),
-                s(r.get('m4')), s(r.get('m5')),
-                b(r.get('exonore')), user_id))
-
-        # ── Niveau 2 — dépendent de niveau 1 ────────────────────────────────
-
-        batch('"TABLES"', data.get('tables', []),
-            'INSERT INTO "TABLES" (numero_salle,position_x,position_y,description_t,etat,user_id) VALUES (%s,%s,%s,%s,%s,%s)',
-            lambda r: (
-                i(r.get('numero_salle')), i(r.get('position_x')), i(r.get('position_y')),
-                s(r.get('description_t')), s(r.get('etat')), user_id))
-
-        # ITEM — mapping local_id → nouveau numero_item cloud
+                record = json.loads(line)
+                key, row = record['table'], record.get('row')
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                return reject(f'ligne {line_no} invalide: {e}')
+            if key not in loader.tables:
+                return reject(f'ligne {line_no}: table inconnue {key}')
+            if key in done:
+                return reject(f'ligne {line_no}: table {key} déjà reçue, les lignes d\'une table doivent se suivre')
+            if key != pending_key and pending_key is not None:
+                done.add(pending_key)
+            if row is None:
+                if pending:
+                    loader.load(pending_key, pending)
+                pending_key, pending = None, []
+                loader.load(key, [])
+                done.add(key)
+                continue
+            if key != pending_key or len(pending) >= MIGRATE_STREAM_BATCH:
+                if pending:
+                    loader.load(pending_key, pending)
+                pending_key, pending = key, []
+            pending.append(row)
+        if pending:
+            loader.load(pending_key, pending)
+
+        loader.finish()
+        conn.commit()
+        summary = loader.summary()
+        summary['lignes_recues'] = line_no
+        logger.info(f"[migrate_receive/stream] OK — {summary['total_inserted']} lignes insérées pour user_id={user_id}")
+        return jsonify(summary), 200
+
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"[migrate_receive/stream] ERREUR: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+    finally:
+        loader.close()
+        conn.close()
+
+# ── Migration depuis un fichier SQLite ──────────────────────────────────────
+MIGRATE_UPLOAD_CHUNK = 1024 * 1024   # octets lus par écriture disque
+
+# Colonnes attendues par MIGRATE_PLAN absentes d'une base au format /export
+MIGRATE_SQLITE_ALIASES = {
+    'item':    {'local_id': 'numero_item'},
+    'codebar': {'bar_local_id': 'bar'},
+}
+
+def iter_sqlite_rows(db, table_name, aliases=None, batch_size=MIGRATE_STREAM_BATCH):
+    """Produit par lots les lignes d'une table SQLite (dicts, noms de colonnes en minuscules)"""
+    cur = db.execute(f'SELECT * FROM "{table_name}"')
+    columns = [d[0].lower() for d in cur.description]
+    aliases = aliases or {}
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        batch = [dict(zip(columns, row)) for row in rows]
+        for alias, column in aliases.items():
+            for r in batch:
+                r.setdefault(alias, r.get(column))
+        yield batch
+
+def save_upload(path):
+    """Copie le corps de la requête (brut ou champ multipart `file`) sur disque, par blocs.
+
+    request.files n'est lu que pour un envoi multipart : pour tout autre type
+    (curl --data-binary envoie application/x-www-form-urlencoded), l'analyse du
+    formulaire par Werkzeug consommerait le corps brut.
+    """
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('file')
+        if upload:
+            upload.save(path)
+        return
+    with open(path, 'wb') as out:
+        while True:
+            chunk = request.stream.read(MIGRATE_UPLOAD_CHUNK)
+            if not chunk:
+                break
+            out.write(chunk)
+
+
+@app.route('/migrate_receive/sqlite', methods=['POST'])
+def migrate_receive_sqlite():
+    """Migration depuis le fichier SQLite du poste (même format que /export).
+
+    Le fichier est écrit sur disque sans passer en mémoire, puis chaque table est
+    lue par lots avec sqlite3 et chargée par COPY via MigrationLoader. Les valeurs
+    SQLite sont déjà typées : les nombres prennent le chemin rapide des conversions.
+    """
+    user_id = request.args.get('user_id') or request.headers.get('X-User-ID')
+    if not user_id:
+        return jsonify({'error': 'user_id requis'}), 400
+    clear = request.args.get('clear', 'true').lower() not in ('0', 'false', 'non', 'no')
+    mode = request.args.get('mode', 'reload')
+    if mode not in MIGRATE_MODES:
+        return jsonify({'error': f"mode invalide: {mode}"}), 400
+
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    db = None
+    try:
+        save_upload(path)
+        try:
+            db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+            sqlite_tables = {name.lower(): name for (name,) in
+                             db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        except sqlite3.DatabaseError as e:
+            return jsonify({'error': f'Fichier SQLite invalide: {e}'}), 400
+        if not sqlite_tables:
+            return jsonify({'error': 'Base SQLite vide'}), 400
+
+        conn = get_conn()
+        conn.autocommit = False
+        loader = MigrationLoader(conn, user_id, sync=mode == 'sync')
+        try:
+            if clear and mode != 'sync':
+                loader.clear()
+                logger.info(f"[migrate_receive/sqlite] Tables effacées pour user_id={user_id}")
+            for key, *_ in loader.plan:
+                table_name = sqlite_tables.get(key)
+                if not table_name:
+                    continue
+                loaded = False
+                for rows in iter_sqlite_rows(db, table_name, MIGRATE_SQLITE_ALIASES.get(key)):
+                    loader.load(key, rows)
+                    loaded = True
+                if not loaded:
+                    loader.load(key, [])   # table vide : en sync, ses lignes cloud sont supprimées
+
+            loader.finish()
+            summary = loader.summary()
+            logger.info(f"[migrate_receive/sqlite] OK — {summary['total_inserted']} lignes insérées pour user_id={user_id}")
+            return jsonify(summary), 200
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"[migrate_receive/sqlite] ERREUR: {e}", exc_info=True)
+            return jsonify({'error': str(e)}), 500
+        finally:
+            loader.close()
+            conn.close()
+    finally:
+        if db:
+            db.close()
+        os.unlink(path)
+
+
+# ── Sessions de migration reprenables ───────────────────────────────────────
+MIGRATE_SESSION_TTL_DAYS = int(os.environ.get('MIGRATE_SESSION_TTL_DAYS', 7))
+
+MIGRATION_SESSION_DDL = """
+    CREATE TABLE IF NOT EXISTS migration_session (
+        session_id text PRIMARY KEY,
+        user_id varchar NOT NULL,
+        statut text NOT NULL DEFAULT 'en_cours',
+        next_seq integer NOT NULL DEFAULT 0,
+        progress jsonb NOT NULL DEFAULT '{}',
+        created_at timestamptz NOT NULL DEFAULT now(),
+        updated_at timestamptz NOT NULL DEFAULT now()
+    );
+    CREATE TABLE IF NOT EXISTS migration_session_chunk (
+        session_id text NOT NULL REFERENCES migration_session ON DELETE CASCADE,
+        seq integer NOT NULL,
+        par_table jsonb NOT NULL,
+        committed_at timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (session_id, seq)
+    );
+    CREATE TABLE IF NOT EXISTS migration_item_map (
+        session_id text NOT NULL REFERENCES migration_session ON DELETE CASCADE,
+        local_id integer NOT NULL,
+        cloud_id integer NOT NULL,
+        PRIMARY KEY (session_id, local_id)
+    );
+"""
+
+def migration_session_response(session):
+    return {
+        'session_id': session['session_id'],
+        'statut': session['statut'],
+        'resume_from': session['next_seq'],
+        'progression': session['progress'],
+    }
+
+def load_migration_session(cur, session_id, user_id, for_update=False):
+    """La session de cet utilisateur, ou None"""
+    cur.execute(f"""
+        SELECT session_id, user_id, statut, next_seq, progress
+        FROM migration_session
+        WHERE session_id = %s AND user_id = %s
+        {'FOR UPDATE' if for_update else ''}
+    """, (session_id, user_id))
+    return cur.fetchone()
+
+
+@app.route('/migrate/sessions', methods=['POST'])
+def create_migration_session():
+    """Ouvre une session de migration par chunks ; efface les données si clear (défaut)"""
+    req     = request.get_json(silent=True) or {}
+    user_id = req.get('user_id') or request.headers.get('X-User-ID')
+    if not user_id:
+        return jsonify({'error': 'user_id requis'}), 400
+    clear = req.get('clear', True)
+
+    conn = get_conn()
+    conn.autocommit = False
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        cur.execute("DELETE FROM migration_session WHERE updated_at < now() - %s * interval '1 day'",
+                    (MIGRATE_SESSION_TTL_DAYS,))
+        if clear:
+            loader = MigrationLoader(conn, user_id, autocommit=False)
+            loader.clear()
+            loader.close()
+        cur.execute("""
+            INSERT INTO migration_session (session_id, user_id)
+            VALUES (%s, %s)
+            RETURNING session_id, user_id, statut, next_seq, progress
+        """, (uuid.uuid4().hex, user_id))
+        session = cur.fetchone()
+        conn.commit()
+        logger.info(f"[migrate/sessions] Session {session['session_id']} ouverte pour user_id={user_id}")
+        return jsonify(migration_session_response(session)), 201
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"[migrate/sessions] ERREUR: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cur.close()
+        conn.close()
+
+
+@app.route('/migrate/sessions/<session_id>', methods=['GET'])
+def get_migration_session(session_id):
+    """Point de reprise : premier chunk non acquitté et progression par table"""
+    user_id = request.args.get('user_id') or request.headers.get('X-User-ID')
+    if not user_id:
+        return jsonify({'error': 'user_id requis'}), 400
+
+    conn = get_conn()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        session = load_migration_session(cur, session_id, user_id)
+        conn.rollback()
+        if not session:
+            return jsonify({'error': 'Session introuvable'}), 404
+        return jsonify(migration_session_response(session)), 200
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"[migrate/sessions] ERREUR: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cur.close()
+        conn.close()
+
+
+@app.route('/migrate/sessions/<session_id>/chunks/<int:seq>', methods=['PUT'])
+def put_migration_chunk(session_id, seq):
+    """Applique le chunk `seq` ({"data": {...}} comme migrate_receive) en une transaction.
+
+    Le chunk et son acquittement sont commités ensemble : un chunk déjà acquitté
+    renvoyé après une coupure n'est pas rejoué, un chunk en échec est entièrement
+    annulé et peut être renvoyé tel quel.
+    """
+    req     = request.get_json(silent=True) or {}
+    user_id = req.get('user_id') or request.headers.get('X-User-ID')
+    data    = req.get('data', {})
+    if not user_id:
+        return jsonify({'error': 'user_id requis'}), 400
+
+    conn = get_conn()
+    conn.autocommit = False
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    loader = None
+    try:
+        session = load_migration_session(cur, session_id, user_id, for_update=True)
+        if not session:
+            conn.rollback()
+            return jsonify({'error': 'Session introuvable'}), 404
+        if session['statut'] != 'en_cours':
+            conn.rollback()
+            return jsonify(dict(migration_session_response(session), error='Session terminée')), 409
+        if seq < session['next_seq']:
+            conn.rollback()
+            return jsonify(dict(migration_session_response(session), ack=seq, deja_recu=True)), 200
+        if seq > session['next_seq']:
+            conn.rollback()
+            return jsonify(dict(migration_session_response(session),
+                                error=f"Chunk {seq} hors séquence, reprendre à {session['next_seq']}")), 409
+
+        # Mapping item des chunks précédents, utile seulement pour traduire codebar
         item_id_map = {}
-        for r in data.get('item', []):
-            try:
-                cur.execute("""
-                    INSERT INTO item
-                        (numero_categorie,ref,designation,prix,prixb,prixvh,qte,qtea,
-                         model,remarque,numero_fou,tva,bar,prix2,prix3,prix4,prix5,
-                         tvav,prixba,exp,debut,fin,promo,m1,m2,m3,m4,m5,
-                         disponible,gere,temp_fabrication,user_id)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                    RETURNING numero_item
-                """, (
-                    i(r.get('numero_categorie')),
-                    s(r.get('ref')),        s(r.get('designation'), 'Article'),
-                    s(r.get('prix')),       s(r.get('prixb')),      s(r.get('prixvh')),
-                    f(r.get('qte')),        i(r.get('qtea')),
-                    s(r.get('model')),      s(r.get('remarque')),
-                    i(r.get('numero_fou')), i(r.get('tva')),        s(r.get('bar')),
-                    s(r.get('prix2')),      s(r.get('prix3')),      s(r.get('prix4')),
-                    s(r.get('prix5')),      s(r.get('tvav')),       s(r.get('prixba')),
-                    r.get('exp'),           r.get('debut'),          r.get('fin'),
-                    s(r.get('promo')),
-                    s(r.get('m1')), s(r.get('m2')), s(r.get('m3')),
-                    s(r.get('m4')), s(r.get('m5')),
-                    b(r.get('disponible'), True), b(r.get('gere')),
-                    i(r.get('temp_fabrication')), user_id))
-                cloud_id = cur.fetchone()[0]
-                local_id = i(r.get('local_id'))
-                if local_id:
-                    item_id_map[local_id] = cloud_id
-            except Exception as e:
-                logger.warning(f"item insert: {e}")
+        if data.get('codebar'):
+            cur.execute("SELECT local_id, cloud_id FROM migration_item_map WHERE session_id = %s",
+                        (session_id,))
+            item_id_map = {row['local_id']: row['cloud_id'] for row in cur.fetchall()}
+
+        loader = MigrationLoader(conn, user_id, autocommit=False, item_id_map=item_id_map)
+        for key, *_ in loader.plan:
+            loader.load(key, data.get(key, []))
+
+        if loader.new_item_ids:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO migration_item_map (session_id, local_id, cloud_id) VALUES %s
+                ON CONFLICT (session_id, local_id) DO UPDATE SET cloud_id = EXCLUDED.cloud_id
+            """, [(session_id, local_id, cloud_id) for local_id, cloud_id in loader.new_item_ids.items()])
+
+        chunk_counts = {k: v for k, v in loader.results.items() if v}
+        progress = dict(session['progress'])
+        for table, count in chunk_counts.items():
+            progress[table] = progress.get(table, 0) + count
+        cur.execute("""
+            INSERT INTO migration_session_chunk (session_id, seq, par_table) VALUES (%s, %s, %s::jsonb)
+        """, (session_id, seq, json.dumps(chunk_counts)))
+        cur.execute("""
+            UPDATE migration_session
+            SET next_seq = %s, progress = %s::jsonb, updated_at = now()
+            WHERE session_id = %s
+            RETURNING session_id, user_id, statut, next_seq, progress
+        """, (seq + 1, json.dumps(progress), session_id))
+        session = cur.fetchone()
         conn.commit()
-        results['item'] = len(item_id_map)
-
-        # CODEBAR — bar_local_id traduit vers le nouveau numero_item cloud
-        codebar_vals = []
-        for r in data.get('codebar', []):
-            local_item_id = i(r.get('bar_local_id'))
-            cloud_item_id = item_id_map.get(local_item_id, local_item_id)
-            codebar_vals.append((str(cloud_item_id), s(r.get('bar2')), user_id))
-        if codebar_vals:
-            try:
-                cur.executemany(
-                    "INSERT INTO codebar (bar, bar2, user_id) VALUES (%s,%s,%s)",
-                    codebar_vals)
-                conn.commit()
-                results['codebar'] = len(codebar_vals)
-            except Exception as e:
-                conn.rollback()
-                logger.error(f"codebar insert: {e}")
-                results['codebar'] = f"ERR: {str(e)[:120]}"
-        else:
-            results['codebar'] = 0
-
-        batch('mouvement', data.get('mouvement', []),
-            """INSERT INTO mouvement
-               (date_m,etat_m,numero_four,refdoc,vers,nature,connection1,numero_util,cheque,user_id)
-               VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-            lambda r: (
-                r.get('date_m'),          s(r.get('etat_m')),
-                i(r.get('numero_four')),  s(r.get('refdoc')),
-                s(r.get('vers')),         s(r.get('nature')),
-                i(r.get('connection1')),  i(r.get('numero_util')),
-                s(r.get('cheque')),       user_id))
-
-        batch('cloture', data.get('cloture', []),
-            "INSERT INTO cloture (date_cloture,prelevement,fondcaisse,user_id) VALUES (%s,%s,%s,%s)",
-            lambda r: (
-                r.get('date_cloture'), s(r.get('prelevement')),
-                s(r.get('fondcaisse')), user_id))
-
-        # ── Niveau 3 — dépendent de niveau 2 ────────────────────────────────
-
-        batch('comande', data.get('comande', []),
-            """INSERT INTO comande
-               (numero_table,date_comande,etat_c,connection1,numero_util,nature,compteur,cheque,user_id)
-               VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-            lambda r: (
-                i(r.get('numero_table')),  r.get('date_comande'),
-                s(r.get('etat_c')),        i(r.get('connection1')),
-                i(r.get('numero_util')),   s(r.get('nature')),
-                i(r.get('compteur')),      s(r.get('cheque')), user_id))
-
-        # ── Niveau 4 — dépendent de niveau 3 ────────────────────────────────
-
-        batch('attache', data.get('attache', []),
-            """INSERT INTO attache
-               (numero_comande,numero_item,quantite,prixt,remarque,bnfc,marge,prixbh,achatfx,send,user_id)
-               VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-            lambda r: (
-                i(r.get('numero_comande')), i(r.get('numero_item')),
-                f(r.get('quantite')),
-                s(r.get('prixt')),   s(r.get('remarque')),
-                s(r.get('bnfc')),    s(r.get('marge')),
-                s(r.get('prixbh')),  s(r.get('achatfx')),
-                b(r.get('send')),    user_id))
-
-        batch('attache2', data.get('attache2', []),
-            """INSERT INTO attache2
-               (numero_item,numero_mouvement,qtea,nqte,nprix,pump,send,user_id)
-               VALUES (%s,%s,%s,%s,%s,%s,%s,%s)""",
-            lambda r: (
-                i(r.get('numero_item')), i(r.get('numero_mouvement')),
-                f(r.get('qtea')),        f(r.get('nqte')),
-                s(r.get('nprix')),       s(r.get('pump')),
-                b(r.get('send')),        user_id))
-
-        batch('attachetmp', data.get('attachetmp', []),
-            """INSERT INTO attachetmp
-               (numero_comande,numero_item,quantite,prixt,remarque,bnfc,marge,prixbh,achatfx,send,user_id)
-               VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-            lambda r: (
-                i(r.get('numero_comande')), i(r.get('numero_item')),
-                f(r.get('quantite')),
-                s(r.get('prixt')),   s(r.get('remarque')),
-                s(r.get('bnfc')),    s(r.get('marge')),
-                s(r.get('prixbh')),  s(r.get('achatfx')),
-                b(r.get('send')),    user_id))
-
-        batch('encaisse', data.get('encaisse', []),
-            """INSERT INTO encaisse
-               (apaye,reglement,tva,ht,numero_comande,numero_cloture,time_enc,origine,solder,user_id)
-               VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-            lambda r: (
-                s(r.get('apaye')),   s(r.get('reglement')),
-                s(r.get('tva')),     s(r.get('ht')),
-                i(r.get('numero_comande')), i(r.get('numero_cloture')),
-                r.get('time_enc'),   s(r.get('origine')),
-                s(r.get('solder')),  user_id))
-
-        batch('item_composition', data.get('item_composition', []),
-            """INSERT INTO item_composition
-               (numero_item,numero_item_cmp,designation_cmp,quantite_cmp,
-                prixbh_cmp,prixt_cmp,remarque_cmp,send_cmp,m1_cmp,user_id)
-               VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-            lambda r: (
-                i(r.get('numero_item')),     i(r.get('numero_item_cmp')),
-                s(r.get('designation_cmp')), f(r.get('quantite_cmp')),
-                s(r.get('prixbh_cmp')),      s(r.get('prixt_cmp')),
-                s(r.get('remarque_cmp')),    b(r.get('send_cmp')),
-                s(r.get('m1_cmp')),          user_id))
-
-        batch('mouvementc', data.get('mouvementc', []),
-            """INSERT INTO mouvementc
-               (date_mc,time_mc,montant,justificatif,numero_util,origine,cf,numero_cf,user_id)
-               VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-            lambda r: (
-                r.get('date_mc'),           r.get('time_mc'),
-                s(r.get('montant')),        s(r.get('justificatif')),
-                i(r.get('numero_util')),    s(r.get('origine')),
-                s(r.get('cf')),             i(r.get('numero_cf')),
-                user_id))
-
-        batch('observation', data.get('observation', []),
-            "INSERT INTO observation (numero_comande,doc,texts,user_id) VALUES (%s,%s,%s,%s)",
-            lambda r: (i(r.get('numero_comande')), s(r.get('doc')), s(r.get('texts')), user_id))
-
-        batch('tmp', data.get('tmp', []),
-            """INSERT INTO tmp
-               (v1,v2,v3,v4,v5,v6,v7,v8,v9,v10,
-                f1,f2,f3,f4,f5,f6,f7,f8,f9,f10,
-                r1,r2,r3,r4,r5,r6,r7,r8,r9,r10,user_id)
-               VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,
-                       %s,%s,%s,%s,%s,%s,%s,%s,%s,%s,
-                       %s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-            lambda r: tuple(s(r.get(f'v{j}')) for j in range(1, 11)) +
-                      tuple(s(r.get(f'f{j}')) for j in range(1, 11)) +
-                      tuple(s(r.get(f'r{j}')) for j in range(1, 11)) +
-                      (user_id,))
-
-        # ── Résumé ────────────────────────────────────────────────────────────
-        errors  = {k: v for k, v in results.items() if isinstance(v, str)}
-        inserts = {k: v for k, v in results.items() if isinstance(v, int)}
-        total   = sum(inserts.values())
-
-        logger.info(f"[migrate_receive] OK — {total} lignes insérées pour user_id={user_id}")
-        return jsonify({
-            'statut':         'OK',
-            'user_id':        user_id,
-            'total_inserted': total,
-            'par_table':      inserts,
-            'erreurs':        errors,
-        }), 200
+        return jsonify(dict(migration_session_response(session), ack=seq, par_table=chunk_counts)), 200
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"[migrate/sessions] Chunk {seq} annulé: {e}", exc_info=True)
+        return jsonify({'error': str(e), 'resume_from': seq}), 500
+    finally:
+        if loader:
+            loader.close()
+        cur.close()
+        conn.close()
+
+
+@app.route('/migrate/sessions/<session_id>/finish', methods=['POST'])
+def finish_migration_session(session_id):
+    """Clôt la session et libère le mapping des articles"""
+    req     = request.get_json(silent=True) or {}
+    user_id = req.get('user_id') or request.headers.get('X-User-ID')
+    if not user_id:
+        return jsonify({'error': 'user_id requis'}), 400
 
+    conn = get_conn()
+    conn.autocommit = False
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        cur.execute("""
+            UPDATE migration_session SET statut = 'terminee', updated_at = now()
+            WHERE session_id = %s AND user_id = %s
+            RETURNING session_id, user_id, statut, next_seq, progress
+        """, (session_id, user_id))
+        session = cur.fetchone()
+        if not session:
+            conn.rollback()
+            return jsonify({'error': 'Session introuvable'}), 404
+        cur.execute("DELETE FROM migration_item_map WHERE session_id = %s", (session_id,))
+        conn.commit()
+        logger.info(f"[migrate/sessions] Session {session_id} terminée — {session['progress']}")
+        return jsonify(migration_session_response(session)), 200
     except Exception as e:
         conn.rollback()
-        logger.error(f"[migrate_receive] ERREUR: {e}", exc_info=True)
+        logger.error(f"[migrate/sessions] ERREUR: {e}", exc_info=True)
         return jsonify({'error': str(e)}), 500
     finally:
         cur.close()
         conn.close()
 
+
+# ── Initialisation du schéma ────────────────────────────────────────────────
+# Les tables techniques de l'application sont créées hors des requêtes : au
+# démarrage (python main.py, cf. Procfile) ou par `flask --app main init-db`
+# au déploiement quand l'application est lancée autrement. Les triggers du
+# suivi des modifications verrouillent les tables métier : ils ne sont créés
+# que par `flask --app main install-change-tracking`, lancé explicitement.
+APP_SCHEMA_DDL = (
+    IDEMPOTENCY_DDL,
+    TICKET_COUNTER_DDL,
+    MIGRATION_SESSION_DDL,
+)
+
+def init_db():
+    """Crée les tables techniques manquantes (idempotent, sérialisé par un verrou consultatif)"""
+    conn = get_pool().getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('init_db'))")
+            for ddl in APP_SCHEMA_DDL:
+                cur.execute(ddl)
+        conn.commit()
+        logger.info("Schéma applicatif initialisé")
+    finally:
+        conn.close()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Crée les tables techniques de l'application"""
+    init_db()
+
+def init_change_tracking():
+    """Installe le journal des modifications et les triggers manquants des tables exportées"""
+    conn = get_pool().getconn()
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            plans = get_export_plans(cur)
+            install_change_tracking(cur, trackable_tables(plans), versioned_tables(plans))
+        conn.commit()
+    finally:
+        conn.close()
+
+@app.cli.command('install-change-tracking')
+def install_change_tracking_command():
+    """Installe le suivi des modifications (exports delta et cache ETag)"""
+    init_change_tracking()
+
+
 # Lancer l'application
 if __name__ == '__main__':
+    init_db()
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,66 @@
+"""Behaviour tests against a real PostgreSQL database.
+
+DATABASE_URL must point to a database with the application schema; without
+it every test is skipped. The application tables and the change tracking are
+installed once per session (init-db, install-change-tracking), and each test
+writes under its own tenant, deleted afterwards.
+"""
+import os
+import sys
+import uuid
+
+import psycopg2.extras
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def database():
+    if not os.environ.get('DATABASE_URL'):
+        pytest.skip('DATABASE_URL non défini')
+    main.init_db()
+    main.init_change_tracking()
+
+
+@pytest.fixture
+def client(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'EXPORT_CACHE_DIR', str(tmp_path / 'export_cache'))
+    return main.app.test_client()
+
+
+@pytest.fixture
+def db(database):
+    """Curseur (RealDictCursor) sur une connexion du pool en autocommit"""
+    conn = main.get_pool().getconn()
+    conn.autocommit = True
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    yield cur
+    cur.close()
+    conn.close()
+
+
+@pytest.fixture
+def tenant(db):
+    user_id = f'test_{uuid.uuid4().hex[:12]}'
+    yield user_id
+    for table in main.MIGRATE_DELETE_ORDER:
+        db.execute(f'DELETE FROM {table} WHERE user_id = %s', (user_id,))
+    main.reset_ticket_counters(db, user_id)
+    db.execute('DELETE FROM idempotency_key WHERE user_id = %s', (user_id,))
+
+
+@pytest.fixture
+def caisse(db, tenant):
+    """(numero_util, [numero_item]) : un utilisateur (mot de passe 1234) et trois articles en stock"""
+    db.execute("INSERT INTO utilisateur (nom, password2, user_id) VALUES ('caisse', '1234', %s) "
+               "RETURNING numero_util", (tenant,))
+    numero_util = db.fetchone()['numero_util']
+    items = []
+    for k in range(3):
+        db.execute("INSERT INTO item (designation, qte, user_id) VALUES (%s, 100, %s) RETURNING numero_item",
+                   (f'article {k}', tenant))
+        items.append(db.fetchone()['numero_item'])
+    return numero_util, items
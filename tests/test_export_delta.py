@@ -0,0 +1,77 @@
+"""Incremental export: GET /export?since=<watermark>."""
+import base64
+import sqlite3
+
+
+def export(client, user_id, **params):
+    response = client.get('/export', query_string=params, headers={'X-User-ID': user_id})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return response.get_json()
+
+
+def open_export(tmp_path, body):
+    path = tmp_path / 'export.sqlite'
+    path.write_bytes(base64.b64decode(body['db']))
+    return sqlite3.connect(path)
+
+
+def add_client(cur, user_id, nom):
+    cur.execute("INSERT INTO client (nom, solde, user_id) VALUES (%s, '0', %s) RETURNING numero_clt",
+                (nom, user_id))
+    return cur.fetchone()['numero_clt']
+
+
+def test_delta_contains_only_changes_since_watermark(client, db, tenant, tmp_path):
+    add_client(db, tenant, 'inchangé')
+    updated = add_client(db, tenant, 'modifié')
+    deleted = add_client(db, tenant, 'supprimé')
+    full = export(client, tenant)
+    assert full['delta'] is False
+    assert full['watermark'] is not None
+
+    db.execute("UPDATE client SET nom = 'renommé' WHERE numero_clt = %s", (updated,))
+    db.execute("DELETE FROM client WHERE numero_clt = %s", (deleted,))
+    added = add_client(db, tenant, 'ajouté')
+
+    delta = export(client, tenant, since=full['watermark'])
+    assert delta['delta'] is True
+    assert delta['watermark'] >= full['watermark']
+    assert delta['table_contents']['client'] == 2
+    assert delta['deleted'] == {'client': 1}
+    with open_export(tmp_path, delta) as sqlite:
+        assert dict(sqlite.execute('SELECT numero_clt, nom FROM client')) == {updated: 'renommé', added: 'ajouté'}
+        assert sqlite.execute('SELECT TABLE_NAME, PK FROM SYNC_DELETED').fetchall() == [('client', str(deleted))]
+
+
+def test_delta_ignores_other_tenants(client, db, tenant):
+    full = export(client, tenant)
+    add_client(db, f'{tenant}_autre', 'autre tenant')
+    try:
+        delta = export(client, tenant, since=full['watermark'])
+    finally:
+        db.execute('DELETE FROM client WHERE user_id = %s', (f'{tenant}_autre',))
+    assert delta['delta'] is True
+    assert not any(delta['table_contents'].get(table) for table in ('client', 'item'))
+    assert delta['deleted'] == {}
+
+
+def test_migration_forces_full_export(client, db, tenant):
+    add_client(db, tenant, 'avant migration')
+    full = export(client, tenant)
+
+    response = client.post('/migrate_receive', json={
+        'user_id': tenant,
+        'data': {'client': [{'reference': f'C{k}', 'nom': f'client {k}', 'solde': '0'} for k in range(50)]},
+    })
+    assert response.status_code == 200, response.get_data(as_text=True)
+
+    # Une entrée 'R' par instruction au lieu d'une par ligne chargée
+    db.execute('SELECT op, count(*) AS n FROM export_changelog WHERE user_id = %s AND txid >= %s GROUP BY op',
+               (tenant, full['watermark']))
+    entries = {row['op']: row['n'] for row in db.fetchall()}
+    assert set(entries) == {'R'}
+    assert entries['R'] < 50
+
+    after = export(client, tenant, since=full['watermark'])
+    assert after['delta'] is False
+    assert after['table_contents']['client'] == 50
@@ -0,0 +1,80 @@
+"""Full-export cache: ETag / If-None-Match on GET /export."""
+import main
+
+
+def export(client, user_id, etag=None):
+    headers = {'X-User-ID': user_id}
+    if etag:
+        headers['If-None-Match'] = etag
+    return client.get('/export', query_string={'format': 'sqlite'}, headers=headers)
+
+
+def count_builds(monkeypatch):
+    calls = []
+    build = main.build_export_db
+
+    def counting_build(*args, **kwargs):
+        calls.append(1)
+        return build(*args, **kwargs)
+
+    monkeypatch.setattr(main, 'build_export_db', counting_build)
+    return calls
+
+
+def add_client(cur, user_id, nom):
+    cur.execute("INSERT INTO client (nom, solde, user_id) VALUES (%s, '0', %s)", (nom, user_id))
+
+
+def test_unchanged_export_is_served_from_cache(client, db, tenant, monkeypatch):
+    add_client(db, tenant, 'client')
+    builds = count_builds(monkeypatch)
+
+    first = export(client, tenant)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    second = export(client, tenant)
+    assert second.status_code == 200
+    assert second.headers['ETag'] == etag
+    assert second.get_data() == first.get_data()
+
+    not_modified = export(client, tenant, etag)
+    assert not_modified.status_code == 304
+    assert not_modified.get_data() == b''
+    assert len(builds) == 1
+
+
+def test_only_own_writes_change_etag(client, db, tenant):
+    add_client(db, tenant, 'client')
+    etag = export(client, tenant).headers['ETag']
+
+    other = f'{tenant}_autre'
+    add_client(db, other, 'autre tenant')
+    try:
+        assert export(client, tenant, etag).status_code == 304
+    finally:
+        db.execute('DELETE FROM client WHERE user_id = %s', (other,))
+
+    db.execute("UPDATE client SET nom = 'modifié' WHERE user_id = %s", (tenant,))
+    changed = export(client, tenant, etag)
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+
+def test_incomplete_export_is_not_cached(client, db, tenant, monkeypatch):
+    add_client(db, tenant, 'client')
+    builds = count_builds(monkeypatch)
+    build = main.build_export_db
+
+    def build_skipping_a_table(*args, **kwargs):
+        exported_tables, table_contents, created_tables = build(*args, **kwargs)
+        return exported_tables[1:], table_contents, created_tables
+
+    monkeypatch.setattr(main, 'build_export_db', build_skipping_a_table)
+    incomplete = export(client, tenant)
+    assert incomplete.status_code == 503
+    assert 'ETag' not in incomplete.headers
+
+    monkeypatch.setattr(main, 'build_export_db', build)
+    complete = export(client, tenant)
+    assert complete.status_code == 200
+    assert len(builds) == 2
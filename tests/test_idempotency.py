@@ -0,0 +1,66 @@
+"""Idempotency-Key on write routes: a replayed request returns the stored response."""
+import threading
+
+import main
+
+
+def vente(caisse, **fields):
+    numero_util, items = caisse
+    return {'numero_util': numero_util, 'password2': '1234',
+            'lignes': [{'numero_item': items[0], 'quantite': 2, 'prixt': '5'}], **fields}
+
+
+def post(client, user_id, body, key):
+    return client.post('/valider_vente', json=body, headers={'X-User-ID': user_id, 'Idempotency-Key': key})
+
+
+def sales(cur, user_id):
+    cur.execute('SELECT count(*) AS n FROM comande WHERE user_id = %s', (user_id,))
+    return cur.fetchone()['n']
+
+
+def test_replay_returns_stored_response(client, db, tenant, caisse):
+    first = post(client, tenant, vente(caisse), 'cle-1')
+    replay = post(client, tenant, vente(caisse), 'cle-1')
+
+    assert first.status_code == replay.status_code == 200
+    assert replay.get_json() == first.get_json()
+    assert replay.headers['Idempotent-Replayed'] == 'true'
+    assert 'Idempotent-Replayed' not in first.headers
+    assert sales(db, tenant) == 1
+
+
+def test_key_reused_for_another_body_is_rejected(client, db, tenant, caisse):
+    post(client, tenant, vente(caisse), 'cle-1')
+
+    response = post(client, tenant, vente(caisse, date_comande='2026-01-01T10:00:00'), 'cle-1')
+
+    assert response.status_code == 422
+    assert sales(db, tenant) == 1
+
+
+def test_failed_request_is_not_stored(client, db, tenant, caisse):
+    refused = [post(client, tenant, vente(caisse, password2='faux'), 'cle-2') for _ in range(2)]
+
+    assert [r.status_code for r in refused] == [401, 401]
+    assert 'Idempotent-Replayed' not in refused[1].headers
+    db.execute('SELECT count(*) AS n FROM idempotency_key WHERE user_id = %s', (tenant,))
+    assert db.fetchone()['n'] == 0
+
+
+def test_concurrent_duplicates_commit_once(db, tenant, caisse):
+    responses = []
+
+    def send():
+        response = post(main.app.test_client(), tenant, vente(caisse), 'cle-3')
+        responses.append((response.status_code, response.get_json()))
+
+    threads = [threading.Thread(target=send) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [status for status, _ in responses] == [200] * 6
+    assert len({body['numero_comande'] for _, body in responses}) == 1
+    assert sales(db, tenant) == 1
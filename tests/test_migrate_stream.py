@@ -0,0 +1,33 @@
+"""NDJSON migration stream: POST /migrate_receive/stream."""
+import json
+
+
+def clients(cur, user_id):
+    cur.execute('SELECT reference FROM client WHERE user_id = %s ORDER BY reference', (user_id,))
+    return [row['reference'] for row in cur.fetchall()]
+
+
+def client_line(reference):
+    return json.dumps({'table': 'client', 'row': {'reference': reference, 'nom': reference, 'solde': '0'}}) + '\n'
+
+
+def test_stream_reload_replaces_tenant_data(client, db, tenant):
+    db.execute("INSERT INTO client (reference, nom, solde, user_id) VALUES ('OLD', 'ancien', '0', %s)", (tenant,))
+
+    response = client.post('/migrate_receive/stream', query_string={'user_id': tenant},
+                           data=''.join(client_line(f'C{k}') for k in range(3)))
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    assert response.get_json()['lignes_recues'] == 3
+    assert clients(db, tenant) == ['C0', 'C1', 'C2']
+
+
+def test_malformed_line_rolls_back_clear(client, db, tenant):
+    db.execute("INSERT INTO client (reference, nom, solde, user_id) VALUES ('OLD', 'ancien', '0', %s)", (tenant,))
+
+    response = client.post('/migrate_receive/stream', query_string={'user_id': tenant, 'clear': 'true'},
+                           data=client_line('C0') + client_line('C1') + '{"table": \n' + client_line('C2'))
+
+    assert response.status_code == 400
+    assert 'ligne 3' in response.get_json()['error']
+    assert clients(db, tenant) == ['OLD']
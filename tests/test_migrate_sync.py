@@ -0,0 +1,76 @@
+"""Migration in sync mode: rows matched on their natural key instead of reloaded."""
+import json
+
+
+def migrate(client, user_id, data, mode='sync'):
+    response = client.post('/migrate_receive', json={'user_id': user_id, 'data': data, 'mode': mode})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return response.get_json()
+
+
+def migrate_stream(client, user_id, lines, mode='sync'):
+    body = ''.join(json.dumps(line) + '\n' for line in lines)
+    return client.post('/migrate_receive/stream', query_string={'user_id': user_id, 'mode': mode}, data=body)
+
+
+def clients(cur, user_id):
+    cur.execute('SELECT reference, numero_clt, ville FROM client WHERE user_id = %s', (user_id,))
+    return {row['reference']: (row['numero_clt'], row['ville']) for row in cur.fetchall()}
+
+
+def client_row(reference, ville=''):
+    return {'reference': reference, 'nom': f'client {reference}', 'ville': ville, 'solde': '0'}
+
+
+def test_sync_updates_in_place_and_deletes_missing_rows(client, db, tenant):
+    migrate(client, tenant, {
+        'categorie': [{'description_c': 'boissons'}],
+        'client': [client_row('A'), client_row('B'), client_row('C')],
+    }, mode='reload')
+    before = clients(db, tenant)
+
+    summary = migrate(client, tenant, {'client': [client_row('A'), client_row('B', 'Oran'), client_row('D')]})
+
+    assert summary['sync']['client'] == {'inserees': 1, 'maj': 1, 'supprimees': 1}
+    after = clients(db, tenant)
+    assert set(after) == {'A', 'B', 'D'}
+    assert after['A'] == before['A']
+    assert after['B'] == (before['B'][0], 'Oran')
+    # Table absente de l'envoi : intacte
+    db.execute('SELECT count(*) AS n FROM categorie WHERE user_id = %s', (tenant,))
+    assert db.fetchone()['n'] == 1
+
+
+def test_sync_twice_changes_nothing(client, db, tenant):
+    data = {'client': [client_row('A'), client_row('B')]}
+    migrate(client, tenant, data)
+    before = clients(db, tenant)
+
+    summary = migrate(client, tenant, data)
+
+    assert summary['sync']['client'] == {'inserees': 0, 'maj': 0, 'supprimees': 0}
+    assert clients(db, tenant) == before
+
+
+def test_stream_sync_empty_table_declaration_deletes_rows(client, db, tenant):
+    migrate(client, tenant, {'client': [client_row('A'), client_row('B')]}, mode='reload')
+
+    response = migrate_stream(client, tenant, [{'table': 'client'}])
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    assert response.get_json()['sync']['client']['supprimees'] == 2
+    assert clients(db, tenant) == {}
+
+
+def test_stream_rejects_interleaved_table_without_changes(client, db, tenant):
+    migrate(client, tenant, {'client': [client_row('A')]}, mode='reload')
+    before = clients(db, tenant)
+
+    response = migrate_stream(client, tenant, [
+        {'table': 'client', 'row': client_row('B')},
+        {'table': 'fournisseur', 'row': {'reference': 'F1', 'nom': 'fournisseur'}},
+        {'table': 'client', 'row': client_row('C')},
+    ])
+
+    assert response.status_code == 400
+    assert clients(db, tenant) == before
@@ -0,0 +1,66 @@
+"""Offline sale batches: POST /valider_ventes_batch."""
+
+
+def vente(caisse, numero_item=None, **fields):
+    numero_util, items = caisse
+    return {
+        'numero_util': numero_util,
+        'password2': '1234',
+        'lignes': [{'numero_item': items[0] if numero_item is None else numero_item, 'quantite': 2, 'prixt': '5'}],
+        **fields,
+    }
+
+
+def stock(cur, numero_item):
+    cur.execute('SELECT qte FROM item WHERE numero_item = %s', (numero_item,))
+    return float(cur.fetchone()['qte'])
+
+
+def test_failing_sales_are_isolated(client, db, tenant, caisse):
+    ventes = [
+        vente(caisse),
+        vente(caisse, numero_item='x'),                                # échec en base
+        vente(caisse),
+        vente(caisse, numero_table=999999999, payment_mode='a_terme'),  # client inconnu
+        vente(caisse),
+        vente(caisse, password2='faux'),
+    ]
+
+    response = client.post('/valider_ventes_batch', json={'ventes': ventes}, headers={'X-User-ID': tenant})
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    body = response.get_json()
+    assert (body['validees'], body['rejetees']) == (3, 3)
+    resultats = body['resultats']
+    assert [r['index'] for r in resultats] == list(range(6))
+    assert [r.get('status') for r in resultats] == [None, 500, None, 500, None, 401]
+    assert [resultats[i]['compteur'] for i in (0, 2, 4)] == [1, 2, 3]
+    assert stock(db, caisse[1][0]) == 100 - 3 * 2
+    db.execute('SELECT count(*) AS n FROM comande WHERE user_id = %s', (tenant,))
+    assert db.fetchone()['n'] == 3
+
+
+def test_batch_matches_sequential_replay(client, db, tenant, caisse):
+    _, items = caisse
+    ventes = [vente(caisse, numero_item=items[k % 3]) for k in range(12)]
+    ventes[5] = vente(caisse, numero_item='x')
+    ventes[11] = vente(caisse, numero_table=999999999, payment_mode='a_terme')
+    headers = {'X-User-ID': tenant}
+
+    def state():
+        db.execute('SELECT nature, compteur FROM comande WHERE user_id = %s ORDER BY compteur', (tenant,))
+        comandes = [tuple(row.values()) for row in db.fetchall()]
+        return comandes, [stock(db, item) for item in items]
+
+    sequential = [client.post('/valider_vente', json=v, headers=headers).status_code for v in ventes]
+    assert [k for k, status in enumerate(sequential) if status != 200] == [5, 11]
+    expected = state()
+    db.execute('DELETE FROM attache WHERE user_id = %s', (tenant,))
+    db.execute('DELETE FROM comande WHERE user_id = %s', (tenant,))
+    db.execute('DELETE FROM comande_compteur WHERE user_id = %s', (tenant,))
+    db.execute('UPDATE item SET qte = 100 WHERE user_id = %s', (tenant,))
+
+    response = client.post('/valider_ventes_batch', json={'ventes': ventes}, headers=headers)
+
+    assert [r.get('status', 200) for r in response.get_json()['resultats']] == sequential
+    assert state() == expected